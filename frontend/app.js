@@ -767,14 +767,17 @@ async function runCalcForSelected() {
     const img  = $("#calc_preview");
     const thumbs = $("#calc_preview_thumbs");
 
+    // calc-service отдаёт уменьшенные варианты превью: size=thumb|medium|full, format=jpeg|webp
+    const variant = (u, size) => `${u}${u.includes("?") ? "&" : "?"}size=${size}&format=webp`;
+
     if (data?.preview?.processed_image_url) {
-      img.src = data.preview.processed_image_url;
+      img.src = variant(data.preview.processed_image_url, "medium");
       img.loading = "lazy"; img.decoding = "async";
       if (thumbs) {
         const singles = (data.preview.single_photos || []).filter(Boolean);
         thumbs.innerHTML = singles.map(u => `
           <a href="${u}" target="_blank" rel="noopener" style="display:block;border:1px solid #eee;border-radius:6px;overflow:hidden">
-            <img src="${u}" alt="bbox" style="width:100%;display:block" loading="lazy" decoding="async">
+            <img src="${variant(u, "thumb")}" alt="bbox" style="width:100%;display:block" loading="lazy" decoding="async">
           </a>`).join("");
       }
       show(wrap, true);
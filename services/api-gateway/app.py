@@ -1,6 +1,6 @@
 import os
 from urllib.parse import urljoin, urlparse, parse_qs
-from typing import Iterable, Tuple, Dict, Any
+from typing import Iterable, Tuple, Dict, Any, Optional
 
 import requests
 from flask import Flask, request, send_from_directory, Response, jsonify, stream_with_context
@@ -36,10 +36,13 @@ def _relay_bytes(r: requests.Response) -> Response:
     """Проксируем небинарный/мелкий ответ (r.content)."""
     return Response(r.content, status=r.status_code, headers=_filter_headers(r.headers))
 
-def _relay_stream(r: requests.Response) -> Response:
-    """Проксируем бинарный/крупный ответ стримом."""
+def _relay_stream(r: requests.Response, chunk_size: Optional[int] = 64 * 1024) -> Response:
+    """
+    Проксируем бинарный/крупный ответ стримом. chunk_size=None - поток событий (NDJSON/SSE)
+    без буферизации: каждый чанк уходит сразу, как пришел.
+    """
     def generate():
-        for chunk in r.iter_content(chunk_size=64 * 1024):
+        for chunk in r.iter_content(chunk_size=chunk_size):
             if chunk:
                 yield chunk
     return Response(stream_with_context(generate()), status=r.status_code, headers=_filter_headers(r.headers))
@@ -234,7 +237,9 @@ def api_calc_for_photo():
         batch_req = {
             "method": method,
             "seed": seed,
-            "images": [{"image_url": image_url, "lat": shot_lat, "lon": shot_lon}]
+            "auto_policy": payload.get("auto_policy"),
+            "images": [{"image_url": image_url, "photo_uuid": uuid, "path": p.get("name"),
+                        "lat": shot_lat, "lon": shot_lon}]
         }
         r = requests.post(urljoin(CALC_URL, "/detect_batch"),
                           json=batch_req,
@@ -314,6 +319,36 @@ def api_calc_photo():
                      timeout=DEFAULT_TIMEOUT)
     return _relay_stream(r)
 
+@app.post("/api/calc/jobs")
+def api_calc_jobs():
+    r = requests.post(urljoin(CALC_URL, "/jobs"),
+                      json=request.get_json(silent=True) or {},
+                      timeout=DEFAULT_TIMEOUT)
+    return _relay_bytes(r)
+
+@app.get("/api/calc/jobs/<job_id>")
+def api_calc_job(job_id):
+    r = requests.get(urljoin(CALC_URL, f"/jobs/{job_id}"),
+                     params=request.args,
+                     timeout=DEFAULT_TIMEOUT)
+    return _relay_bytes(r)
+
+@app.get("/api/calc/jobs/<job_id>/stream")
+def api_calc_job_stream(job_id):
+    headers = {k: v for k, v in request.headers.items() if k.lower() in ("accept", "last-event-id")}
+    r = requests.get(urljoin(CALC_URL, f"/jobs/{job_id}/stream"),
+                     params=request.args,
+                     headers=headers,
+                     stream=True,
+                     timeout=(5, None))  # поток держится, пока задача не завершится
+    return _relay_stream(r, chunk_size=None)
+
+@app.post("/api/calc/jobs/<job_id>/cancel")
+def api_calc_job_cancel(job_id):
+    r = requests.post(urljoin(CALC_URL, f"/jobs/{job_id}/cancel"),
+                      timeout=DEFAULT_TIMEOUT)
+    return _relay_bytes(r)
+
 @app.post("/api/calc_batch")
 def api_calc_batch():
     data = request.get_json(silent=True) or {}
@@ -333,13 +368,16 @@ def api_calc_batch():
             metas.append({
                 "photo_id": pid,
                 "image_url": urljoin(PHOTO_URL, f"/photos/{p['uuid']}"),
+                "photo_uuid": p["uuid"],
+                "path": p.get("name"),
                 "lat": p.get("shot_lat"),
                 "lon": p.get("shot_lon")
             })
 
-    images = [{"image_url": m["image_url"], "lat": m["lat"], "lon": m["lon"]} for m in metas]
+    images = [{k: m[k] for k in ("image_url", "photo_uuid", "path", "lat", "lon")} for m in metas]
     r = requests.post(urljoin(CALC_URL, "/detect_batch"),
-                      json={"method": method, "seed": seed, "images": images},
+                      json={"method": method, "seed": seed, "images": images,
+                            "auto_policy": data.get("auto_policy")},
                       timeout=(10, 300))
     if r.status_code != 200:
         return _relay_bytes(r)
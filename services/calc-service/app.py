@@ -1,9 +1,25 @@
+import contextlib
+import functools
+import hashlib
 import io
+import json
 import logging
 import math
+import multiprocessing
+import multiprocessing.connection
 import os
+import pickle
+import queue
 import random
+import resource
+import sqlite3
+import threading
+import time
+import types
 import uuid
+import zlib
+from collections import OrderedDict, deque
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
 
 import cv2
 import numpy as np
@@ -11,25 +27,220 @@ import torch
 from transformers import OneFormerProcessor, OneFormerForUniversalSegmentation
 
 import requests
-from flask import Flask, request, jsonify, send_file
+from requests.adapters import HTTPAdapter
+from urllib.parse import urlsplit
+from flask import Flask, Request, Response, request, jsonify, send_file, stream_with_context
 from PIL import Image, ImageDraw, ImageFont
+from werkzeug.exceptions import RequestEntityTooLarge
+
+# ONNX Runtime - необязательный CPU-бэкенд инференса
+try:
+    import onnxruntime as ort
+    from onnxruntime.quantization import QuantType, quantize_dynamic
+except Exception:
+    ort = None
+
+# zstandard - необязательный кодек для карт классов (без него - zlib)
+try:
+    import zstandard
+except Exception:
+    zstandard = None
 
 # Настройка логирования
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-app = Flask(__name__)
+class CalcRequest(Request):
+    """Файлы multipart читаются в память, а не во временные файлы: байты сразу идут в декодирование"""
+
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        return io.BytesIO()
 
-# Хранилище для сгенерированных фото
-PHOTO_STORAGE = {}
-UPLOAD_DIR = "/tmp/calc_service_photos"
-os.makedirs(UPLOAD_DIR, exist_ok=True)
+app = Flask(__name__)
+app.request_class = CalcRequest
 
 # Глобальные настройки
 BASE_URL = "http://localhost:5004"
 
+# Хранилище сгенерированных фото: каталог (индекс + файлы), лимит объема,
+# время жизни фото без обращений и период фоновой очистки
+RENDER_STORE_DIR = os.environ.get("RENDER_STORE_DIR", "/tmp/calc_service_photos")
+RENDER_STORE_MAX_MB = int(os.environ.get("RENDER_STORE_MAX_MB", "2048"))
+RENDER_STORE_TTL_SEC = float(os.environ.get("RENDER_STORE_TTL_SEC", str(7 * 24 * 3600)))
+RENDER_STORE_SWEEP_SEC = float(os.environ.get("RENDER_STORE_SWEEP_SEC", "300"))
+# Токен для административных операций (/clear); пустой - без проверки
+ADMIN_TOKEN = os.environ.get("ADMIN_TOKEN", "")
+
+# Кэш моделей на диске и бюджет RAM для загруженных в память моделей
+MODEL_CACHE_DIR = os.environ.get("MODEL_CACHE_DIR", "./model_cache")
+MODEL_RAM_BUDGET_MB = int(os.environ.get("MODEL_RAM_BUDGET_MB", "6144"))
+
+# Кэш загруженных изображений: бюджет, время свежести записи до перепроверки,
+# хранить ли декодированные RGB вместе с байтами
+IMAGE_CACHE_MAX_MB = int(os.environ.get("IMAGE_CACHE_MAX_MB", "512"))
+IMAGE_CACHE_FRESH_SEC = float(os.environ.get("IMAGE_CACHE_FRESH_SEC", "60"))
+IMAGE_CACHE_DECODED = os.environ.get("IMAGE_CACHE_DECODED", "1") == "1"
+# Загрузка изображений: размер пула HTTP-соединений и одновременных запросов к одному хосту
+FETCH_POOL_SIZE = int(os.environ.get("FETCH_POOL_SIZE", "32"))
+FETCH_PER_HOST_LIMIT = int(os.environ.get("FETCH_PER_HOST_LIMIT", "4"))
+# Общий с photo-service том загрузок (только чтение): фото по photo_uuid / path читаются с диска,
+# пустое значение - только HTTP. PHOTO_SERVICE_URL - адрес photo-service для отката на HTTP
+UPLOAD_DIR = os.environ.get("UPLOAD_DIR", "")
+PHOTO_SERVICE_URL = os.environ.get("PHOTO_SERVICE_URL", "http://photo-service:5000")
+# Лимит тела запроса (изображения в multipart или телом запроса), сверх - 413; 0 - без лимита
+MAX_UPLOAD_MB = int(os.environ.get("MAX_UPLOAD_MB", "512"))
+app.config["MAX_CONTENT_LENGTH"] = MAX_UPLOAD_MB * 1024 * 1024 if MAX_UPLOAD_MB > 0 else None
+
+# Постобработка: минимальная площадь здания (px) и порог уверенности класса "здание"
+DETECTION_MIN_AREA = int(os.environ.get("DETECTION_MIN_AREA", "500"))
+DETECTION_BUILDING_CONFIDENCE = float(os.environ.get("DETECTION_BUILDING_CONFIDENCE", "0.6"))
+
+# Кэш результатов детекции по содержимому изображения: каталог и лимит объема (0 - выключен)
+RESULT_CACHE_DIR = os.environ.get("RESULT_CACHE_DIR", "/tmp/calc_service_results")
+RESULT_CACHE_MAX_MB = int(os.environ.get("RESULT_CACHE_MAX_MB", "1024"))
+# Версия формата результатов: меняется вместе с постобработкой, старые записи не используются
+RESULT_CACHE_VERSION = 2
+
+# Сохраненные карты классов для повторной постобработки без инференса: каталог и лимит (0 - выключено)
+LABEL_MAP_DIR = os.environ.get("LABEL_MAP_DIR", "/tmp/calc_service_label_maps")
+LABEL_MAP_MAX_MB = int(os.environ.get("LABEL_MAP_MAX_MB", "2048"))
+# Ограничение сетки порогов в /reprocess/sweep
+SWEEP_MAX_PAIRS = int(os.environ.get("SWEEP_MAX_PAIRS", "400"))
+
+# Варианты выходных изображений: размеры превью (по длинной стороне), форматы, качество
+OUTPUT_SIZES = {
+    "full": None,
+    "medium": int(os.environ.get("OUTPUT_MEDIUM_MAX_SIDE", "1024")),
+    "thumb": int(os.environ.get("OUTPUT_THUMB_MAX_SIDE", "320"))
+}
+OUTPUT_FORMATS = {
+    "jpeg": {"pil_format": "JPEG", "mimetype": "image/jpeg", "ext": "jpg"},
+    "webp": {"pil_format": "WEBP", "mimetype": "image/webp", "ext": "webp"}
+}
+OUTPUT_DEFAULT_QUALITY = int(os.environ.get("OUTPUT_DEFAULT_QUALITY", "90"))
+
+# Дополнительные категории объектов (помимо зданий, дорог и прочего) по ключевым словам классов
+EXTRA_CATEGORIES = json.loads(os.environ.get("EXTRA_CATEGORIES") or json.dumps({
+    "vegetation": ["tree", "grass", "plant", "palm", "flower", "vegetation", "terrain"],
+    "vehicle": ["car", "bus", "truck", "van", "bicycle", "motorbike", "motorcycle", "train"],
+    "sky": ["sky"]
+}))
+
+# Микробатчинг прямых проходов модели
+INFERENCE_MAX_BATCH_SIZE = int(os.environ.get("INFERENCE_MAX_BATCH_SIZE", "4"))
+INFERENCE_MAX_WAIT_MS = float(os.environ.get("INFERENCE_MAX_WAIT_MS", "25"))
+INFERENCE_BUCKET_PX = int(os.environ.get("INFERENCE_BUCKET_PX", "64"))
+# Сколько изображений /detect_batch отдает на детекцию одновременно
+BATCH_DETECT_WINDOW = int(os.environ.get("BATCH_DETECT_WINDOW", str(2 * INFERENCE_MAX_BATCH_SIZE)))
+# Конвейер /detect_batch: потоки стадий загрузки и отрисовки (детекция - BATCH_DETECT_WINDOW)
+# и сколько изображений пакета одновременно находится между стадиями
+BATCH_FETCH_WORKERS = int(os.environ.get("BATCH_FETCH_WORKERS", "8"))
+BATCH_RENDER_WORKERS = int(os.environ.get("BATCH_RENDER_WORKERS", "2"))
+BATCH_PIPELINE_DEPTH = int(os.environ.get("BATCH_PIPELINE_DEPTH", "16"))
+
+# Асинхронные задачи (/jobs): сколько задач выполняется одновременно, таймаут
+# на одно изображение, сколько хранить завершенные задачи, период heartbeat в потоке
+JOBS_MAX_CONCURRENT = int(os.environ.get("JOBS_MAX_CONCURRENT", "2"))
+JOB_IMAGE_TIMEOUT_SEC = float(os.environ.get("JOB_IMAGE_TIMEOUT_SEC", "120"))
+JOB_RETENTION_SEC = float(os.environ.get("JOB_RETENTION_SEC", "3600"))
+JOB_STREAM_HEARTBEAT_SEC = float(os.environ.get("JOB_STREAM_HEARTBEAT_SEC", "15"))
+
+# Пул процессов инференса: число воркеров (0 - инференс в процессе Flask), потоки torch
+# на воркер (0 - поровну разделить доступные ядра), interop-потоки, привязка воркеров к ядрам
+INFERENCE_WORKERS = int(os.environ.get("INFERENCE_WORKERS", "0"))
+INFERENCE_WORKER_THREADS = int(os.environ.get("INFERENCE_WORKER_THREADS", "0"))
+INFERENCE_WORKER_INTEROP_THREADS = int(os.environ.get("INFERENCE_WORKER_INTEROP_THREADS", "1"))
+INFERENCE_WORKER_AFFINITY = os.environ.get("INFERENCE_WORKER_AFFINITY", "0") == "1"
+# Ограничение нагрузки: изображений в очереди и в работе у пула, одновременных запросов
+# /detect и /detect_batch (0 - без ограничения); сверх них отвечаем 429 с Retry-After
+INFERENCE_QUEUE_MAX = int(os.environ.get("INFERENCE_QUEUE_MAX", "64"))
+MAX_INFLIGHT_REQUESTS = int(os.environ.get("MAX_INFLIGHT_REQUESTS", "32"))
+RETRY_AFTER_SEC = int(os.environ.get("RETRY_AFTER_SEC", "5"))
+
+# Бэкенд инференса: torch | onnx | onnx-int8 (ONNX Runtime на CPU, int8 - динамическая
+# квантизация весов); по умолчанию и по методам, например INFERENCE_BACKENDS='{"1": "onnx-int8"}'
+INFERENCE_BACKEND = os.environ.get("INFERENCE_BACKEND", "torch")
+INFERENCE_BACKENDS = json.loads(os.environ.get("INFERENCE_BACKENDS") or "{}")
+INFERENCE_BACKEND_CHOICES = ("torch", "onnx", "onnx-int8")
+
+# Быстрый препроцессинг (cv2/NumPy в переиспользуемый тензор) вместо OneFormerProcessor;
+# включается только для процессоров со стандартным ресайзом и нормализацией
+FAST_PREPROCESS = os.environ.get("FAST_PREPROCESS", "1") == "1"
+
+# Argmax карты классов на промежуточном разрешении (длинная сторона не больше ARGMAX_MAX_SIDE),
+# до размера фото масштабируется уже карта uint8/uint16 (nearest); 0 - логиты на полном разрешении
+ARGMAX_MAX_SIDE = int(os.environ.get("ARGMAX_MAX_SIDE", "1024"))
+
+# Декодирование JPEG для инференса сразу в уменьшенном масштабе (1/2-1/8, не меньше входа модели)
+REDUCED_DECODE = os.environ.get("REDUCED_DECODE", "1") == "1"
+
+# Бюджет памяти на одно изображение (оценка по размеру до декодирования, 0 - без проверки) и что
+# делать при превышении: downscale - анализ в уменьшенной геометрии, reject - отказ (413)
+REQUEST_MEMORY_BUDGET_MB = int(os.environ.get("REQUEST_MEMORY_BUDGET_MB", "4096"))
+MEMORY_OVERBUDGET_ACTION = os.environ.get("MEMORY_OVERBUDGET_ACTION", "downscale")
+# Период опроса RSS процесса для замера пика во время обработки
+RSS_SAMPLE_MS = int(os.environ.get("RSS_SAMPLE_MS", "20"))
+
+# Тайловый инференс для очень больших изображений (панорамы, съемка с дронов): порог
+# включения в мегапикселях (0 - выключен), сторона тайла и перекрытие в пикселях исходника
+TILED_INFERENCE_MIN_MP = float(os.environ.get("TILED_INFERENCE_MIN_MP", "12"))
+TILE_SIZE = int(os.environ.get("TILE_SIZE", "1024"))
+TILE_OVERLAP = int(os.environ.get("TILE_OVERLAP", "128"))
+if TILE_SIZE < 1 or not 0 <= TILE_OVERLAP < TILE_SIZE:
+    # При перекрытии >= тайла шаг вырождается в 1 px - тысячи тайлов на одно фото
+    raise ValueError(f"TILE_OVERLAP must satisfy 0 <= TILE_OVERLAP < TILE_SIZE (got {TILE_OVERLAP} and {TILE_SIZE})")
+
+# Автоподбор (method=0): сколько моделей-кандидатов прогоняется параллельно
+AUTO_SELECT_WORKERS = int(os.environ.get("AUTO_SELECT_WORKERS", "2"))
+# Политики автоподбора: exhaustive - все модели, cascade - дешевая модель первой,
+# тяжелые запускаются только если результат не проходит порог качества
+AUTO_POLICY = os.environ.get("AUTO_POLICY", "exhaustive")
+AUTO_POLICIES = {
+    "exhaustive": {
+        "stages": [[1, 2, 3, 4, 5]],
+        "accept": None
+    },
+    "cascade": {
+        "stages": [[1], [2], [4, 3, 5]],
+        "accept": {
+            "min_buildings": 1,
+            "min_mean_confidence": 0.8,
+            "min_building_ratio": 0.02
+        }
+    }
+}
+# Переопределение каскада из окружения, например:
+# AUTO_CASCADE_POLICY='{"stages": [[1], [4]], "accept": {"min_buildings": 3}}'
+if os.environ.get("AUTO_CASCADE_POLICY"):
+    _cascade_override = json.loads(os.environ["AUTO_CASCADE_POLICY"])
+    AUTO_POLICIES["cascade"]["stages"] = _cascade_override.get("stages", AUTO_POLICIES["cascade"]["stages"])
+    AUTO_POLICIES["cascade"]["accept"].update(_cascade_override.get("accept", {}))
+# Потоки torch на процесс (0 - оставить значение torch по умолчанию)
+TORCH_NUM_THREADS = int(os.environ.get("TORCH_NUM_THREADS", "0"))
+if TORCH_NUM_THREADS > 0:
+    torch.set_num_threads(TORCH_NUM_THREADS)
+
+def _to_rgb_image(image):
+    """Приводит путь, массив или PIL-изображение к PIL RGB"""
+    if isinstance(image, str):
+        return Image.open(image).convert('RGB')
+    if isinstance(image, np.ndarray):
+        return Image.fromarray(image).convert('RGB')
+    return image if image.mode == 'RGB' else image.convert('RGB')
+
+class _OneFormerExportWrapper(torch.nn.Module):
+    """Обертка для экспорта в ONNX: на выходе только логиты классов и масок запросов"""
+
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    def forward(self, pixel_values, task_inputs, pixel_mask):
+        outputs = self.model(pixel_values=pixel_values, task_inputs=task_inputs, pixel_mask=pixel_mask)
+        return outputs.class_queries_logits, outputs.masks_queries_logits
+
 class AdvancedUrbanSegmentator:
-    def __init__(self, model_name="shi-labs/oneformer_ade20k_swin_tiny", cache_dir=None):
+    def __init__(self, model_name="shi-labs/oneformer_ade20k_swin_tiny", cache_dir=None, backend="torch"):
         self.model_name = model_name
         self.cache_dir = cache_dir
         
@@ -46,9 +257,117 @@ class AdvancedUrbanSegmentator:
                 self.processor.save_pretrained(local_model_path)
                 self.model.save_pretrained(local_model_path)
         
+        self._task_inputs = None
+        self.fast_preprocess = FAST_PREPROCESS and self._fast_preprocess_supported()
+        self._input_lock = threading.Lock()
+        self._input_storage = None
         self.class_names = self.model.config.id2label
         self.building_class_ids = self._find_building_class_ids()
         self.road_class_ids = self._find_road_class_ids()
+        self.category_bits, self.category_lut = self._build_category_lut()
+        
+        self.backend = "torch"
+        self.onnx_path = None
+        self.onnx_session = None
+        if backend != "torch":
+            try:
+                self._load_onnx(quantize=backend == "onnx-int8")
+                self.backend = backend
+            except Exception as e:
+                logger.error(f"Бэкенд {backend} для {model_name} недоступен ({e}), используется torch")
+    
+    @classmethod
+    def for_class_names(cls, model_name, class_names):
+        """
+        Сегментатор без модели - только постобработка по сохраненной карте классов
+        (таблица категорий строится по именам классов, как у загруженной модели)
+        """
+        segmentator = cls.__new__(cls)
+        segmentator.model_name = model_name
+        segmentator.cache_dir = None
+        segmentator.processor = None
+        segmentator.model = None
+        segmentator.backend = None
+        segmentator.onnx_path = None
+        segmentator.onnx_session = None
+        segmentator._task_inputs = None
+        segmentator.fast_preprocess = False
+        segmentator.class_names = class_names
+        segmentator.building_class_ids = segmentator._find_building_class_ids()
+        segmentator.road_class_ids = segmentator._find_road_class_ids()
+        segmentator.category_bits, segmentator.category_lut = segmentator._build_category_lut()
+        return segmentator
+    
+    def _onnx_artifact_path(self, quantize):
+        """Путь к ONNX-артефакту модели рядом с кэшем моделей"""
+        safe_name = self.model_name.replace("/", "_")
+        root = os.path.join(self.cache_dir or ".", "onnx", safe_name)
+        return os.path.join(root, "model.int8.onnx" if quantize else "model.onnx")
+    
+    def _export_onnx(self, path):
+        """Экспортирует модель в ONNX один раз; запись атомарная, чтобы воркеры не видели полуфайл"""
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.model.eval()
+        pixel_inputs = self.preprocess_images([Image.new('RGB', (512, 512))])
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with torch.no_grad():
+            torch.onnx.export(
+                _OneFormerExportWrapper(self.model),
+                (pixel_inputs["pixel_values"], self.task_inputs(1), pixel_inputs["pixel_mask"]),
+                tmp_path,
+                input_names=["pixel_values", "task_inputs", "pixel_mask"],
+                output_names=["class_queries_logits", "masks_queries_logits"],
+                dynamic_axes={
+                    "pixel_values": {0: "batch", 2: "height", 3: "width"},
+                    "task_inputs": {0: "batch"},
+                    "pixel_mask": {0: "batch", 1: "height", 2: "width"},
+                    "class_queries_logits": {0: "batch"},
+                    "masks_queries_logits": {0: "batch", 2: "mask_height", 3: "mask_width"}
+                },
+                opset_version=17,
+                dynamo=False
+            )
+        os.replace(tmp_path, path)
+    
+    def _load_onnx(self, quantize):
+        """Загружает ONNX-сессию (экспорт и квантизация - при первом запуске)"""
+        if ort is None:
+            raise RuntimeError("onnxruntime is not installed")
+        fp32_path = self._onnx_artifact_path(quantize=False)
+        if not os.path.exists(fp32_path):
+            started = time.time()
+            self._export_onnx(fp32_path)
+            logger.info(f"Модель {self.model_name} экспортирована в ONNX за {time.time() - started:.1f} с")
+        path = fp32_path
+        if quantize:
+            path = self._onnx_artifact_path(quantize=True)
+            if not os.path.exists(path):
+                tmp_path = f"{path}.{os.getpid()}.tmp"
+                quantize_dynamic(fp32_path, tmp_path, weight_type=QuantType.QInt8)
+                os.replace(tmp_path, path)
+                logger.info(f"Модель {self.model_name}: int8-квантизация сохранена в {path}")
+        
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        options.intra_op_num_threads = torch.get_num_threads()
+        self.onnx_session = ort.InferenceSession(path, sess_options=options, providers=["CPUExecutionProvider"])
+        self.onnx_path = path
+        # Веса torch больше не нужны: прямой проход идет через ONNX Runtime
+        self.model = None
+    
+    def _run_onnx(self, inputs):
+        """Прямой проход через ONNX Runtime; выходы в виде torch-тензоров, как у модели"""
+        feeds = {
+            node.name: inputs[node.name].numpy()
+            for node in self.onnx_session.get_inputs() if node.name in inputs
+        }
+        class_logits, mask_logits = self.onnx_session.run(
+            ["class_queries_logits", "masks_queries_logits"], feeds
+        )
+        return types.SimpleNamespace(
+            class_queries_logits=torch.from_numpy(class_logits),
+            masks_queries_logits=torch.from_numpy(mask_logits)
+        )
     
     def _get_local_model_path(self):
         if not self.cache_dir:
@@ -72,58 +391,247 @@ class AdvancedUrbanSegmentator:
                 road_ids.append(class_id)
         return road_ids or [11, 12, 13]
     
-    def semantic_segmentation_detailed(self, image, min_area=500, building_confidence=0.6):
-        if isinstance(image, str):
-            image = Image.open(image).convert('RGB')
-        elif isinstance(image, np.ndarray):
-            image = Image.fromarray(image).convert('RGB')
-        else:
-            image = image.convert('RGB')
+    def _build_category_lut(self):
+        """
+        Таблица class_id -> битовая маска категорий. Класс может входить в несколько
+        категорий (например, дерево - и в "other", и в "vegetation"), поэтому категории
+        кодируются битами, а маска любой категории получается из одной выборки по таблице.
+        """
+        category_bits = OrderedDict([("building", 1), ("road", 2), ("other", 4)])
+        for index, name in enumerate(EXTRA_CATEGORIES):
+            category_bits[name] = 8 << index
         
-        inputs = self.processor(images=image, task_inputs=["semantic"], return_tensors="pt")
-        
-        with torch.no_grad():
-            outputs = self.model(**inputs)
+        lut_size = max(max(self.class_names) + 1, len(self.class_names))
+        lut = np.zeros(lut_size, dtype=np.uint8 if len(category_bits) <= 8 else np.uint32)
+        building_ids = [i for i in self.building_class_ids if i < lut_size]
+        road_ids = [i for i in self.road_class_ids if i < lut_size]
+        lut[building_ids] |= category_bits["building"]
+        lut[road_ids] |= category_bits["road"]
         
-        semantic_map = self.processor.post_process_semantic_segmentation(
-            outputs, target_sizes=[image.size[::-1]]
-        )[0]
+        # Остальные объекты - все классы, кроме фона (0), зданий и дорог
+        other_ids = [i for i in range(1, len(self.class_names))
+                     if i not in self.building_class_ids and i not in self.road_class_ids]
+        lut[other_ids] |= category_bits["other"]
         
-        semantic_map_np = semantic_map.cpu().numpy()
+        for name, keywords in EXTRA_CATEGORIES.items():
+            for class_id, class_name in self.class_names.items():
+                if any(keyword in class_name.lower() for keyword in keywords):
+                    lut[class_id] |= category_bits[name]
+        return category_bits, lut
+    
+    def category_mask(self, category_flags, name):
+        """Маска категории (uint8 0/1) по карте битов категорий"""
+        return ((category_flags & self.category_bits[name]) != 0).view(np.uint8)
+    
+    def category_stats(self, semantic_map_np):
+        """Доля пикселей каждой категории по гистограмме классов (один проход по карте)"""
+        class_counts = np.bincount(semantic_map_np.ravel(), minlength=self.category_lut.size)
+        total = max(1, semantic_map_np.size)
+        return {
+            name: round(float(class_counts[:self.category_lut.size][(self.category_lut & bit) != 0].sum()) / total, 4)
+            for name, bit in self.category_bits.items()
+        }
+    
+    def semantic_segmentation_detailed(self, image, min_area=500, building_confidence=0.6):
+        image = _to_rgb_image(image)
+        semantic_map_np = self.predict_semantic_maps([image])[0]
+        return self.postprocess_semantic_map(semantic_map_np, min_area, building_confidence)
+    
+    def resized_shape(self, image_size):
+        """Размер (h, w), к которому процессор приведет изображение перед подачей в модель"""
+        width, height = image_size
+        size = self.processor.image_processor.size
+        shortest_edge = size["shortest_edge"]
+        longest_edge = size.get("longest_edge")
+        short, long = (width, height) if width <= height else (height, width)
+        new_short, new_long = shortest_edge, int(shortest_edge * long / short)
+        if longest_edge and new_long > longest_edge:
+            new_short, new_long = int(longest_edge * new_short / new_long), longest_edge
+        return (new_long, new_short) if width <= height else (new_short, new_long)
+    
+    def preprocess_signature(self):
+        """Ключ совместимости препроцессинга: одинаковый ключ - одинаковые тензоры входа"""
+        image_processor = self.processor.image_processor
+        return repr(tuple(
+            getattr(image_processor, name, None)
+            for name in ("do_resize", "size", "resample", "do_rescale", "rescale_factor",
+                         "do_normalize", "image_mean", "image_std")
+        ))
+    
+    def preprocess_images(self, images, fast=None, reuse_buffer=False):
+        """
+        Ресайз и нормализация изображений; возвращает pixel_values и pixel_mask.
+        fast=None - быстрый путь, если он поддерживается процессором модели;
+        reuse_buffer - писать pixel_values в общий буфер (только под self._input_lock)
+        """
+        images = [_to_rgb_image(image) for image in images]
+        if self.fast_preprocess if fast is None else fast:
+            return self._preprocess_fast(images, reuse_buffer)
+        inputs = self.processor(images=images, task_inputs=["semantic"] * len(images), return_tensors="pt")
+        if self._task_inputs is None:
+            self._task_inputs = inputs["task_inputs"][:1].clone()
+        return {key: inputs[key] for key in ("pixel_values", "pixel_mask") if key in inputs}
+    
+    def _fast_preprocess_supported(self):
+        """Быстрый путь повторяет только стандартную цепочку: bilinear-ресайз, rescale, normalize"""
+        image_processor = self.processor.image_processor
+        size = getattr(image_processor, "size", None) or {}
+        return (
+            getattr(image_processor, "do_resize", False) and "shortest_edge" in size
+            and int(getattr(image_processor, "resample", -1)) == int(Image.BILINEAR)
+            and getattr(image_processor, "do_rescale", False)
+            and getattr(image_processor, "do_normalize", False)
+        )
+    
+    def _preprocess_fast(self, images, reuse_buffer):
+        """
+        Препроцессинг без OneFormerProcessor: ресайз cv2 (INTER_AREA при уменьшении - ближе
+        всего к антиалиасингу PIL), rescale и normalize одним проходом по uint8, паддинг
+        вправо и вниз до общего размера батча, как у процессора
+        """
+        image_processor = self.processor.image_processor
+        scale = np.asarray(image_processor.image_std, dtype=np.float32)
+        # (x * rescale_factor - mean) / std = x * scale + offset
+        offset = -np.asarray(image_processor.image_mean, dtype=np.float32) / scale
+        scale = np.float32(image_processor.rescale_factor) / scale
         
-        # Создаем маски для разных типов объектов
-        building_mask = np.zeros_like(semantic_map_np, dtype=np.uint8)
-        road_mask = np.zeros_like(semantic_map_np, dtype=np.uint8)
-        other_mask = np.zeros_like(semantic_map_np, dtype=np.uint8)
+        shapes = [self.resized_shape(image.size) for image in images]
+        height = max(h for h, _ in shapes)
+        width = max(w for _, w in shapes)
+        numel = len(images) * 3 * height * width
+        if reuse_buffer:
+            if self._input_storage is None or self._input_storage.numel() < numel:
+                self._input_storage = torch.empty(numel, dtype=torch.float32)
+            pixel_values = self._input_storage[:numel].view(len(images), 3, height, width)
+        else:
+            pixel_values = torch.empty((len(images), 3, height, width), dtype=torch.float32)
+        pixel_mask = torch.zeros((len(images), height, width), dtype=torch.int64)
         
-        # Заполняем маску зданий
-        for class_id in self.building_class_ids:
-            building_mask[semantic_map_np == class_id] = 1
+        values = pixel_values.numpy()
+        for i, (image, (h, w)) in enumerate(zip(images, shapes)):
+            array = np.asarray(image)
+            interpolation = cv2.INTER_AREA if h * w < array.shape[0] * array.shape[1] else cv2.INTER_LINEAR
+            resized = cv2.resize(array, (w, h), interpolation=interpolation).transpose(2, 0, 1)
+            target = values[i, :, :h, :w]
+            np.multiply(resized, scale[:, None, None], out=target, casting="unsafe")
+            target += offset[:, None, None]
+            if h < height or w < width:
+                values[i, :, h:, :] = 0
+                values[i, :, :h, w:] = 0
+            pixel_mask[i, :h, :w] = 1
+        return {"pixel_values": pixel_values, "pixel_mask": pixel_mask}
+    
+    def task_inputs(self, batch_size):
+        """Токены текстовой задачи "semantic" - постоянны для модели, считаются один раз"""
+        if self._task_inputs is None:
+            dummy = Image.new('RGB', (32, 32))
+            inputs = self.processor(images=[dummy], task_inputs=["semantic"], return_tensors="pt")
+            self._task_inputs = inputs["task_inputs"][:1].clone()
+        return self._task_inputs.expand(batch_size, -1)
+    
+    def forward_semantic_maps(self, pixel_inputs, target_sizes, argmax_max_side=None):
+        """Прямой проход по готовым тензорам входа; возвращает карты классов размеров target_sizes"""
+        inputs = dict(pixel_inputs)
+        inputs["task_inputs"] = self.task_inputs(inputs["pixel_values"].shape[0])
         
-        # Заполняем маску дорог
-        for class_id in self.road_class_ids:
-            road_mask[semantic_map_np == class_id] = 1
+        if self.onnx_session is not None:
+            outputs = self._run_onnx(inputs)
+        else:
+            with torch.no_grad():
+                outputs = self.model(**inputs)
         
-        # Маска для всех остальных объектов (кроме фона)
-        background_class = 0  # обычно 0 - это фон
-        for class_id in range(1, len(self.class_names)):  # начинаем с 1, чтобы исключить фон
-            if class_id not in self.building_class_ids and class_id not in self.road_class_ids:
-                other_mask[semantic_map_np == class_id] = 1
+        return self._semantic_maps_from_outputs(outputs, inputs.get("pixel_mask"), target_sizes, argmax_max_side)
+    
+    def predict_semantic_maps(self, images):
+        """Один прямой проход модели по батчу изображений; возвращает карты классов"""
+        images = [_to_rgb_image(image) for image in images]
+        target_sizes = [_source_size(image)[::-1] for image in images]
+        # Буфер входа переиспользуется между батчами: свободен, как только прямой проход завершен
+        with self._input_lock:
+            pixel_inputs = self.preprocess_images(images, reuse_buffer=True)
+            return self.forward_semantic_maps(pixel_inputs, target_sizes)
+    
+    def _semantic_maps_from_outputs(self, outputs, pixel_mask, target_sizes, argmax_max_side=None):
+        """
+        Аналог processor.post_process_semantic_segmentation, но с учетом паддинга в батче:
+        логиты каждого изображения обрезаются до его области перед масштабированием.
+
+        Логиты масштабируются не до размера фото, а до промежуточного (длинная сторона не
+        больше argmax_max_side): для 150 классов и 12 Мп это гигабайты float32. До размера
+        фото увеличивается уже карта классов uint8/uint16 ближайшим соседом.
+        """
+        if argmax_max_side is None:
+            argmax_max_side = ARGMAX_MAX_SIDE
+        masks_classes = outputs.class_queries_logits.softmax(dim=-1)[..., :-1]
+        masks_probs = outputs.masks_queries_logits.sigmoid()
+        segmentation = torch.einsum("bqc, bqhw -> bchw", masks_classes, masks_probs)
+        label_dtype = np.uint8 if segmentation.shape[1] <= 256 else np.uint16
         
-        building_mask_refined = self._refine_mask_soft(building_mask)
-        road_mask_refined = self._refine_mask_soft(road_mask)
-        other_mask_refined = self._refine_mask_soft(other_mask)
+        semantic_maps = []
+        for idx, target_size in enumerate(target_sizes):
+            logits = segmentation[idx]
+            if pixel_mask is not None:
+                padded_h, padded_w = pixel_mask.shape[-2:]
+                valid_h = int(pixel_mask[idx].any(dim=1).sum())
+                valid_w = int(pixel_mask[idx].any(dim=0).sum())
+                crop_h = max(1, math.ceil(logits.shape[-2] * valid_h / padded_h))
+                crop_w = max(1, math.ceil(logits.shape[-1] * valid_w / padded_w))
+                logits = logits[:, :crop_h, :crop_w]
+            height, width = target_size
+            factor = min(1.0, argmax_max_side / max(height, width)) if argmax_max_side > 0 else 1.0
+            argmax_size = (max(1, round(height * factor)), max(1, round(width * factor)))
+            resized_logits = torch.nn.functional.interpolate(
+                logits.unsqueeze(dim=0), size=argmax_size, mode="bilinear", align_corners=False
+            )
+            semantic_map = resized_logits[0].argmax(dim=0).cpu().numpy().astype(label_dtype)
+            del resized_logits
+            if argmax_size != (height, width):
+                semantic_map = cv2.resize(semantic_map, (width, height), interpolation=cv2.INTER_NEAREST)
+            semantic_maps.append(semantic_map)
+        return semantic_maps
+    
+    def postprocess_semantic_map(self, semantic_map_np, min_area=500, building_confidence=0.6):
+        """Маски категорий и компоненты зданий по карте классов"""
+        # Одна выборка по таблице категорий вместо сравнения карты с каждым class_id
+        # Неуточненные маски не переживают своего уточнения - в памяти по одной маске на категорию
+        category_flags = self.category_lut[semantic_map_np]
+        building_mask_refined = self._refine_mask_soft(self.category_mask(category_flags, "building"))
+        road_mask_refined = self._refine_mask_soft(self.category_mask(category_flags, "road"))
+        other_mask_refined = self._refine_mask_soft(self.category_mask(category_flags, "other"))
+        del category_flags
         
         buildings_dict = self._extract_components_soft(building_mask_refined, min_area, "building", 
                                                      semantic_map_np, building_confidence)
         
         return {
             "buildings": buildings_dict,
+            "building_ratio": float(np.count_nonzero(building_mask_refined)) / building_mask_refined.size,
             "road_mask": road_mask_refined,
             "other_mask": other_mask_refined,
-            "semantic_map": semantic_map_np
+            "category_stats": self.category_stats(semantic_map_np),
+            "semantic_map": semantic_map_np,
+            "class_names": self.class_names
         }
     
+    def sweep_thresholds(self, semantic_map_np, min_areas, building_confidences):
+        """
+        Число зданий и их средняя уверенность для каждой пары (min_area, building_confidence).
+        Маска и таблица компонент строятся один раз (для наименьшего min_area), пороги
+        применяются к таблице, поэтому сетка любого размера стоит почти как одна постобработка.
+        """
+        category_flags = self.category_lut[semantic_map_np]
+        building_mask = self._refine_mask_soft(self.category_mask(category_flags, "building"))
+        del category_flags
+        table = self._component_table(building_mask, semantic_map_np, min(min_areas))
+        
+        areas = table["area"][None, None, :]
+        confidences = table["confidence"][None, None, :]
+        selected = ((areas >= np.asarray(min_areas)[:, None, None]) &
+                    (confidences >= np.asarray(building_confidences)[None, :, None]))
+        counts = selected.sum(axis=2)
+        confidence_sums = (selected * confidences).sum(axis=2)
+        return counts, confidence_sums
+    
     def _refine_mask_soft(self, mask):
         if np.sum(mask) == 0:
             return mask
@@ -134,550 +642,3452 @@ class AdvancedUrbanSegmentator:
         
         return cleaned_mask
     
-    def _extract_components_soft(self, mask, min_area, object_type, semantic_map, min_confidence=0.3):
+    def _component_table(self, mask, semantic_map, min_area):
+        """
+        Статистика связных компонент маски за один проход по пикселям.
+
+        bbox, площадь и центроид берутся из connectedComponentsWithStats, доминирующий
+        класс и уверенность - из одного bincount по парам (компонента, класс).
+        Компоненты меньше min_area в подсчет классов не попадают.
+        """
         num_labels, labels, stats, centroids = cv2.connectedComponentsWithStats(mask, connectivity=8)
         
-        objects_dict = {}
+        component_ids = np.nonzero(stats[:, cv2.CC_STAT_AREA] >= min_area)[0]
+        component_ids = component_ids[component_ids > 0]
         
-        for i in range(1, num_labels):
-            area = stats[i, cv2.CC_STAT_AREA]
-            
-            if area >= min_area:
-                component_mask = (labels == i).astype(np.uint8)
-                
-                component_pixels = semantic_map[component_mask > 0]
-                if len(component_pixels) > 0:
-                    unique_classes, counts = np.unique(component_pixels, return_counts=True)
-                    dominant_class = unique_classes[np.argmax(counts)]
-                    class_name = self.class_names.get(dominant_class, f"Class {dominant_class}")
-                    confidence = counts.max() / len(component_pixels)
-                    
-                    if confidence >= min_confidence:
-                        bbox, area, centroid = self._analyze_mask(component_mask)
-                        
-                        objects_dict[i] = {
-                            "mask": component_mask,
-                            "class_id": int(dominant_class),
-                            "class_name": class_name,
-                            "confidence": float(confidence),
-                            "bbox": bbox,
-                            "area": area,
-                            "centroid": centroid,
-                            "object_id": i,
-                            "type": object_type,
-                            "pixel_count": int(area)
-                        }
-                else:
-                    bbox, area, centroid = self._analyze_mask(component_mask)
-                    dominant_class = 1
-                    
-                    objects_dict[i] = {
-                        "mask": component_mask,
-                        "class_id": int(dominant_class),
-                        "class_name": object_type,
-                        "confidence": 1.0,
-                        "bbox": bbox,
-                        "area": area,
-                        "centroid": centroid,
-                        "object_id": i,
-                        "type": object_type,
-                        "pixel_count": int(area)
-                    }
+        num_classes = self.category_lut.size
+        if len(component_ids):
+            # Номера компонент сжимаются до 1..N, чтобы таблица пар не зависела от шума
+            compact_index = np.zeros(num_labels, dtype=np.int32)
+            compact_index[component_ids] = np.arange(1, len(component_ids) + 1, dtype=np.int32)
+            compact_labels = compact_index[labels]
+            selected = compact_labels > 0
+            pairs = compact_labels[selected].astype(np.int64) * num_classes + semantic_map[selected]
+            class_counts = np.bincount(pairs, minlength=(len(component_ids) + 1) * num_classes)
+            class_counts = class_counts.reshape(len(component_ids) + 1, num_classes)[1:]
+            dominant_class = class_counts.argmax(axis=1)
+            dominant_count = class_counts[np.arange(len(component_ids)), dominant_class]
+        else:
+            dominant_class = np.zeros(0, dtype=np.int64)
+            dominant_count = np.zeros(0, dtype=np.int64)
         
-        return objects_dict
+        areas = stats[component_ids, cv2.CC_STAT_AREA]
+        return {
+            "labels": labels,
+            "component_ids": component_ids,
+            "area": areas,
+            "left": stats[component_ids, cv2.CC_STAT_LEFT],
+            "top": stats[component_ids, cv2.CC_STAT_TOP],
+            "width": stats[component_ids, cv2.CC_STAT_WIDTH],
+            "height": stats[component_ids, cv2.CC_STAT_HEIGHT],
+            "centroid": centroids[component_ids],
+            "class_id": dominant_class,
+            "confidence": dominant_count / np.maximum(areas, 1)
+        }
     
-    def _analyze_mask(self, mask):
-        y_indices, x_indices = np.where(mask > 0)
-        if len(y_indices) == 0 or len(x_indices) == 0:
-            return [0, 0, 0, 0], 0, [0, 0]
-        x_min, x_max = np.min(x_indices), np.max(x_indices)
-        y_min, y_max = np.min(y_indices), np.max(y_indices)
-        area = len(y_indices)
-        centroid = [np.mean(x_indices), np.mean(y_indices)]
-        return [x_min, y_min, x_max, y_max], area, centroid
-
-def download_image(image_url):
-    """Загружает изображение по URL"""
-    try:
-        response = requests.get(image_url, timeout=30)
-        response.raise_for_status()
+    def _extract_components_soft(self, mask, min_area, object_type, semantic_map, min_confidence=0.3):
+        table = self._component_table(mask, semantic_map, min_area)
+        labels = table["labels"]
         
-        image = Image.open(io.BytesIO(response.content))
-        if image.mode != 'RGB':
-            image = image.convert('RGB')
+        objects_dict = {}
+        for k, i in enumerate(table["component_ids"]):
+            confidence = float(table["confidence"][k])
+            if confidence < min_confidence:
+                continue
             
-        return image
-    except Exception as e:
-        logger.error(f"Error downloading image {image_url}: {e}")
-        raise
+            i = int(i)
+            x_min, y_min = int(table["left"][k]), int(table["top"][k])
+            x_max = x_min + int(table["width"][k]) - 1
+            y_max = y_min + int(table["height"][k]) - 1
+            area = int(table["area"][k])
+            dominant_class = int(table["class_id"][k])
+            
+            # Маска компоненты хранится только в пределах bbox (ROI), а не на весь кадр
+            component_mask = (labels[y_min:y_max + 1, x_min:x_max + 1] == i).view(np.uint8)
+            
+            objects_dict[i] = {
+                "mask": component_mask,
+                "mask_origin": [x_min, y_min],
+                "class_id": dominant_class,
+                "class_name": self.class_names.get(dominant_class, f"Class {dominant_class}"),
+                "confidence": confidence,
+                "bbox": [x_min, y_min, x_max, y_max],
+                "area": area,
+                "centroid": [float(table["centroid"][k][0]), float(table["centroid"][k][1])],
+                "object_id": i,
+                "type": object_type,
+                "pixel_count": area
+            }
+        
+        return objects_dict
 
-def generate_offset_coordinates(lat, lon, offset=50):
-    """Генерирует случайные координаты в радиусе от указанной точки"""
-    if not lat and not lon: return None, None
-    lat, lon = float(lat), float(lon)
-    a, d = random.uniform(0, 2 * math.pi), random.uniform(0, offset ** 2) ** 0.5
-    return (lat + d * math.cos(a) / 111000, 
-            lon + d * math.sin(a) / (111000 * math.cos(math.radians(lat))))
-    
-def detect_objects(image_url, lat, lon, method, seed):
+def _estimate_model_bytes(segmentator):
+    """Оценивает объем памяти, занятый весами и буферами модели"""
+    if segmentator.onnx_path is not None:
+        return os.path.getsize(segmentator.onnx_path)
+    total = 0
+    for tensor in list(segmentator.model.parameters()) + list(segmentator.model.buffers()):
+        total += tensor.numel() * tensor.element_size()
+    return total
+
+class ModelRegistry:
     """
-    Выполняет реальную детекцию зданий используя семантическую сегментацию с разными моделями
-    
-    Args:
-        image_url: URL изображения
-        lat: широта съемки
-        lon: долгота съемки  
-        method: метод детекции (0 - автоподбор)
-        seed: seed для воспроизводимости
-    
-    Returns:
-        list: список обнаружений [id, method, bbox, confidence, lat, lon]
+    Реестр загруженных моделей на весь процесс.
+
+    Модели держатся в памяти по ключу method из _get_model_config(), при превышении
+    бюджета RAM выгружается модель, которая дольше всех не использовалась (LRU).
     """
-    try:
-        # Загружаем изображение
-        image = download_image(image_url)
-        
-        # Если method=0 - автоподбор лучшего алгоритма
-        if method == 0:
-            return _auto_select_best_model(image, lat, lon, seed)
-        
-        # Определяем модель на основе method
+
+    def __init__(self, cache_dir, ram_budget_bytes):
+        self.cache_dir = cache_dir
+        self.ram_budget_bytes = ram_budget_bytes
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._load_locks = {}
+        self.loads = 0
+        self.hits = 0
+        self.evictions = 0
+
+    def get(self, method):
+        """Возвращает сегментатор для method, загружая модель при необходимости"""
         model_config = _get_model_config(method)
-        used_method = model_config["method"]
-        model_name = model_config["model_name"]
-        
-        # Инициализируем сегментатор с выбранной моделью
-        cache_dir = "./model_cache"
-        os.makedirs(cache_dir, exist_ok=True)
-        
-        segmentator = AdvancedUrbanSegmentator(
-            model_name=model_name,
-            cache_dir=cache_dir
-        )
-        
-        # Выполняем реальную семантическую сегментацию
-        results = segmentator.semantic_segmentation_detailed(
-            image, 
-            min_area=500,
-            building_confidence=0.6
-        )
-        
-        # Преобразуем результаты в требуемый формат (ТОЛЬКО ЗДАНИЯ)
-        detections = _format_detections(results["buildings"], used_method, lat, lon, image.size)
-        
-        # Сохраняем маски для использования в отрисовке
-        results["detections"] = detections
-        results["image_size"] = image.size
-        
-        logger.info(f"Детекция моделью {model_name}: найдено {len(detections)} зданий")
-        return results
-        
-    except Exception as e:
-        logger.error(f"Ошибка детекции: {e}")
-        return {"buildings": {}, "detections": [], "road_mask": None, "other_mask": None}
+        key = model_config["method"]
 
-def _auto_select_best_model(image, lat, lon, seed):
-    """Запускает все модели и выбирает ту, которая нашла больше всего зданий"""
-    logger.info("Автоподбор модели: запуск всех моделей...")
-    
-    cache_dir = "./model_cache"
-    os.makedirs(cache_dir, exist_ok=True)
-    
-    models_to_test = [1, 2, 3, 4, 5]
-    best_results = None
-    best_model_method = 1
-    best_model_name = "shi-labs/oneformer_ade20k_swin_tiny"
-    max_buildings = 0
-    
-    for model_method in models_to_test:
-        try:
-            model_config = _get_model_config(model_method)
-            model_name = model_config["model_name"]
-            
-            logger.info(f"Тестируем модель {model_method}: {model_name}")
-            
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                entry["last_used"] = time.time()
+                entry["uses"] += 1
+                self.hits += 1
+                return entry["segmentator"]
+            load_lock = self._load_locks.setdefault(key, threading.Lock())
+
+        # Загрузка идет вне общего замка, чтобы не блокировать уже загруженные модели;
+        # отдельный замок на method не дает двум запросам грузить одну модель параллельно
+        with load_lock:
+            with self._lock:
+                entry = self._entries.get(key)
+                if entry is not None:
+                    self._entries.move_to_end(key)
+                    entry["last_used"] = time.time()
+                    entry["uses"] += 1
+                    self.hits += 1
+                    return entry["segmentator"]
+
+            os.makedirs(self.cache_dir, exist_ok=True)
+            started = time.time()
             segmentator = AdvancedUrbanSegmentator(
-                model_name=model_name,
-                cache_dir=cache_dir
-            )
-            
-            results = segmentator.semantic_segmentation_detailed(
-                image, 
-                min_area=500,
-                building_confidence=0.6
+                model_name=model_config["model_name"],
+                cache_dir=self.cache_dir,
+                backend=model_config["backend"]
             )
-            
-            buildings_count = len(results["buildings"])
-            logger.info(f"  Модель {model_method} нашла {buildings_count} зданий")
-            
-            if buildings_count > max_buildings:
-                max_buildings = buildings_count
-                best_model_method = model_method
-                best_model_name = model_name
-                best_results = results
-                best_results["detections"] = _format_detections(
-                    results["buildings"], model_method, lat, lon, image.size
+            if segmentator.model is not None:
+                segmentator.model.eval()
+            size_bytes = _estimate_model_bytes(segmentator)
+            logger.info(f"Модель {key} ({model_config['model_name']}) загружена за "
+                        f"{time.time() - started:.1f} с, {size_bytes / 2**20:.0f} МБ")
+
+            with self._lock:
+                self._entries[key] = {
+                    "segmentator": segmentator,
+                    "model_name": model_config["model_name"],
+                    "backend": segmentator.backend,
+                    "size_bytes": size_bytes,
+                    "loaded_at": time.time(),
+                    "last_used": time.time(),
+                    "uses": 1
+                }
+                self.loads += 1
+                self._evict_locked(keep=key)
+            return segmentator
+
+    def peek(self, method):
+        """Сегментатор для method, если модель уже загружена; None - без загрузки"""
+        with self._lock:
+            entry = self._entries.get(_get_model_config(method)["method"])
+            return entry["segmentator"] if entry is not None else None
+
+    def _evict_locked(self, keep):
+        """Выгружает LRU-модели, пока суммарный объем превышает бюджет"""
+        while self._total_bytes_locked() > self.ram_budget_bytes:
+            victim = next((k for k in self._entries if k != keep), None)
+            if victim is None:
+                break
+            entry = self._entries.pop(victim)
+            self.evictions += 1
+            logger.info(f"Модель {victim} ({entry['model_name']}) выгружена из памяти (LRU)")
+
+    def _total_bytes_locked(self):
+        return sum(entry["size_bytes"] for entry in self._entries.values())
+
+    def unload(self, method=None):
+        """Выгружает одну модель или все модели; возвращает число выгруженных"""
+        with self._lock:
+            if method is None:
+                count = len(self._entries)
+                self._entries.clear()
+                return count
+            key = _get_model_config(method)["method"]
+            return 1 if self._entries.pop(key, None) is not None else 0
+
+    def stats(self):
+        """Сводка по загруженным моделям и занимаемой памяти"""
+        with self._lock:
+            models = [
+                {
+                    "method": key,
+                    "model_name": entry["model_name"],
+                    "backend": entry["backend"],
+                    "size_mb": round(entry["size_bytes"] / 2**20, 1),
+                    "loaded_at": entry["loaded_at"],
+                    "last_used": entry["last_used"],
+                    "uses": entry["uses"]
+                }
+                for key, entry in self._entries.items()
+            ]
+            return {
+                "models": models,
+                "total_mb": round(self._total_bytes_locked() / 2**20, 1),
+                "budget_mb": round(self.ram_budget_bytes / 2**20, 1),
+                "loads": self.loads,
+                "hits": self.hits,
+                "evictions": self.evictions
+            }
+
+MODEL_REGISTRY = ModelRegistry(MODEL_CACHE_DIR, MODEL_RAM_BUDGET_MB * 1024 * 1024)
+
+class _PendingImage:
+    __slots__ = ("image", "bucket", "inputs", "future", "enqueued_at")
+
+    def __init__(self, image, bucket, inputs=None):
+        self.image = image
+        self.bucket = bucket
+        self.inputs = inputs
+        self.future = Future()
+        self.enqueued_at = time.monotonic()
+
+class InferenceScheduler:
+    """
+    Планировщик микробатчей для прямых проходов OneFormer.
+
+    Изображения для одного method копятся в очереди не дольше max_wait_ms и
+    группируются по размеру после ресайза (bucket), чтобы паддинг в батче был
+    минимальным. Батч из одной корзины прогоняется одним вызовом модели, а карты
+    классов раздаются ожидающим вызывающим потокам.
+    """
+
+    def __init__(self, registry, max_batch_size, max_wait_ms, bucket_px):
+        self.registry = registry
+        self.max_batch_size = max(1, max_batch_size)
+        self.max_wait = max(0.0, max_wait_ms) / 1000.0
+        self.bucket_px = max(1, bucket_px)
+        self._cond = threading.Condition()
+        # method -> {bucket -> deque ожидающих изображений в порядке поступления}
+        self._pending = {}
+        self._workers = {}
+        self.batches = 0
+        self.images = 0
+
+    def submit(self, method, image, pixel_inputs=None):
+        """
+        Ставит изображение в очередь; возвращает Future с картой классов.
+        pixel_inputs - уже готовые тензоры входа (общие для кандидатов автоподбора):
+        такое изображение идет отдельным прямым проходом без повторного препроцессинга
+        """
+        key = _get_model_config(method)["method"]
+        image = _to_rgb_image(image)
+        # Модель загружается в потоке вызывающего, чтобы ошибки загрузки не терялись
+        segmentator = self.registry.get(key)
+        if pixel_inputs is None:
+            height, width = segmentator.resized_shape(image.size)
+            bucket = (math.ceil(height / self.bucket_px), math.ceil(width / self.bucket_px))
+        else:
+            # Своя корзина: готовые тензоры не объединяются в батч с другими изображениями
+            bucket = object()
+        item = _PendingImage(image, bucket, pixel_inputs)
+
+        with self._cond:
+            self._pending.setdefault(key, {}).setdefault(bucket, deque()).append(item)
+            if key not in self._workers:
+                worker = threading.Thread(target=self._worker, args=(key,),
+                                          name=f"inference-{key}", daemon=True)
+                self._workers[key] = worker
+                worker.start()
+            self._cond.notify_all()
+        return item.future
+
+    def predict(self, method, image, pixel_inputs=None):
+        """Синхронная обертка над submit()"""
+        return self.submit(method, image, pixel_inputs).result()
+
+    def _worker(self, key):
+        while True:
+            batch = self._next_batch(key)
+            self._run_batch(key, batch)
+
+    def _next_batch(self, key):
+        with self._cond:
+            while True:
+                buckets = self._pending.get(key)
+                if not buckets:
+                    self._cond.wait()
+                    continue
+                # Корзину выбираем по самому старому запросу, чтобы никто не ждал дольше окна;
+                # голова очереди корзины - самый старый ее запрос
+                bucket, items = min(buckets.items(), key=lambda entry: entry[1][0].enqueued_at)
+                remaining = items[0].enqueued_at + self.max_wait - time.monotonic()
+                if len(items) >= self.max_batch_size or remaining <= 0 or items[0].inputs is not None:
+                    batch = [items.popleft() for _ in range(min(len(items), self.max_batch_size))]
+                    if not items:
+                        del buckets[bucket]
+                    return batch
+                self._cond.wait(remaining)
+
+    def _run_batch(self, key, batch):
+        batch = [item for item in batch if item.future.set_running_or_notify_cancel()]
+        if not batch:
+            return
+        try:
+            segmentator = self.registry.get(key)
+            if batch[0].inputs is not None:
+                semantic_maps = segmentator.forward_semantic_maps(
+                    batch[0].inputs, [_source_size(batch[0].image)[::-1]]
                 )
-                best_results["image_size"] = image.size
-                
+            else:
+                semantic_maps = segmentator.predict_semantic_maps([item.image for item in batch])
         except Exception as e:
-            logger.error(f"  Ошибка в модели {model_method}: {e}")
+            logger.error(f"Ошибка батча модели {key} ({len(batch)} изобр.): {e}")
+            for item in batch:
+                item.future.set_exception(e)
+            return
+
+        with self._cond:
+            self.batches += 1
+            self.images += len(batch)
+        for item, semantic_map in zip(batch, semantic_maps):
+            item.future.set_result(semantic_map)
+
+    def stats(self):
+        with self._cond:
+            return {
+                "max_batch_size": self.max_batch_size,
+                "max_wait_ms": self.max_wait * 1000.0,
+                "bucket_px": self.bucket_px,
+                "pending": {key: sum(len(items) for items in buckets.values())
+                            for key, buckets in self._pending.items()},
+                "batches": self.batches,
+                "images": self.images,
+                "mean_batch_size": round(self.images / self.batches, 2) if self.batches else 0.0
+            }
+
+INFERENCE_SCHEDULER = InferenceScheduler(
+    MODEL_REGISTRY, INFERENCE_MAX_BATCH_SIZE, INFERENCE_MAX_WAIT_MS, INFERENCE_BUCKET_PX
+)
+
+class InferenceQueueFull(Exception):
+    """Очередь пула инференса заполнена; retry_after - через сколько секунд повторить"""
+
+    def __init__(self, retry_after):
+        super().__init__(f"Inference queue is full, retry after {retry_after} s")
+        self.retry_after = retry_after
+
+def _inference_worker_main(worker_index, tasks_conn, results_conn, num_threads, interop_threads, cpus, consumers):
+    """
+    Точка входа процесса-воркера: свои модели, свой планировщик микробатчей.
+    Задачи приходят по своему каналу и разбираются consumers потоками, чтобы
+    планировщик мог собирать батчи; по тому же каналу идут команды статистики и выгрузки.
+    """
+    if cpus:
+        os.sched_setaffinity(0, cpus)
+    torch.set_num_threads(num_threads)
+    torch.set_num_interop_threads(interop_threads)
+    logger.info(f"Воркер инференса {worker_index} (pid {os.getpid()}): {num_threads} потоков torch, "
+                f"ядра {sorted(cpus) if cpus else 'все'}")
+
+    local_tasks = queue.Queue()
+    send_lock = threading.Lock()
+
+    def send(message):
+        with send_lock:
+            results_conn.send(message)
+
+    def consume():
+        while True:
+            task_id, (content, lat, lon, method, seed, auto_policy, admission) = local_tasks.get()
+            send(("started", task_id, None))
+            try:
+                results, error = _detect_in_content(content, lat, lon, method, seed, auto_policy, admission), None
+            except Exception as e:
+                results, error = None, str(e)
+            send(("done", task_id, (results, error)))
+
+    for i in range(max(1, consumers)):
+        threading.Thread(target=consume, name=f"inference-consumer-{i}", daemon=True).start()
+
+    while True:
+        try:
+            kind, task_id, payload = tasks_conn.recv()
+        except EOFError:
+            # Родительский процесс завершился
+            return
+        if kind == "task":
+            local_tasks.put((task_id, payload))
             continue
-    
-    logger.info(f"Выбрана модель {best_model_method} ({best_model_name}): {max_buildings} зданий")
-    return best_results if best_results else {"buildings": {}, "detections": [], "road_mask": None, "other_mask": None}
+        action, argument = payload
+        try:
+            if action == "unload":
+                reply = {"unloaded": MODEL_REGISTRY.unload(argument), **MODEL_REGISTRY.stats()}
+            else:
+                reply = {**MODEL_REGISTRY.stats(), "scheduler": INFERENCE_SCHEDULER.stats()}
+        except Exception as e:
+            reply = {"error": str(e)}
+        send(("control", task_id, reply))
 
-def _format_detections(buildings_dict, method, lat, lon, image_size):
-    """Форматирует обнаружения зданий в требуемый формат"""
-    detections = []
-    
-    for obj_id, building in buildings_dict.items():
-        bbox_dict = _convert_bbox_format(building["bbox"])
-        obj_lat, obj_lon = _calculate_object_coordinates(
-            lat, lon, building["centroid"], image_size, building["area"]
-        )
-        
-        detection = [
-            f'id{obj_id}',
-            method,
-            bbox_dict,
-            round(building["confidence"], 3),
-            obj_lat,
-            obj_lon
+class InferencePool:
+    """
+    Пул процессов инференса за ограниченной очередью.
+
+    Каждый воркер - отдельный процесс (spawn) со своими моделями, своим числом потоков
+    torch и, при необходимости, привязкой к своему набору ядер. Задача (байты изображения
+    и параметры детекции) уходит наименее загруженному воркеру по его собственному каналу,
+    поэтому падение одного воркера не блокирует остальных: его начатые задачи завершаются
+    ошибкой, не начатые переотправляются. Если в работе и в очереди уже queue_max
+    изображений, submit() без ожидания бросает InferenceQueueFull.
+    """
+
+    def __init__(self, workers, threads_per_worker, interop_threads, pin_cpus, queue_max, consumers):
+        self.workers = max(1, workers)
+        cpus = sorted(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else list(range(os.cpu_count() or 1))
+        self.threads_per_worker = threads_per_worker if threads_per_worker > 0 else max(1, len(cpus) // self.workers)
+        self.interop_threads = max(1, interop_threads)
+        self.queue_max = max(1, queue_max)
+        self.consumers = consumers
+        self._cpu_sets = [
+            {cpus[(i * self.threads_per_worker + j) % len(cpus)] for j in range(self.threads_per_worker)}
+            if pin_cpus else None
+            for i in range(self.workers)
         ]
-        detections.append(detection)
-    
-    return detections
+        self._ctx = None
+        self._workers = []
+        self._cond = threading.Condition()
+        self._tasks = {}
+        self._control_replies = {}
+        self._next_id = 0
+        self.completed = 0
+        self.failed = 0
+        self.rejected = 0
+        self.restarts = 0
+        self._mean_task_sec = None
+        self._started_at = None
 
-def _get_model_config(method):
-    """Возвращает конфигурацию модели на основе method"""
-    models = {
-        1: {"method": 1, "model_name": "shi-labs/oneformer_ade20k_swin_tiny", "description": "Tiny модель"},
-        2: {"method": 2, "model_name": "shi-labs/oneformer_ade20k_swin_base", "description": "Small модель"},
-        3: {"method": 3, "model_name": "shi-labs/oneformer_coco_swin_large", "description": "COCO модель"},
-        4: {"method": 4, "model_name": "shi-labs/oneformer_ade20k_swin_large", "description": "ADE20K модель"},
-        5: {"method": 5, "model_name": "shi-labs/oneformer_cityscapes_swin_large", "description": "Cityscapes модель"}
-    }
-    
-    return models.get(method, models[1])
+    def start(self):
+        self._ctx = multiprocessing.get_context("spawn")
+        self._started_at = time.monotonic()
+        for worker_index in range(self.workers):
+            self._workers.append({"busy_sec": 0.0, "tasks": 0})
+            self._spawn(worker_index)
+        threading.Thread(target=self._collect, name="inference-pool-collector", daemon=True).start()
+        logger.info(f"Пул инференса: {self.workers} воркеров по {self.threads_per_worker} потоков torch, "
+                    f"очередь до {self.queue_max} изображений")
 
-def _convert_bbox_format(bbox):
-    """Конвертирует bbox из [x_min, y_min, x_max, y_max] в {x, y, w, h}"""
-    x_min, y_min, x_max, y_max = bbox
-    return {
-        'x': int(x_min),
-        'y': int(y_min), 
-        'w': int(x_max - x_min),
-        'h': int(y_max - y_min)
-    }
+    def _spawn(self, worker_index):
+        tasks_recv, tasks_send = self._ctx.Pipe(duplex=False)
+        results_recv, results_send = self._ctx.Pipe(duplex=False)
+        process = self._ctx.Process(
+            target=_inference_worker_main,
+            args=(worker_index, tasks_recv, results_send, self.threads_per_worker,
+                  self.interop_threads, self._cpu_sets[worker_index], self.consumers),
+            name=f"inference-worker-{worker_index}",
+            daemon=True
+        )
+        process.start()
+        tasks_recv.close()
+        results_send.close()
+        self._workers[worker_index].update(
+            process=process, send=tasks_send, recv=results_recv, send_lock=threading.Lock(),
+            assigned=0, active=0, busy_since=None
+        )
+
+    def _send(self, worker, message):
+        try:
+            with worker["send_lock"]:
+                worker["send"].send(message)
+        except OSError:
+            # Воркер упал: сборщик заметит это и переотправит задачу
+            pass
+
+    def retry_after(self):
+        """Оценка времени до освобождения места в очереди (секунды для Retry-After)"""
+        with self._cond:
+            if not self._mean_task_sec:
+                return RETRY_AFTER_SEC
+            slots = self.workers * max(1, self.consumers)
+            return int(min(60, max(1, math.ceil(len(self._tasks) * self._mean_task_sec / slots))))
+
+    def full(self):
+        with self._cond:
+            return len(self._tasks) >= self.queue_max
+
+    def submit(self, content, lat, lon, method, seed, auto_policy, admission, block=False):
+        """Ставит изображение в очередь; возвращает Future с (результатом, ошибкой)"""
+        future = Future()
+        with self._cond:
+            while block and len(self._tasks) >= self.queue_max:
+                self._cond.wait()
+            if len(self._tasks) >= self.queue_max:
+                self.rejected += 1
+                full = True
+            else:
+                full = False
+                task_id = self._next_id
+                self._next_id += 1
+                worker = min(self._workers, key=lambda w: w["assigned"])
+                worker["assigned"] += 1
+                payload = (content, lat, lon, method, seed, auto_policy, admission)
+                self._tasks[task_id] = {"future": future, "worker": worker, "payload": payload, "started": None}
+        if full:
+            raise InferenceQueueFull(self.retry_after())
+        self._send(worker, ("task", task_id, payload))
+        return future
+
+    def detect(self, content, lat, lon, method, seed, auto_policy, admission, block=False):
+        results, error = self.submit(content, lat, lon, method, seed, auto_policy, admission, block).result()
+        if error is not None:
+            raise RuntimeError(error)
+        return results
+
+    def _collect(self):
+        while True:
+            with self._cond:
+                channels = {}
+                for worker_index, worker in enumerate(self._workers):
+                    channels[worker["recv"]] = (worker_index, worker["process"])
+                    channels[worker["process"].sentinel] = (worker_index, worker["process"])
+            for ready in multiprocessing.connection.wait(list(channels), timeout=1.0):
+                worker_index, process = channels[ready]
+                if ready is process.sentinel:
+                    self._restart(worker_index, process)
+                    continue
+                try:
+                    message = ready.recv()
+                except (EOFError, OSError):
+                    self._restart(worker_index, process)
+                    continue
+                self._handle(worker_index, message)
+
+    def _handle(self, worker_index, message):
+        kind, task_id, payload = message
+        now = time.monotonic()
+        future = None
+        with self._cond:
+            worker = self._workers[worker_index]
+            if kind == "control":
+                reply = self._control_replies.get(task_id)
+                if reply is not None:
+                    reply[worker_index] = payload
+                    self._cond.notify_all()
+                return
+            task = self._tasks.get(task_id)
+            if task is None:
+                return
+            if kind == "started":
+                task["started"] = now
+                if worker["active"] == 0:
+                    worker["busy_since"] = now
+                worker["active"] += 1
+                return
+
+            # done
+            del self._tasks[task_id]
+            future = task["future"]
+            worker["assigned"] -= 1
+            worker["tasks"] += 1
+            if task["started"] is not None:
+                worker["active"] -= 1
+                if worker["active"] == 0:
+                    worker["busy_sec"] += now - worker["busy_since"]
+                    worker["busy_since"] = None
+                elapsed = now - task["started"]
+                self._mean_task_sec = elapsed if self._mean_task_sec is None else 0.9 * self._mean_task_sec + 0.1 * elapsed
+            if payload[1] is None:
+                self.completed += 1
+            else:
+                self.failed += 1
+            self._cond.notify_all()
+        future.set_result(payload)
+
+    def _restart(self, worker_index, process):
+        """Перезапускает упавший воркер: начатые задачи - с ошибкой, остальные - другим воркерам"""
+        worker = self._workers[worker_index]
+        if worker["process"] is not process:
+            return
+        # Забираем то, что воркер успел отправить до падения
+        try:
+            while worker["recv"].poll():
+                self._handle(worker_index, worker["recv"].recv())
+        except (EOFError, OSError):
+            pass
+        process.join(timeout=1.0)
+        logger.error(f"Воркер инференса {worker_index} (pid {process.pid}) завершился "
+                     f"с кодом {process.exitcode}, перезапуск")
+        worker["recv"].close()
+        worker["send"].close()
+
+        with self._cond:
+            if worker["busy_since"] is not None:
+                worker["busy_sec"] += time.monotonic() - worker["busy_since"]
+            self._spawn(worker_index)
+            self.restarts += 1
+            lost, resend = [], []
+            for task_id, task in list(self._tasks.items()):
+                if task["worker"] is not worker:
+                    continue
+                if task["started"] is not None:
+                    del self._tasks[task_id]
+                    lost.append(task["future"])
+                else:
+                    target = min(self._workers, key=lambda w: w["assigned"])
+                    target["assigned"] += 1
+                    task["worker"] = target
+                    resend.append((target, ("task", task_id, task["payload"])))
+            self.failed += len(lost)
+            self._cond.notify_all()
+        for future in lost:
+            future.set_result((None, f"Inference worker {worker_index} crashed"))
+        for target, message in resend:
+            self._send(target, message)
+
+    def control(self, action, argument=None, timeout=10.0):
+        """Отправляет команду всем воркерам и собирает ответы (по индексу воркера)"""
+        with self._cond:
+            request_id = f"control-{self._next_id}"
+            self._next_id += 1
+            replies = self._control_replies[request_id] = {}
+            workers = list(self._workers)
+        for worker in workers:
+            self._send(worker, ("control", request_id, (action, argument)))
+        with self._cond:
+            self._cond.wait_for(lambda: len(replies) >= self.workers, timeout)
+            self._control_replies.pop(request_id, None)
+            return [replies.get(i) for i in range(self.workers)]
+
+    def stats(self):
+        now = time.monotonic()
+        with self._cond:
+            uptime = now - self._started_at if self._started_at else 0.0
+            workers = []
+            for worker_index, worker in enumerate(self._workers):
+                busy_sec = worker["busy_sec"] + (now - worker["busy_since"] if worker["busy_since"] else 0.0)
+                cpus = self._cpu_sets[worker_index]
+                workers.append({
+                    "worker": worker_index,
+                    "pid": worker["process"].pid,
+                    "alive": worker["process"].is_alive(),
+                    "assigned": worker["assigned"],
+                    "active": worker["active"],
+                    "tasks": worker["tasks"],
+                    "utilisation": round(busy_sec / uptime, 3) if uptime > 0 else 0.0,
+                    "cpus": sorted(cpus) if cpus else None
+                })
+            in_flight = sum(1 for task in self._tasks.values() if task["started"] is not None)
+            return {
+                "workers": workers,
+                "threads_per_worker": self.threads_per_worker,
+                "interop_threads": self.interop_threads,
+                "queue_max": self.queue_max,
+                "queue_depth": len(self._tasks) - in_flight,
+                "in_flight": in_flight,
+                "completed": self.completed,
+                "failed": self.failed,
+                "rejected": self.rejected,
+                "restarts": self.restarts,
+                "mean_task_sec": round(self._mean_task_sec, 3) if self._mean_task_sec else None
+            }
+
+# Пул создается и запускается в __main__: процессы-воркеры импортируют этот модуль заново
+INFERENCE_POOL = None
+
+def _decode_image(content):
+    """Декодирует байты изображения в PIL RGB"""
+    image = Image.open(io.BytesIO(content))
+    image.load()
+    if image.mode != 'RGB':
+        image = image.convert('RGB')
+    return image
+
+def _source_size(image):
+    """Размер исходного изображения (до уменьшенного декодирования) - в этой геометрии результаты"""
+    return image.info.get("source_size", image.size)
+
+def _inference_input_shape(method, auto_policy, image_size):
+    """
+    Наибольший размер входа (h, w) среди моделей, которые будут запущены на изображении;
+    None, если для автоподбора загружены еще не все модели-кандидаты
+    """
+    if method == 0:
+        policy = AUTO_POLICIES[auto_policy or AUTO_POLICY]
+        segmentators = [MODEL_REGISTRY.peek(m) for m in sorted({m for stage in policy["stages"] for m in stage})]
+        if None in segmentators:
+            return None
+    else:
+        segmentators = [MODEL_REGISTRY.get(method)]
+    shapes = [segmentator.resized_shape(image_size) for segmentator in segmentators]
+    return max(h for h, _ in shapes), max(w for _, w in shapes)
+
+def _decode_for_inference(content, method, auto_policy=None, working_size=None):
+    """
+    Декодирует изображение для инференса. JPEG декодируется сразу в уменьшенном масштабе
+    (draft-режим, масштабирование DCT на 1/2, 1/4 или 1/8), но не меньше входа модели:
+    процессор все равно уменьшил бы его до своего размера. Исходный размер сохраняется
+    в info["source_size"], карта классов и координаты строятся в геометрии оригинала.
+    Изображения для тайлового инференса декодируются целиком.
+
+    working_size - геометрия анализа меньше исходной (решение бюджета памяти): изображение
+    приводится ровно к этому размеру, и вся обработка идет в нем.
+    """
+    if working_size is not None:
+        image = Image.open(io.BytesIO(content))
+        if image.format == "JPEG":
+            image.draft('RGB', working_size)
+        image.load()
+        if image.mode != 'RGB':
+            image = image.convert('RGB')
+        return image if image.size == working_size else image.resize(working_size, Image.BILINEAR)
+    if not REDUCED_DECODE:
+        return _decode_image(content)
+    image = Image.open(io.BytesIO(content))
+    source_size = image.size
+    if image.format == "JPEG" and not _use_tiling(source_size):
+        input_shape = _inference_input_shape(method, auto_policy, source_size)
+        if input_shape is not None:
+            image.draft('RGB', (input_shape[1], input_shape[0]))
+    image.load()
+    if image.mode != 'RGB':
+        image = image.convert('RGB')
+    if image.size != source_size:
+        image.info["source_size"] = source_size
+    return image
+
+class UploadResolver:
+    """
+    Изображения photo-service на общем томе загрузок.
+
+    Вход задается image_url, photo_uuid и/или path (имя файла относительно UPLOAD_DIR).
+    Канонический ключ изображения - URL photo-service (PHOTO_SERVICE_URL/photos/<uuid>),
+    по нему же идет откат на HTTP, если файла на томе нет. Изображение, заданное только
+    путем, получает ключ upload://<path>. Переданные пути запоминаются (LRU), чтобы
+    ленивые превью и повторные запросы по тому же URL тоже читались с диска.
+    """
+
+    UPLOAD_SCHEME = "upload://"
+    # Расширения, с которыми photo-service сохраняет файлы под именем <uuid><ext>
+    UUID_EXTS = (".jpg", ".jpeg", ".png", ".webp", ".bmp", ".gif", ".tif", ".tiff")
+
+    def __init__(self, root, photo_url, max_hints=100000):
+        self.root = os.path.realpath(root) if root else None
+        self.photo_prefix = f"{photo_url.rstrip('/')}/photos/"
+        self.max_hints = max_hints
+        self._hints = OrderedDict()
+        self._lock = threading.Lock()
+        self.local_reads = 0
+        self.http_fallbacks = 0
+
+    def _safe_path(self, path):
+        """Абсолютный путь файла внутри UPLOAD_DIR; выход за пределы каталога - ValueError"""
+        if self.root is None:
+            raise ValueError("path input requires UPLOAD_DIR")
+        full = os.path.realpath(os.path.join(self.root, str(path).lstrip("/")))
+        if not full.startswith(self.root + os.sep):
+            raise ValueError(f"path is outside of UPLOAD_DIR: {path}")
+        return full
+
+    def image_url(self, data):
+        """Канонический URL изображения из полей image_url / photo_uuid / path (None - не заданы)"""
+        path = data.get('path')
+        if data.get('image_url'):
+            image_url = data['image_url']
+        elif data.get('photo_uuid'):
+            try:
+                image_url = f"{self.photo_prefix}{uuid.UUID(str(data['photo_uuid']))}"
+            except ValueError:
+                raise ValueError(f"invalid photo_uuid: {data['photo_uuid']}")
+        elif path:
+            self._safe_path(path)
+            return f"{self.UPLOAD_SCHEME}{str(path).lstrip('/')}"
+        else:
+            return None
+        # Рядом с image_url / photo_uuid path - только подсказка: без тома или за его пределами не учитывается
+        if path and self.root is not None:
+            try:
+                self._safe_path(path)
+            except ValueError:
+                return image_url
+            with self._lock:
+                self._hints[image_url] = path
+                self._hints.move_to_end(image_url)
+                while len(self._hints) > self.max_hints:
+                    self._hints.popitem(last=False)
+        return image_url
+
+    def local_path(self, image_url):
+        """Путь к файлу на томе загрузок или None, если изображение надо загружать по HTTP"""
+        if image_url.startswith(self.UPLOAD_SCHEME):
+            return self._safe_path(image_url[len(self.UPLOAD_SCHEME):])
+        if self.root is None:
+            return None
+        with self._lock:
+            path = self._hints.get(image_url)
+        if path is not None:
+            full = self._safe_path(path)
+            if os.path.isfile(full):
+                return full
+        if image_url.startswith(self.photo_prefix):
+            try:
+                photo_uuid = str(uuid.UUID(image_url[len(self.photo_prefix):]))
+            except ValueError:
+                return None
+            for ext in self.UUID_EXTS:
+                full = os.path.join(self.root, photo_uuid + ext)
+                if os.path.isfile(full):
+                    return full
+        return None
+
+    def note_http(self, image_url):
+        """Учитывает загрузку по HTTP изображения photo-service, которого нет на томе"""
+        if self.root is None:
+            return
+        with self._lock:
+            if image_url.startswith(self.photo_prefix) or image_url in self._hints:
+                self.http_fallbacks += 1
+
+    def read(self, path):
+        """Читает файл с тома целиком (одно чтение, без запроса к photo-service)"""
+        with open(path, "rb") as f:
+            content = f.read()
+        with self._lock:
+            self.local_reads += 1
+        return content
+
+    def stats(self):
+        with self._lock:
+            return {
+                "upload_dir": self.root,
+                "known_paths": len(self._hints),
+                "local_reads": self.local_reads,
+                "http_fallbacks": self.http_fallbacks
+            }
+
+UPLOADS = UploadResolver(UPLOAD_DIR, PHOTO_SERVICE_URL)
+
+class ImageFetchCache:
+    """
+    Кэш загруженных изображений по URL с бюджетом в байтах и LRU-вытеснением.
+
+    Хранит исходные байты и (опционально) декодированное RGB-изображение. Запись
+    считается свежей fresh_sec секунд, после этого перепроверяется условным
+    запросом (If-None-Match / If-Modified-Since): на 304 байты берутся из кэша.
+    Изображения, найденные resolver на томе загрузок, читаются с диска и
+    перепроверяются по mtime и размеру файла при каждом обращении. Изображения из
+    тела запроса удерживаются под ключом inline://<sha256> до конца его обработки.
+    """
+
+    INLINE_SCHEME = "inline://"
+
+    def __init__(self, max_bytes, fresh_sec, keep_decoded, pool_size, per_host_limit, resolver=None):
+        self.max_bytes = max_bytes
+        self.resolver = resolver
+        self.fresh_sec = fresh_sec
+        self.keep_decoded = keep_decoded
+        self.per_host_limit = max(1, per_host_limit)
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        # Одна сессия с пулом keep-alive соединений на весь процесс
+        self._session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self._session.mount("http://", adapter)
+        self._session.mount("https://", adapter)
+        self._host_slots = {}
+        self._inline = {}
+        # Суммарный объем записей (байты + декодированные изображения), меняется вместе с _entries
+        self._bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.revalidated = 0
+        self.evictions = 0
+
+    def _lookup(self, image_url):
+        """Возвращает свежую запись кэша или None; устаревшую запись - вторым значением"""
+        with self._lock:
+            entry = self._entries.get(image_url)
+            if entry is None:
+                return None, None
+            if time.monotonic() - entry["checked_at"] < self.fresh_sec:
+                self._entries.move_to_end(image_url)
+                self.hits += 1
+                return entry, None
+            return None, entry
+
+    def hold_inline(self, content):
+        """Удерживает байты изображения из тела запроса, пока его не отпустят; возвращает ключ"""
+        key = f"{self.INLINE_SCHEME}{hashlib.sha256(content).hexdigest()}"
+        with self._lock:
+            held = self._inline.get(key)
+            self._inline[key] = (content, held[1] + 1 if held is not None else 1)
+        return key
+
+    def release_inline(self, key):
+        with self._lock:
+            content, holders = self._inline[key]
+            if holders > 1:
+                self._inline[key] = (content, holders - 1)
+            else:
+                del self._inline[key]
+
+    def _fetch_inline(self, image_url):
+        """Изображение из тела запроса: ключ по содержимому, перепроверка не нужна"""
+        with self._lock:
+            entry = self._entries.get(image_url)
+            if entry is not None:
+                self._entries.move_to_end(image_url)
+                self.hits += 1
+                return entry
+            held = self._inline.get(image_url)
+        if held is None:
+            raise KeyError(f"{image_url} is no longer available")
+        return self._store(image_url, held[0], None, None)
+
+    def _fetch(self, image_url):
+        if image_url.startswith(self.INLINE_SCHEME):
+            return self._fetch_inline(image_url)
+        local_path = self.resolver.local_path(image_url) if self.resolver is not None else None
+        if local_path is not None:
+            return self._fetch_local(image_url, local_path)
+
+        entry, stale = self._lookup(image_url)
+        if entry is not None:
+            return entry
+
+        headers = {}
+        if stale is not None:
+            if stale["etag"]:
+                headers["If-None-Match"] = stale["etag"]
+            if stale["last_modified"]:
+                headers["If-Modified-Since"] = stale["last_modified"]
+
+        if self.resolver is not None:
+            self.resolver.note_http(image_url)
+        with self._host_slot(image_url):
+            response = self._session.get(image_url, headers=headers, timeout=30)
+        if stale is not None and response.status_code == 304:
+            with self._lock:
+                stale["checked_at"] = time.monotonic()
+                self.revalidated += 1
+                if image_url in self._entries:
+                    self._entries.move_to_end(image_url)
+            return stale
+        response.raise_for_status()
+
+        return self._store(image_url, response.content, response.headers.get("ETag"),
+                           response.headers.get("Last-Modified"))
+
+    def _fetch_local(self, image_url, path):
+        """Файл с тома загрузок: запись кэша действительна, пока не изменились mtime и размер"""
+        stat = os.stat(path)
+        version = f"local:{stat.st_mtime_ns}:{stat.st_size}"
+        with self._lock:
+            entry = self._entries.get(image_url)
+            if entry is not None and entry["etag"] == version:
+                self._entries.move_to_end(image_url)
+                self.hits += 1
+                return entry
+        return self._store(image_url, self.resolver.read(path), version, None)
+
+    def _store(self, image_url, content, etag, last_modified):
+        entry = {
+            "content": content,
+            "etag": etag,
+            "last_modified": last_modified,
+            "checked_at": time.monotonic(),
+            "image": None,
+            "nbytes": len(content)
+        }
+        with self._lock:
+            self.misses += 1
+            replaced = self._entries.pop(image_url, None)
+            if replaced is not None:
+                self._bytes -= replaced["nbytes"]
+            if entry["nbytes"] <= self.max_bytes:
+                self._entries[image_url] = entry
+                self._bytes += entry["nbytes"]
+                self._evict_locked()
+        return entry
+
+    def _host_slot(self, image_url):
+        """Семафор хоста: не больше per_host_limit одновременных загрузок с одного хоста"""
+        host = urlsplit(image_url).netloc
+        with self._lock:
+            slot = self._host_slots.get(host)
+            if slot is None:
+                slot = self._host_slots[host] = threading.BoundedSemaphore(self.per_host_limit)
+            return slot
+
+    def _evict_locked(self):
+        while self._entries and self._bytes > self.max_bytes:
+            _, entry = self._entries.popitem(last=False)
+            self._bytes -= entry["nbytes"]
+            self.evictions += 1
+
+    def get_bytes(self, image_url):
+        """Исходные (закодированные) байты изображения"""
+        return self._fetch(image_url)["content"]
+
+    def get_image(self, image_url):
+        """Декодированное RGB-изображение; возвращается копия, которую можно изменять"""
+        entry = self._fetch(image_url)
+        image = entry["image"]
+        if image is None:
+            image = _decode_image(entry["content"])
+            if self.keep_decoded:
+                with self._lock:
+                    if self._entries.get(image_url) is entry and entry["image"] is None:
+                        entry["image"] = image
+                        entry["nbytes"] += image.width * image.height * 3
+                        self._bytes += image.width * image.height * 3
+                        self._evict_locked()
+        return image.copy()
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.revalidated + self.misses
+            return {
+                "entries": len(self._entries),
+                "bytes_mb": round(self._bytes / 2**20, 1),
+                "budget_mb": round(self.max_bytes / 2**20, 1),
+                "hits": self.hits,
+                "revalidated": self.revalidated,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "inline_held": len(self._inline),
+                "hit_rate": round((self.hits + self.revalidated) / lookups, 3) if lookups else 0.0
+            }
+
+IMAGE_CACHE = ImageFetchCache(
+    IMAGE_CACHE_MAX_MB * 1024 * 1024, IMAGE_CACHE_FRESH_SEC, IMAGE_CACHE_DECODED,
+    FETCH_POOL_SIZE, FETCH_PER_HOST_LIMIT, UPLOADS
+)
+
+def _evict_lru_files(root, suffix, max_bytes):
+    """
+    Удаляет из каталога файлы с суффиксом suffix, к которым дольше всего не обращались
+    (по mtime), пока их объем больше max_bytes; возвращает (оставшийся объем, удалено файлов)
+    """
+    entries = []
+    for entry in os.scandir(root):
+        if entry.name.endswith(suffix):
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+    entries.sort()
+    total = sum(size for _, size, _ in entries)
+    evicted = 0
+    for _, size, path in entries:
+        if total <= max_bytes:
+            break
+        try:
+            os.remove(path)
+            evicted += 1
+        except FileNotFoundError:
+            pass
+        total -= size
+    return total, evicted
+
+class ResultCache:
+    """
+    Дисковый кэш результатов детекции (здания, маски, label_map_id) по ключу из хэша
+    содержимого изображения, метода, параметров постобработки и ревизии модели.
+
+    Запись - сжатый pickle в отдельном файле, запись атомарная (общий каталог
+    безопасен для нескольких процессов). При превышении max_bytes удаляются записи,
+    к которым дольше всего не обращались (mtime обновляется при попадании).
+    """
+
+    def __init__(self, root, max_bytes):
+        self.root = root
+        self.max_bytes = max_bytes
+        os.makedirs(root, exist_ok=True)
+        self._lock = threading.Lock()
+        self._bytes = sum(entry.stat().st_size for entry in os.scandir(root) if entry.name.endswith(".pkl.z"))
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+        self.evictions = 0
+
+    def _path(self, key):
+        return os.path.join(self.root, f"{key}.pkl.z")
+
+    def get(self, key):
+        """Сохраненный результат или None"""
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as f:
+                results = pickle.loads(zlib.decompress(f.read()))
+            os.utime(path)
+        except (FileNotFoundError, zlib.error, pickle.UnpicklingError, EOFError):
+            with self._lock:
+                self.misses += 1
+            return None
+        with self._lock:
+            self.hits += 1
+        return results
+
+    def put(self, key, results):
+        # Координаты объектов и замер памяти относятся к конкретному запросу,
+        # карта классов хранится отдельно в LABEL_MAPS (здесь - только ее label_map_id)
+        results = {k: v for k, v in results.items() if k not in ("detections", "memory", "semantic_map")}
+        content = zlib.compress(pickle.dumps(results, protocol=pickle.HIGHEST_PROTOCOL), 1)
+        path = self._path(key)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(content)
+        try:
+            replaced = os.path.getsize(path)
+        except FileNotFoundError:
+            replaced = 0
+        os.replace(tmp_path, path)
+        with self._lock:
+            self.stores += 1
+            self._bytes += len(content) - replaced
+            over_budget = self._bytes > self.max_bytes
+        if over_budget:
+            self._evict()
+
+    def _evict(self):
+        total, evicted = _evict_lru_files(self.root, ".pkl.z", self.max_bytes)
+        with self._lock:
+            self._bytes = total
+            self.evictions += evicted
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "bytes_mb": round(self._bytes / 2**20, 1),
+                "budget_mb": round(self.max_bytes / 2**20, 1),
+                "hits": self.hits,
+                "misses": self.misses,
+                "stores": self.stores,
+                "evictions": self.evictions,
+                "hit_rate": round(self.hits / lookups, 3) if lookups else 0.0
+            }
+
+RESULT_CACHE = ResultCache(RESULT_CACHE_DIR, RESULT_CACHE_MAX_MB * 1024 * 1024) if RESULT_CACHE_MAX_MB > 0 else None
+
+def _model_revision(method):
+    """
+    Ревизия модели по файлам в кэше моделей (имена, размеры, время изменения) и бэкенду;
+    None, если модель еще не скачана. Не требует загрузки модели в память.
+    """
+    model_config = _get_model_config(method)
+    model_path = os.path.join(MODEL_CACHE_DIR, model_config["model_name"].replace("/", "_"))
+    try:
+        files = sorted(
+            (entry.name, entry.stat().st_size, entry.stat().st_mtime_ns)
+            for entry in os.scandir(model_path) if entry.is_file()
+        )
+    except FileNotFoundError:
+        return None
+    if not files:
+        return None
+    digest = hashlib.sha256(repr(files).encode()).hexdigest()[:16]
+    return f"{model_config['model_name']}@{digest}:{model_config['backend']}"
+
+def _result_cache_key(content, method, auto_policy):
+    """Ключ кэша результатов; None, если ревизия какой-либо из моделей неизвестна"""
+    if method == 0:
+        policy_name = auto_policy or AUTO_POLICY
+        policy = AUTO_POLICIES[policy_name]
+        methods = sorted({m for stage in policy["stages"] for m in stage})
+        method_key = ["auto", policy_name, policy]
+    else:
+        methods = [_get_model_config(method)["method"]]
+        method_key = methods[0]
+    revisions = [_model_revision(m) for m in methods]
+    if None in revisions:
+        return None
+    params = [
+        RESULT_CACHE_VERSION, method_key, revisions, DETECTION_MIN_AREA, DETECTION_BUILDING_CONFIDENCE,
+        TILED_INFERENCE_MIN_MP, TILE_SIZE, TILE_OVERLAP, sorted(EXTRA_CATEGORIES), FAST_PREPROCESS,
+        ARGMAX_MAX_SIDE, REDUCED_DECODE, REQUEST_MEMORY_BUDGET_MB, MEMORY_OVERBUDGET_ACTION
+    ]
+    digest = hashlib.sha256(content)
+    digest.update(json.dumps(params, sort_keys=True).encode())
+    return digest.hexdigest()
+
+class LabelMapStore:
+    """
+    Сжатые карты классов на диске - для повторной постобработки с другими порогами
+    без прогона модели.
+
+    Файл: строка JSON-заголовка (форма, тип, кодек, метод, имена классов) и сжатая
+    карта uint8/uint16 (zstd, если установлен zstandard, иначе zlib). Идентификатор
+    карты - хэш содержимого изображения, метода и ревизии модели, поэтому одно и то же
+    изображение сохраняется один раз. Вытеснение - как у кэша результатов (LRU по mtime).
+    """
+
+    def __init__(self, root, max_bytes):
+        self.root = root
+        self.max_bytes = max_bytes
+        os.makedirs(root, exist_ok=True)
+        self.codec = "zstd" if zstandard is not None else "zlib"
+        self._lock = threading.Lock()
+        self._bytes = sum(entry.stat().st_size for entry in os.scandir(root) if entry.name.endswith(".lmap"))
+        self.stores = 0
+        self.loads = 0
+        self.evictions = 0
+
+    def _path(self, map_id):
+        if not map_id or not all(c in "0123456789abcdef" for c in map_id):
+            raise ValueError("Invalid label_map_id")
+        return os.path.join(self.root, f"{map_id}.lmap")
+
+    def exists(self, map_id):
+        return os.path.exists(self._path(map_id))
+
+    def put(self, map_id, semantic_map, method, model_name, class_names):
+        dtype = np.uint8 if semantic_map.max(initial=0) < 256 else np.uint16
+        raw = np.ascontiguousarray(semantic_map, dtype=dtype).tobytes()
+        if self.codec == "zstd":
+            payload = zstandard.ZstdCompressor(level=3).compress(raw)
+        else:
+            payload = zlib.compress(raw, 6)
+        header = json.dumps({
+            "shape": list(semantic_map.shape),
+            "dtype": np.dtype(dtype).name,
+            "codec": self.codec,
+            "method": method,
+            "model_name": model_name,
+            "class_names": {str(k): v for k, v in class_names.items()}
+        }, ensure_ascii=False).encode()
+        
+        path = self._path(map_id)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(header + b"\n" + payload)
+        os.replace(tmp_path, path)
+        with self._lock:
+            self.stores += 1
+            self._bytes += len(header) + 1 + len(payload)
+            over_budget = self._bytes > self.max_bytes
+        if over_budget:
+            total, evicted = _evict_lru_files(self.root, ".lmap", self.max_bytes)
+            with self._lock:
+                self._bytes = total
+                self.evictions += evicted
+
+    def get(self, map_id):
+        """(карта классов, заголовок); KeyError, если карты нет"""
+        path = self._path(map_id)
+        try:
+            with open(path, 'rb') as f:
+                content = f.read()
+        except FileNotFoundError:
+            raise KeyError(map_id)
+        os.utime(path)
+        header_end = content.index(b"\n")
+        header = json.loads(content[:header_end])
+        payload = content[header_end + 1:]
+        if header["codec"] == "zstd":
+            if zstandard is None:
+                raise RuntimeError("Label map is zstd-compressed but zstandard is not installed")
+            raw = zstandard.ZstdDecompressor().decompress(payload)
+        else:
+            raw = zlib.decompress(payload)
+        semantic_map = np.frombuffer(raw, dtype=header["dtype"]).reshape(header["shape"])
+        header["class_names"] = {int(k): v for k, v in header["class_names"].items()}
+        with self._lock:
+            self.loads += 1
+        return semantic_map, header
+
+    def stats(self):
+        with self._lock:
+            return {
+                "codec": self.codec,
+                "bytes_mb": round(self._bytes / 2**20, 1),
+                "budget_mb": round(self.max_bytes / 2**20, 1),
+                "stores": self.stores,
+                "loads": self.loads,
+                "evictions": self.evictions
+            }
+
+LABEL_MAPS = LabelMapStore(LABEL_MAP_DIR, LABEL_MAP_MAX_MB * 1024 * 1024) if LABEL_MAP_MAX_MB > 0 else None
+
+# Постобработчики сохраненных карт по имени модели (таблица категорий строится один раз)
+_POSTPROCESSORS = {}
+
+def _postprocessor(header):
+    key = (header["model_name"], len(header["class_names"]))
+    segmentator = _POSTPROCESSORS.get(key)
+    if segmentator is None:
+        segmentator = _POSTPROCESSORS[key] = AdvancedUrbanSegmentator.for_class_names(
+            header["model_name"], header["class_names"]
+        )
+    return segmentator
+
+def _label_map_id(content, method):
+    """Идентификатор карты классов: содержимое изображения + метод + ревизия модели"""
+    revision = _model_revision(method)
+    if revision is None:
+        return None
+    digest = hashlib.sha256(content)
+    digest.update(json.dumps([method, revision, TILED_INFERENCE_MIN_MP, TILE_SIZE, TILE_OVERLAP, FAST_PREPROCESS,
+                                ARGMAX_MAX_SIDE, REDUCED_DECODE, REQUEST_MEMORY_BUDGET_MB,
+                                MEMORY_OVERBUDGET_ACTION]).encode())
+    return digest.hexdigest()
+
+class MemoryBudgetExceeded(Exception):
+    """Оценка пиковой памяти изображения больше бюджета запроса"""
+
+    def __init__(self, estimated_bytes, budget_bytes):
+        super().__init__(f"Image needs about {estimated_bytes / 2**20:.0f} MB, "
+                         f"request memory budget is {budget_bytes / 2**20:.0f} MB")
+        self.estimated_bytes = estimated_bytes
+        self.budget_bytes = budget_bytes
+
+class MemoryGuard:
+    """
+    Бюджет памяти на изображение и замер пикового RSS.
+
+    Оценка пика строится по размеру из заголовка изображения, до декодирования:
+    отрисовка идет в исходной геометрии (RENDER_BYTES_PER_PX), анализ - карта классов,
+    маски, таблица компонент - в геометрии анализа (ANALYSIS_BYTES_PER_PX), плюс логиты
+    на разрешении argmax. Если оценка больше бюджета, геометрия анализа уменьшается
+    (downscale) или изображение отклоняется (reject).
+
+    Пиковый RSS - по опросу /proc/self/statm фоновым потоком, пока идут замеры. RSS
+    общий для процесса, поэтому при параллельных запросах это верхняя оценка.
+    """
+
+    RENDER_BYTES_PER_PX = 12
+    ANALYSIS_BYTES_PER_PX = 24
+    DEFAULT_NUM_CLASSES = 150
+
+    def __init__(self, budget_bytes, action, sample_sec):
+        self.budget_bytes = budget_bytes
+        self.action = action
+        self.sample_sec = max(0.001, sample_sec)
+        self._lock = threading.Lock()
+        self._active = {}
+        self._sampler = None
+        self.admitted = 0
+        self.downscaled = 0
+        self.rejected = 0
+
+    @staticmethod
+    def rss_bytes():
+        try:
+            with open("/proc/self/statm") as f:
+                return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+        except (OSError, ValueError):
+            return None
+
+    def estimate(self, source_size, working_size, method, auto_policy=None):
+        """Оценка пиковой памяти обработки изображения, байт"""
+        segmentators = [MODEL_REGISTRY.peek(m) for m in self._methods(method, auto_policy)]
+        num_classes = max(len(s.class_names) if s is not None else self.DEFAULT_NUM_CLASSES for s in segmentators)
+        width, height = working_size
+        if _use_tiling(working_size):
+            # Логиты есть только у тайлов в работе; карта классов и маски - все равно на весь кадр
+            side = min(TILE_SIZE, max(width, height))
+            logits_px = _tiles_in_flight() * side * side
+        else:
+            side = max(width, height)
+            logits_px = width * height
+        factor = min(1.0, ARGMAX_MAX_SIDE / side) if ARGMAX_MAX_SIDE > 0 else 1.0
+        return (
+            self.RENDER_BYTES_PER_PX * source_size[0] * source_size[1]
+            + self.ANALYSIS_BYTES_PER_PX * width * height
+            + num_classes * 4 * logits_px * factor * factor
+        )
+
+    @staticmethod
+    def _methods(method, auto_policy=None):
+        if method == 0:
+            # Только модели политики, по которой пойдет автоподбор
+            policy = AUTO_POLICIES[auto_policy or AUTO_POLICY]
+            return sorted({m for stage in policy["stages"] for m in stage})
+        return [method]
+
+    def admit(self, content, method, auto_policy=None):
+        """
+        Решение по изображению до декодирования: {source_size, working_size, estimated_mb, downscale};
+        MemoryBudgetExceeded, если изображение нельзя обработать в бюджете
+        """
+        source_size = Image.open(io.BytesIO(content)).size
+        working_size = source_size
+        estimate = self.estimate(source_size, working_size, method, auto_policy)
+        downscale = 1.0
+        if self.budget_bytes > 0 and estimate > self.budget_bytes:
+            render_bytes = self.RENDER_BYTES_PER_PX * source_size[0] * source_size[1]
+            if self.action == "reject" or render_bytes >= self.budget_bytes:
+                with self._lock:
+                    self.rejected += 1
+                raise MemoryBudgetExceeded(estimate, self.budget_bytes)
+            # Анализ масштабируется примерно с площадью - шаги по корню отношения, не меньше 5% за шаг
+            for _ in range(16):
+                downscale *= min(0.95, math.sqrt((self.budget_bytes - render_bytes) / (estimate - render_bytes)))
+                working_size = (max(1, int(source_size[0] * downscale)), max(1, int(source_size[1] * downscale)))
+                estimate = self.estimate(source_size, working_size, method, auto_policy)
+                if estimate <= self.budget_bytes:
+                    break
+            else:
+                # Уменьшение не уложило оценку в бюджет - изображение не принимается
+                with self._lock:
+                    self.rejected += 1
+                raise MemoryBudgetExceeded(estimate, self.budget_bytes)
+            with self._lock:
+                self.downscaled += 1
+            logger.warning(f"Изображение {source_size[0]}x{source_size[1]} не помещается в бюджет памяти, "
+                           f"анализ в {working_size[0]}x{working_size[1]}")
+        with self._lock:
+            self.admitted += 1
+        return {
+            "source_size": source_size,
+            "working_size": working_size,
+            "estimated_mb": round(estimate / 2**20, 1),
+            "downscale": round(downscale, 4)
+        }
+
+    @contextlib.contextmanager
+    def track(self):
+        """Замер RSS за время блока: usage.start и usage.peak (байты или None)"""
+        rss = self.rss_bytes()
+        usage = types.SimpleNamespace(start=rss, peak=rss)
+        with self._lock:
+            self._active[id(usage)] = usage
+            if self._sampler is None and rss is not None:
+                self._sampler = threading.Thread(target=self._sample, name="rss-sampler", daemon=True)
+                self._sampler.start()
+        try:
+            yield usage
+        finally:
+            rss = self.rss_bytes()
+            with self._lock:
+                self._active.pop(id(usage), None)
+                if rss is not None:
+                    usage.peak = max(usage.peak, rss)
+
+    def _sample(self):
+        while True:
+            time.sleep(self.sample_sec)
+            rss = self.rss_bytes()
+            with self._lock:
+                if not self._active:
+                    self._sampler = None
+                    return
+                for usage in self._active.values():
+                    usage.peak = max(usage.peak, rss)
+
+    def stats(self):
+        rss = self.rss_bytes()
+        with self._lock:
+            return {
+                "budget_mb": round(self.budget_bytes / 2**20, 1),
+                "action": self.action,
+                "rss_mb": round(rss / 2**20, 1) if rss is not None else None,
+                "max_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+                "admitted": self.admitted,
+                "downscaled": self.downscaled,
+                "rejected": self.rejected
+            }
+
+MEMORY_GUARD = MemoryGuard(REQUEST_MEMORY_BUDGET_MB * 1024 * 1024, MEMORY_OVERBUDGET_ACTION, RSS_SAMPLE_MS / 1000.0)
+
+class DetectionFlights:
+    """
+    Single-flight для детекции: одновременные запросы с одинаковым ключом
+    (содержимое изображения, метод, политика автоподбора) ждут одно вычисление.
+
+    Первый запрос выполняет работу, остальные получают тот же Future; после
+    завершения ключ удаляется, дальше повторы обслуживает кэш результатов.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._flights = {}
+        self.leaders = 0
+        self.coalesced = 0
+
+    def run(self, key, compute):
+        """(результат, True для запроса, который выполнял вычисление)"""
+        with self._lock:
+            future = self._flights.get(key)
+            leader = future is None
+            if leader:
+                future = self._flights[key] = Future()
+                self.leaders += 1
+            else:
+                self.coalesced += 1
+        if not leader:
+            return future.result(), False
+        
+        try:
+            future.set_result(compute())
+        except BaseException as e:
+            future.set_exception(e)
+        finally:
+            with self._lock:
+                del self._flights[key]
+        return future.result(), True
+
+    def stats(self):
+        with self._lock:
+            return {"in_flight": len(self._flights), "leaders": self.leaders, "coalesced": self.coalesced}
+
+DETECTION_FLIGHTS = DetectionFlights()
+
+def _flight_key(content, method, auto_policy):
+    digest = hashlib.sha256(content)
+    digest.update(json.dumps([method, (auto_policy or AUTO_POLICY) if method == 0 else None]).encode())
+    return digest.hexdigest()
+
+def _results_for_location(results, lat, lon):
+    """Копия общего результата с координатами объектов для другой точки съемки"""
+    if "image_size" not in results:
+        return dict(results)
+    return {
+        **results,
+        "detections": _format_detections(results["buildings"], results["method"], lat, lon, results["image_size"])
+    }
+
+def download_image(image_url):
+    """Загружает изображение по URL (через кэш загрузок)"""
+    try:
+        return IMAGE_CACHE.get_image(image_url)
+    except Exception as e:
+        logger.error(f"Error downloading image {image_url}: {e}")
+        raise
+
+def generate_offset_coordinates(lat, lon, offset=50):
+    """Генерирует случайные координаты в радиусе от указанной точки"""
+    if not lat and not lon: return None, None
+    lat, lon = float(lat), float(lon)
+    a, d = random.uniform(0, 2 * math.pi), random.uniform(0, offset ** 2) ** 0.5
+    return (lat + d * math.cos(a) / 111000, 
+            lon + d * math.sin(a) / (111000 * math.cos(math.radians(lat))))
+    
+def _use_tiling(image_size):
+    """Нужен ли тайловый инференс для изображения такого размера"""
+    width, height = image_size
+    return TILED_INFERENCE_MIN_MP > 0 and width * height > TILED_INFERENCE_MIN_MP * 1e6
+
+def _tiles_in_flight():
+    """Сколько тайлов одновременно в инференсе: не больше двух микробатчей"""
+    return max(1, 2 * INFERENCE_MAX_BATCH_SIZE)
+
+def _tile_spans(length, tile, overlap):
+    """
+    Тайлы вдоль одной оси: (начало тайла, начало и конец его центральной части).
+    Центральные части стыкуются посередине перекрытий, так что каждый пиксель берется
+    из того тайла, где он дальше всего от края (у края тайла модели не хватает контекста).
+    """
+    if not 0 <= overlap < tile:
+        raise ValueError(f"overlap must be in [0, {tile}), got {overlap}")
+    if length <= tile:
+        return [(0, 0, length)]
+    stride = tile - overlap
+    starts = list(range(0, length - tile, stride)) + [length - tile]
+    cuts = [0] + [(starts[i + 1] + starts[i] + tile) // 2 for i in range(len(starts) - 1)] + [length]
+    return [(start, cuts[i], cuts[i + 1]) for i, start in enumerate(starts)]
+
+def _predict_tiled(method, image):
+    """
+    Карта классов большого изображения по тайлам TILE_SIZE с перекрытием TILE_OVERLAP.
+
+    Тайлы идут через планировщик микробатчей (одинаковые тайлы попадают в один батч),
+    в работе одновременно не больше двух батчей; из каждой карты тайла в общую карту
+    копируется только центральная часть. Компоненты зданий на стыках тайлов затем
+    выделяются по общей карте, поэтому здание на границе остается одним объектом.
+
+    Тайлы ограничивают только память модели (логиты). Декодированное изображение и карта
+    классов height x width держатся целиком и растут с разрешением; MemoryGuard учитывает
+    их в оценке и уменьшает или отклоняет изображения, которые не помещаются в бюджет.
+    """
+    image = _to_rgb_image(image)
+    width, height = image.size
+    segmentator = MODEL_REGISTRY.get(method)
+    dtype = np.uint8 if len(segmentator.class_names) <= 256 else np.uint16
+    semantic_map = np.empty((height, width), dtype=dtype)
+    
+    tiles = [
+        (x_span, y_span)
+        for y_span in _tile_spans(height, TILE_SIZE, TILE_OVERLAP)
+        for x_span in _tile_spans(width, TILE_SIZE, TILE_OVERLAP)
+    ]
+    window = _tiles_in_flight()
+    pending = deque()
+    
+    def paste(x_span, y_span, future):
+        (x0, core_x0, core_x1), (y0, core_y0, core_y1) = x_span, y_span
+        tile_map = future.result()
+        semantic_map[core_y0:core_y1, core_x0:core_x1] = \
+            tile_map[core_y0 - y0:core_y1 - y0, core_x0 - x0:core_x1 - x0]
+    
+    for x_span, y_span in tiles:
+        x0, y0 = x_span[0], y_span[0]
+        tile = image.crop((x0, y0, min(width, x0 + TILE_SIZE), min(height, y0 + TILE_SIZE)))
+        pending.append((x_span, y_span, INFERENCE_SCHEDULER.submit(method, tile)))
+        if len(pending) >= window:
+            paste(*pending.popleft())
+    while pending:
+        paste(*pending.popleft())
+    
+    logger.info(f"Тайловый инференс {width}x{height}: {len(tiles)} тайлов {TILE_SIZE}px, перекрытие {TILE_OVERLAP}px")
+    return semantic_map
+
+def _predict_semantic_map(method, image):
+    """Карта классов изображения: одним проходом или по тайлам для очень больших изображений"""
+    if _use_tiling(_source_size(image)):
+        return _predict_tiled(method, image)
+    return INFERENCE_SCHEDULER.predict(method, image)
+
+def detect_objects(image_url, lat, lon, method, seed, auto_policy=None, wait_for_slot=True):
+    """
+    Выполняет реальную детекцию зданий используя семантическую сегментацию с разными моделями
+    
+    Args:
+        image_url: URL изображения
+        lat: широта съемки
+        lon: долгота съемки  
+        method: метод детекции (0 - автоподбор)
+        seed: seed для воспроизводимости
+        auto_policy: политика автоподбора для method=0 (exhaustive | cascade)
+        wait_for_slot: ждать места в очереди пула инференса; иначе InferenceQueueFull
+    
+    Returns:
+        list: список обнаружений [id, method, bbox, confidence, lat, lon]
+    """
+    try:
+        content = IMAGE_CACHE.get_bytes(image_url)
+        cache_key = _result_cache_key(content, method, auto_policy) if RESULT_CACHE is not None else None
+        if cache_key is not None:
+            results = RESULT_CACHE.get(cache_key)
+            if results is not None:
+                # Координаты объектов зависят от точки съемки, поэтому пересчитываются
+                results["detections"] = _format_detections(
+                    results["buildings"], results["method"], lat, lon, results["image_size"]
+                )
+                if results.get("semantic_map") is not None:
+                    _persist_label_map(content, results)
+                    results.pop("semantic_map")
+                elif results.get("label_map_id") and (LABEL_MAPS is None or not LABEL_MAPS.exists(results["label_map_id"])):
+                    # Карта классов вытеснена из хранилища - повторная постобработка для записи недоступна
+                    results.pop("label_map_id")
+                return results
+        
+        def compute():
+            # Решение по памяти принимается до декодирования и до постановки в очередь пула
+            admission = MEMORY_GUARD.admit(content, method, auto_policy)
+            if INFERENCE_POOL is not None:
+                # Воркеру уходят байты изображения: загрузка и кэш остаются в этом процессе
+                results = INFERENCE_POOL.detect(content, lat, lon, method, seed, auto_policy, admission,
+                                                block=wait_for_slot)
+            else:
+                results = _detect_in_content(content, lat, lon, method, seed, auto_policy, admission, image_url)
+            
+            if admission["working_size"] != admission["source_size"]:
+                # Карта классов уменьшенного анализа не в геометрии оригинала: ни в кэш результатов,
+                # ни в хранилище карт (ключи у них те же, что у полноразмерного расчета)
+                results.pop("semantic_map", None)
+                return results
+            # Карта классов сохраняется до записи в кэш, чтобы в кэш попал ее label_map_id
+            _persist_label_map(content, results)
+            if RESULT_CACHE is not None and "image_size" in results:
+                # Модель могла быть скачана только сейчас - ключ считаем заново
+                key = cache_key or _result_cache_key(content, method, auto_policy)
+                if key is not None:
+                    try:
+                        RESULT_CACHE.put(key, results)
+                    except OSError as e:
+                        logger.warning(f"Не удалось сохранить результат в кэш: {e}")
+            # Карта классов сохранена - дальше (отрисовка, ответ) она не нужна
+            results.pop("semantic_map", None)
+            return results
+        
+        # Одинаковые изображения, которые считаются прямо сейчас, не запускаются повторно
+        results, leader = DETECTION_FLIGHTS.run(_flight_key(content, method, auto_policy), compute)
+        return results if leader else _results_for_location(results, lat, lon)
+        
+    except (InferenceQueueFull, MemoryBudgetExceeded):
+        raise
+    except Exception as e:
+        logger.error(f"Ошибка детекции: {e}")
+        return {"buildings": {}, "detections": [], "road_mask": None, "other_mask": None}
+
+def _persist_label_map(content, results):
+    """Сохраняет карту классов результата (если ее еще нет) и проставляет label_map_id"""
+    if LABEL_MAPS is None or results.get("semantic_map") is None or not results.get("class_names"):
+        return
+    try:
+        map_id = _label_map_id(content, results["method"])
+        if map_id is None:
+            return
+        if not LABEL_MAPS.exists(map_id):
+            LABEL_MAPS.put(map_id, results["semantic_map"], results["method"],
+                           _get_model_config(results["method"])["model_name"], results["class_names"])
+        results["label_map_id"] = map_id
+    except OSError as e:
+        logger.warning(f"Не удалось сохранить карту классов: {e}")
+
+def _detect_in_content(content, lat, lon, method, seed, auto_policy, admission, image_url=None):
+    """
+    Декодирование и детекция в этом процессе (в том числе в воркере пула) по решению
+    MEMORY_GUARD: при уменьшенной геометрии анализа результаты переводятся в координаты
+    оригинала. Пиковый RSS за время обработки - в results["memory"] и в логе.
+    """
+    source_size, working_size = tuple(admission["source_size"]), tuple(admission["working_size"])
+    with MEMORY_GUARD.track() as usage:
+        if working_size != source_size:
+            image = _decode_for_inference(content, method, auto_policy, working_size)
+        elif REDUCED_DECODE or image_url is None:
+            image = _decode_for_inference(content, method, auto_policy)
+        else:
+            # Полное декодирование берется из кэша загрузок - оно же понадобится для отрисовки
+            image = download_image(image_url)
+        results = _detect_in_image(image, lat, lon, method, seed, auto_policy)
+        del image
+        if working_size != source_size and "image_size" in results:
+            _rescale_results(results, source_size, lat, lon)
+        # Маски отдельных зданий нужны только для подсчета их статистики
+        for building in results["buildings"].values():
+            building.pop("mask", None)
+            building.pop("mask_origin", None)
+    
+    memory = {"estimated_mb": admission["estimated_mb"], "downscale": admission["downscale"]}
+    if usage.peak is not None:
+        memory["peak_rss_mb"] = round(usage.peak / 2**20, 1)
+        memory["rss_growth_mb"] = round((usage.peak - usage.start) / 2**20, 1)
+    results["memory"] = memory
+    logger.info(f"Память {source_size[0]}x{source_size[1]}: оценка {memory['estimated_mb']} МБ, "
+                f"пик RSS {memory.get('peak_rss_mb')} МБ (+{memory.get('rss_growth_mb')}), "
+                f"масштаб анализа {memory['downscale']}")
+    return results
+
+def _rescale_results(results, source_size, lat, lon):
+    """Переводит здания из уменьшенной геометрии анализа в координаты исходного изображения"""
+    work_width, work_height = results["image_size"]
+    src_width, src_height = source_size
+    sx, sy = src_width / work_width, src_height / work_height
+    for building in results["buildings"].values():
+        x_min, y_min, x_max, y_max = building["bbox"]
+        building["bbox"] = [
+            int(x_min * sx), int(y_min * sy),
+            min(src_width, round((x_max + 1) * sx)) - 1, min(src_height, round((y_max + 1) * sy)) - 1
+        ]
+        building["centroid"] = [building["centroid"][0] * sx, building["centroid"][1] * sy]
+        building["area"] = building["pixel_count"] = int(round(building["area"] * sx * sy))
+    results["image_size"] = source_size
+    results["detections"] = _format_detections(results["buildings"], results["method"], lat, lon, source_size)
+
+def _detect_in_image(image, lat, lon, method, seed, auto_policy=None):
+    """Детекция на загруженном изображении в текущем процессе"""
+    # Если method=0 - автоподбор лучшего алгоритма
+    if method == 0:
+        return _auto_select_best_model(image, lat, lon, seed, auto_policy)
+    
+    # Определяем модель на основе method
+    model_config = _get_model_config(method)
+    used_method = model_config["method"]
+    model_name = model_config["model_name"]
+    
+    # Берем сегментатор из реестра загруженных моделей
+    segmentator = MODEL_REGISTRY.get(used_method)
+    
+    # Прямой проход идет через планировщик микробатчей, постобработка - в этом потоке
+    semantic_map_np = _predict_semantic_map(used_method, image)
+    results = segmentator.postprocess_semantic_map(
+        semantic_map_np, 
+        min_area=DETECTION_MIN_AREA,
+        building_confidence=DETECTION_BUILDING_CONFIDENCE
+    )
+    
+    # Преобразуем результаты в требуемый формат (ТОЛЬКО ЗДАНИЯ)
+    image_size = _source_size(image)
+    detections = _format_detections(results["buildings"], used_method, lat, lon, image_size)
+    
+    # Сохраняем маски для использования в отрисовке
+    results["detections"] = detections
+    results["image_size"] = image_size
+    results["method"] = used_method
+    
+    logger.info(f"Детекция моделью {model_name}: найдено {len(detections)} зданий")
+    return results
+
+class _SharedPreprocessing:
+    """Тензоры входа одного изображения, общие для кандидатов с совместимыми процессорами"""
+
+    def __init__(self, image):
+        self.image = _to_rgb_image(image)
+        self._lock = threading.Lock()
+        self._slots = {}
+        self.runs = 0
+
+    def get(self, segmentator):
+        signature = segmentator.preprocess_signature()
+        with self._lock:
+            slot = self._slots.setdefault(signature, {"lock": threading.Lock(), "inputs": None})
+        with slot["lock"]:
+            if slot["inputs"] is None:
+                slot["inputs"] = segmentator.preprocess_images([self.image])
+                self.runs += 1
+            return slot["inputs"]
+
+def _run_auto_candidate(model_method, shared):
+    """Прогон одной модели-кандидата автоподбора на общих тензорах входа"""
+    segmentator = MODEL_REGISTRY.get(model_method)
+    if _use_tiling(_source_size(shared.image)):
+        semantic_map_np = _predict_tiled(model_method, shared.image)
+    else:
+        # Прямой проход - через планировщик, как у одиночной детекции той же модели
+        semantic_map_np = INFERENCE_SCHEDULER.predict(model_method, shared.image, shared.get(segmentator))
+    return segmentator.postprocess_semantic_map(
+        semantic_map_np, 
+        min_area=DETECTION_MIN_AREA,
+        building_confidence=DETECTION_BUILDING_CONFIDENCE
+    )
+
+def _auto_quality_ok(results, accept):
+    """Проверяет, проходит ли результат модели пороги качества каскада"""
+    if results is None:
+        return False
+    buildings = results["buildings"]
+    if len(buildings) < accept.get("min_buildings", 0):
+        return False
+    mean_confidence = (sum(b["confidence"] for b in buildings.values()) / len(buildings)) if buildings else 0.0
+    if mean_confidence < accept.get("min_mean_confidence", 0.0):
+        return False
+    return results.get("building_ratio", 0.0) >= accept.get("min_building_ratio", 0.0)
+
+def _auto_select_best_model(image, lat, lon, seed, auto_policy=None):
+    """
+    Автоподбор модели по политике AUTO_POLICIES: модели запускаются по стадиям,
+    после каждой стадии (если у политики есть accept) лучший результат проверяется
+    порогами качества, и при успехе следующие стадии не запускаются.
+    Лучшей считается модель, нашедшая больше всего зданий.
+    """
+    policy_name = auto_policy or AUTO_POLICY
+    policy = AUTO_POLICIES[policy_name]
+    stages = policy["stages"]
+    accept = policy["accept"]
+    workers = max(1, min(AUTO_SELECT_WORKERS, max(len(stage) for stage in stages)))
+    logger.info(f"Автоподбор модели ({policy_name}): стадии {stages}, параллельно {workers}...")
+    
+    best_results = None
+    best_model_method = 1
+    best_model_name = "shi-labs/oneformer_ade20k_swin_tiny"
+    max_buildings = 0
+    candidates = {}
+    
+    # Изображение декодируется и нормализуется один раз на группу совместимых процессоров
+    shared = _SharedPreprocessing(image)
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for stage in stages:
+            futures = {
+                model_method: pool.submit(_run_auto_candidate, model_method, shared)
+                for model_method in stage if model_method not in candidates
+            }
+            
+            # Выбор идет в порядке стадии, чтобы при равенстве побеждала более ранняя модель
+            for model_method, future in futures.items():
+                model_name = _get_model_config(model_method)["model_name"]
+                try:
+                    results = future.result()
+                except Exception as e:
+                    logger.error(f"  Ошибка в модели {model_method}: {e}")
+                    candidates[model_method] = None
+                    continue
+                
+                buildings_count = len(results["buildings"])
+                candidates[model_method] = buildings_count
+                logger.info(f"  Модель {model_method} ({model_name}) нашла {buildings_count} зданий")
+                
+                if buildings_count > max_buildings:
+                    if best_results is not None:
+                        # Прежний лучший кандидат больше не нужен - его маски и карта освобождаются
+                        best_results.clear()
+                    max_buildings = buildings_count
+                    best_model_method = model_method
+                    best_model_name = model_name
+                    best_results = results
+                else:
+                    results.clear()
+            
+            if accept is not None and _auto_quality_ok(best_results, accept):
+                break
+    
+    logger.info(f"Выбрана модель {best_model_method} ({best_model_name}): {max_buildings} зданий; "
+                f"запущены модели {list(candidates)}, препроцессинг выполнен {shared.runs} раз(а)")
+    
+    if best_results:
+        best_results["detections"] = _format_detections(
+            best_results["buildings"], best_model_method, lat, lon, _source_size(image)
+        )
+        best_results["image_size"] = _source_size(image)
+        best_results["method"] = best_model_method
+    else:
+        best_results = {"buildings": {}, "detections": [], "road_mask": None, "other_mask": None}
+    best_results["auto_select"] = {
+        "policy": policy_name,
+        "models_run": list(candidates),
+        "selected_method": best_model_method if max_buildings else None,
+        "buildings_per_model": candidates
+    }
+    return best_results
+
+def _format_detections(buildings_dict, method, lat, lon, image_size):
+    """Форматирует обнаружения зданий в требуемый формат"""
+    detections = []
+    
+    for obj_id, building in buildings_dict.items():
+        bbox_dict = _convert_bbox_format(building["bbox"])
+        obj_lat, obj_lon = _calculate_object_coordinates(
+            lat, lon, building["centroid"], image_size, building["area"]
+        )
+        
+        detection = [
+            f'id{obj_id}',
+            method,
+            bbox_dict,
+            round(building["confidence"], 3),
+            obj_lat,
+            obj_lon
+        ]
+        detections.append(detection)
+    
+    return detections
+
+def _get_model_config(method):
+    """Возвращает конфигурацию модели на основе method"""
+    models = {
+        1: {"method": 1, "model_name": "shi-labs/oneformer_ade20k_swin_tiny", "description": "Tiny модель"},
+        2: {"method": 2, "model_name": "shi-labs/oneformer_ade20k_swin_base", "description": "Small модель"},
+        3: {"method": 3, "model_name": "shi-labs/oneformer_coco_swin_large", "description": "COCO модель"},
+        4: {"method": 4, "model_name": "shi-labs/oneformer_ade20k_swin_large", "description": "ADE20K модель"},
+        5: {"method": 5, "model_name": "shi-labs/oneformer_cityscapes_swin_large", "description": "Cityscapes модель"}
+    }
+    
+    model_config = dict(models.get(method, models[1]))
+    model_config["backend"] = INFERENCE_BACKENDS.get(str(model_config["method"]), INFERENCE_BACKEND)
+    return model_config
+
+def _convert_bbox_format(bbox):
+    """Конвертирует bbox из [x_min, y_min, x_max, y_max] в {x, y, w, h}"""
+    x_min, y_min, x_max, y_max = bbox
+    return {
+        'x': int(x_min),
+        'y': int(y_min), 
+        'w': int(x_max - x_min),
+        'h': int(y_max - y_min)
+    }
+
+def _calculate_object_coordinates(center_lat, center_lon, centroid, image_size, area):
+    """Рассчитывает координаты объекта на основе его положения в изображении"""
+    centroid_x, centroid_y = centroid
+    img_width, img_height = image_size
+    
+    if center_lat is None or center_lon is None:
+        return None, None
+    
+    # Нормализуем позицию относительно центра изображения
+    norm_x = (centroid_x - img_width/2) / img_width
+    norm_y = (centroid_y - img_height/2) / img_height
+    
+    # Масштабируем смещение в зависимости от площади объекта
+    area_factor = min(area / 10000, 1.0)
+    
+    # Рассчитываем смещение в градусах
+    offset_deg = 0.001 * area_factor
+    
+    obj_lat = float(center_lat) + norm_y * offset_deg
+    obj_lon = float(center_lon) + norm_x * offset_deg
+    
+    return round(obj_lat, 6), round(obj_lon, 6)
+
+# Палитра цветов для bbox (циклическое использование)
+COLOR_PALETTE = [
+    (255, 105, 180),  # розовый
+    (119, 11, 32),    # бордовый
+    (0, 0, 142),      # темно-синий
+    (0, 0, 230),      # синий
+    (106, 0, 228),    # фиолетовый
+    (0, 60, 100),     # темно-бирюзовый
+    (0, 80, 100),     # бирюзовый
+    (0, 0, 70),       # очень темно-синий
+    (0, 0, 192),      # ярко-синий
+    (250, 170, 30)    # оранжевый
+]
+# Для одиночного bbox всегда используем розовый цвет
+SINGLE_DETECTION_COLOR = (255, 105, 180)
+
+def _blend_lut(color, alpha):
+    """Таблица 256 x 3: значение канала -> результат смешивания с цветом при альфе alpha"""
+    values = np.arange(256, dtype=np.uint16)[:, None]
+    blended = (values * (255 - alpha) + np.array(color, dtype=np.uint16) * alpha + 127) // 255
+    return blended.astype(np.uint8).reshape(256, 1, 3)
+
+# Наложение масок: синяя для дорог (альфа 90) и осветляющая для остальных объектов
+# (альфа 192). Маска "прочего" накладывается поверх дорог, как раньше при Image.composite
+ROAD_OVERLAY_LUT = _blend_lut((0, 0, 255), 90)
+OTHER_OVERLAY_LUT = _blend_lut((255, 255, 255), 192)
+
+@functools.lru_cache(maxsize=None)
+def _get_font():
+    """Шрифт подписей; загружается один раз на процесс"""
+    try:
+        return ImageFont.truetype("arial.ttf", 11)
+    except Exception:
+        try:
+            return ImageFont.load_default()
+        except Exception:
+            return None
+
+def composite_masks(image_array, road_mask, other_mask):
+    """
+    Накладывает маски дорог и прочих объектов на RGB-массив: смешивание с цветом
+    маски - это табличная функция значения канала (cv2.LUT), результат копируется
+    по маске в один выходной буфер. Возвращает новый массив uint8.
+    """
+    output = np.array(image_array, dtype=np.uint8)
+    height, width = output.shape[:2]
+    for mask, lut in ((road_mask, ROAD_OVERLAY_LUT), (other_mask, OTHER_OVERLAY_LUT)):
+        if mask is not None and cv2.countNonZero(mask) > 0:
+            if mask.shape != (height, width):
+                # Маски из уменьшенной геометрии анализа (бюджет памяти)
+                mask = cv2.resize(mask, (width, height), interpolation=cv2.INTER_NEAREST)
+            cv2.copyTo(cv2.LUT(image_array, lut), mask, output)
+    return output
+
+def _blend_rect(image_array, x, y, width, height, color, alpha):
+    """Полупрозрачный прямоугольник (как paste RGBA-плашки) прямо в массиве"""
+    img_h, img_w = image_array.shape[:2]
+    x0, y0 = max(0, x), max(0, y)
+    x1, y1 = min(img_w, x + width), min(img_h, y + height)
+    if x0 >= x1 or y0 >= y1:
+        return
+    region = image_array[y0:y1, x0:x1].astype(np.uint16)
+    region *= 255 - alpha
+    region += np.array(color, dtype=np.uint16) * alpha + 127
+    region //= 255
+    image_array[y0:y1, x0:x1] = region
+
+def _outline_rect(image_array, x1, y1, x2, y2, color, width):
+    """Рамка толщиной width внутрь [x1, y1, x2, y2], как ImageDraw.rectangle"""
+    img_h, img_w = image_array.shape[:2]
+    for ys, ye, xs, xe in ((y1, y1 + width, x1, x2 + 1), (y2 - width + 1, y2 + 1, x1, x2 + 1),
+                           (y1, y2 + 1, x1, x1 + width), (y1, y2 + 1, x2 - width + 1, x2 + 1)):
+        ys, ye = max(0, ys), min(img_h, ye)
+        xs, xe = max(0, xs), min(img_w, xe)
+        if ys < ye and xs < xe:
+            image_array[ys:ye, xs:xe] = color
+
+def _layout_detection(image_array, texts, detection, color, outline_width, coord_char_width, coord_padding, coord_bg_height):
+    """Рамка и плашки одного обнаружения рисуются в массив, подписи копятся в texts"""
+    id_val, method_val, bbox, confidence, obj_lat, obj_lon = detection
+    
+    # Конвертируем x,y,w,h в x1,y1,x2,y2 для отрисовки
+    x1 = bbox['x']
+    y1 = bbox['y']
+    x2 = bbox['x'] + bbox['w']
+    y2 = bbox['y'] + bbox['h']
+    _outline_rect(image_array, x1, y1, x2, y2, color, outline_width)
+    
+    # Подписываем bbox с confidence (формат: "id1 .87") на полупрозрачном фоне
+    label = f"{id_val} .{int(confidence * 100):02d}"
+    label_bg_width = 45
+    label_bg_height = 14
+    _blend_rect(image_array, x1 + 1, y1 + 1, label_bg_width, label_bg_height, color, 180)
+    texts.append(((x1 + 3, y1 + 1), label, (255, 255, 255)))
+    
+    # Координаты объекта
+    if obj_lat and obj_lon:
+        coord_text1 = f"{obj_lat:.5f}"
+        coord_text2 = f"{obj_lon:.5f}"
+        
+        coord_bg_x = x1 + 1
+        coord_bg_y = y1 + label_bg_height + 1
+        # Ширина фона учитывает полную длину чисел
+        coord_bg_width = max(len(coord_text1), len(coord_text2)) * coord_char_width + coord_padding
+        
+        if (coord_bg_y + coord_bg_height < y2 and 
+            coord_bg_x + coord_bg_width < x2):
+            _blend_rect(image_array, coord_bg_x, coord_bg_y, coord_bg_width, coord_bg_height,
+                        (255, 255, 255), 180)
+            texts.append(((coord_bg_x + 4, coord_bg_y + 2), coord_text1, (0, 0, 0)))
+            texts.append(((coord_bg_x + 4, coord_bg_y + 12), coord_text2, (0, 0, 0)))
+
+def _draw_texts(image_array, texts):
+    """Все подписи рисуются одним ImageDraw поверх готового массива"""
+    image = Image.fromarray(image_array)
+    draw = ImageDraw.Draw(image)
+    font = _get_font()
+    for xy, text, fill in texts:
+        draw.text(xy, text, fill=fill, font=font)
+    return image
+
+def render_detections(base_image, detections, method, seed, road_mask=None, other_mask=None):
+    """Режим "все bbox": маски, рамки, подписи и статусная строка; base_image не изменяется"""
+    base_array = np.asarray(base_image)
+    if road_mask is not None or other_mask is not None:
+        image_array = composite_masks(base_array, road_mask, other_mask)
+    else:
+        image_array = np.array(base_array)
+    height, width = image_array.shape[:2]
+    
+    texts = []
+    for i, detection in enumerate(detections):
+        _layout_detection(image_array, texts, detection, COLOR_PALETTE[i % len(COLOR_PALETTE)],
+                          outline_width=3, coord_char_width=6, coord_padding=8, coord_bg_height=24)
+    
+    # Информационная строка с seed (полупрозрачный фон) - ТОЛЬКО ДЛЯ РЕЖИМА ВСЕХ BBOX
+    info_bg_height = 20
+    _blend_rect(image_array, 0, height - info_bg_height, width, info_bg_height, (0, 0, 0), 180)
+    info_text = f"Detections: {len(detections)} | Method: {method} | Seed: {seed}"
+    texts.append(((10, height - info_bg_height + 3), info_text, (255, 255, 255)))
+    
+    return _draw_texts(image_array, texts)
+
+def render_single_detection(base_image, detection):
+    """Режим "один bbox" - без масок и статусной строки; base_image не изменяется"""
+    image_array = np.array(base_image)
+    texts = []
+    _layout_detection(image_array, texts, detection, SINGLE_DETECTION_COLOR,
+                      outline_width=4, coord_char_width=7, coord_padding=10, coord_bg_height=22)
+    return _draw_texts(image_array, texts)
+
+def parse_output_variant(args):
+    """
+    Вариант выходного изображения из параметров запроса size, format, quality.
+    По умолчанию - полноразмерный JPEG с качеством OUTPUT_DEFAULT_QUALITY.
+    """
+    size = (args.get('size') or 'full').lower()
+    output_format = (args.get('format') or 'jpeg').lower()
+    if output_format == 'jpg':
+        output_format = 'jpeg'
+    if size not in OUTPUT_SIZES:
+        raise ValueError(f"size must be one of {sorted(OUTPUT_SIZES)}")
+    if output_format not in OUTPUT_FORMATS:
+        raise ValueError(f"format must be one of {sorted(OUTPUT_FORMATS)}")
+    quality = int(args.get('quality') or OUTPUT_DEFAULT_QUALITY)
+    if not 1 <= quality <= 100:
+        raise ValueError("quality must be in 1..100")
+    return {"size": size, "format": output_format, "quality": quality}
+
+DEFAULT_OUTPUT_VARIANT = {"size": "full", "format": "jpeg", "quality": OUTPUT_DEFAULT_QUALITY}
+
+def variant_suffix(variant):
+    """Суффикс имени файла варианта, например thumb_q80.webp"""
+    return f"{variant['size']}_q{variant['quality']}.{OUTPUT_FORMATS[variant['format']]['ext']}"
+
+def variant_mimetype(variant):
+    return OUTPUT_FORMATS[variant['format']]['mimetype']
+
+def encode_variant(image, variant=None):
+    """Уменьшает изображение до размера варианта и кодирует в его формат"""
+    variant = variant or DEFAULT_OUTPUT_VARIANT
+    if image.mode != 'RGB':
+        image = image.convert('RGB')
+    max_side = OUTPUT_SIZES[variant['size']]
+    if max_side and max(image.size) > max_side:
+        image = image.copy()
+        image.thumbnail((max_side, max_side), Image.BILINEAR, reducing_gap=2.0)
+    img_buffer = io.BytesIO()
+    image.save(img_buffer, OUTPUT_FORMATS[variant['format']]['pil_format'], quality=variant['quality'])
+    img_buffer.seek(0)
+    return img_buffer
+
+def render_error_image(error):
+    """Картинка-заглушка с текстом ошибки"""
+    width, height = 800, 600
+    image = Image.new('RGB', (width, height), color=(240, 240, 240))
+    draw = ImageDraw.Draw(image)
+    draw.text((50, 50), f"Error: {str(error)}", fill=(255, 0, 0))
+    return encode_variant(image, {"size": "full", "format": "jpeg", "quality": 85})
+
+def draw_detections(image_url, detections, method, seed, single_detection_index=None, road_mask=None, other_mask=None,
+                    variant=None):
+    """
+    Отрисовывает обнаружения на изображении
+    
+    Args:
+        image_url: URL изображения
+        detections: список обнаружений [id, method, bbox, confidence, lat, lon]
+        method: метод детекции
+        seed: seed
+        single_detection_index: индекс одиночного bbox (None - все bbox)
+        road_mask: маска дорог
+        other_mask: маска других объектов
+        variant: размер/формат/качество результата (None - полноразмерный JPEG)
+    
+    Returns:
+        tuple: (img_buffer, photo_urls)
+    """
+    try:
+        base_image = download_image(image_url)
+        
+        if single_detection_index is None:
+            image = render_detections(base_image, detections, method, seed, road_mask, other_mask)
+        elif single_detection_index < len(detections):
+            image = render_single_detection(base_image, detections[single_detection_index])
+        else:
+            image = base_image
+        
+        return encode_variant(image, variant), []
+        
+    except Exception as e:
+        logger.error(f"Error in draw_detections: {e}")
+        return render_error_image(e), []
+        
+class RenderStore:
+    """
+    Дисковое хранилище отрисованных фото с индексом в SQLite.
+
+    Файлы называются по sha256 содержимого, поэтому одинаковые картинки хранятся
+    один раз. Индекс связывает UUID фото с исходными данными (URL, обнаружения,
+    параметры отложенной отрисовки) и файлами полноразмерного рендера и вариантов.
+    Фото, к которым не обращались ttl_sec секунд, удаляются; при превышении
+    max_bytes вытесняются давно не запрашивавшиеся. Индекс работает в режиме WAL,
+    все изменения идут под BEGIN IMMEDIATE, поэтому одно хранилище можно делить
+    между несколькими процессами на узле.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS photos (
+            uuid TEXT PRIMARY KEY,
+            image_url TEXT,
+            detections TEXT,
+            detection_index INTEGER,
+            render TEXT,
+            blob TEXT,
+            created REAL NOT NULL,
+            last_access REAL NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS photos_last_access ON photos(last_access);
+        CREATE INDEX IF NOT EXISTS photos_blob ON photos(blob);
+        CREATE TABLE IF NOT EXISTS variants (
+            uuid TEXT NOT NULL,
+            suffix TEXT NOT NULL,
+            blob TEXT NOT NULL,
+            PRIMARY KEY (uuid, suffix)
+        );
+        CREATE INDEX IF NOT EXISTS variants_blob ON variants(blob);
+        CREATE TABLE IF NOT EXISTS blobs (
+            hash TEXT PRIMARY KEY,
+            filename TEXT NOT NULL,
+            size INTEGER NOT NULL,
+            created REAL NOT NULL
+        );
+    """
+
+    def __init__(self, root, max_bytes, ttl_sec, sweep_sec):
+        self.root = root
+        self.blob_dir = os.path.join(root, "blobs")
+        os.makedirs(self.blob_dir, exist_ok=True)
+        self.db_path = os.path.join(root, "index.sqlite3")
+        self.max_bytes = max_bytes
+        self.ttl_sec = ttl_sec
+        self.sweep_sec = sweep_sec
+        self._local = threading.local()
+        self._sweeper = None
+        self.expired = 0
+        self.evictions = 0
+        self._conn().executescript(self.SCHEMA)
+
+    def _conn(self):
+        """Соединение с индексом, свое для каждого потока"""
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    @contextlib.contextmanager
+    def _write(self):
+        """Транзакция с блокировкой записи (общей для всех процессов)"""
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield conn
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+
+    def _blob_path(self, filename):
+        return os.path.join(self.blob_dir, filename)
+
+    def _put_blob(self, conn, content, ext):
+        """Кладет файл по хэшу содержимого (внутри транзакции записи); возвращает хэш"""
+        blob_hash = hashlib.sha256(content).hexdigest()
+        filename = f"{blob_hash}.{ext}"
+        path = self._blob_path(filename)
+        if not os.path.exists(path):
+            tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(tmp_path, 'wb') as f:
+                f.write(content)
+            os.replace(tmp_path, path)
+        conn.execute(
+            "INSERT OR IGNORE INTO blobs (hash, filename, size, created) VALUES (?, ?, ?, ?)",
+            (blob_hash, filename, len(content), time.time())
+        )
+        return blob_hash
+
+    def _drop_unreferenced(self, conn, hashes=None):
+        """Удаляет файлы, на которые больше не ссылается ни одно фото; возвращает освобожденные байты"""
+        query = (
+            "SELECT hash, filename, size FROM blobs WHERE "
+            "NOT EXISTS (SELECT 1 FROM photos WHERE photos.blob = blobs.hash) AND "
+            "NOT EXISTS (SELECT 1 FROM variants WHERE variants.blob = blobs.hash)"
+        )
+        params = []
+        if hashes is not None:
+            hashes = [h for h in hashes if h]
+            if not hashes:
+                return 0
+            query += f" AND hash IN ({','.join('?' * len(hashes))})"
+            params = hashes
+        freed = 0
+        for blob_hash, filename, size in conn.execute(query, params).fetchall():
+            conn.execute("DELETE FROM blobs WHERE hash = ?", (blob_hash,))
+            try:
+                os.remove(self._blob_path(filename))
+            except FileNotFoundError:
+                pass
+            freed += size
+        return freed
+
+    def _drop_photo(self, conn, photo_uuid):
+        hashes = [row[0] for row in conn.execute(
+            "SELECT blob FROM photos WHERE uuid = ? UNION ALL SELECT blob FROM variants WHERE uuid = ?",
+            (photo_uuid, photo_uuid)
+        )]
+        conn.execute("DELETE FROM variants WHERE uuid = ?", (photo_uuid,))
+        conn.execute("DELETE FROM photos WHERE uuid = ?", (photo_uuid,))
+        return self._drop_unreferenced(conn, hashes)
+
+    def _total_bytes(self, conn):
+        return conn.execute("SELECT COALESCE(SUM(size), 0) FROM blobs").fetchone()[0]
+
+    def create(self, image_url, detections, detection_index=None, content=None, ext="jpg", render=None):
+        """
+        Регистрирует фото и возвращает UUID. content - готовое изображение;
+        без него фото отрисовывается при первом запросе по параметрам render.
+        """
+        photo_uuid = str(uuid.uuid4())
+        now = time.time()
+        with self._write() as conn:
+            blob_hash = self._put_blob(conn, content, ext) if content is not None else None
+            conn.execute(
+                "INSERT INTO photos (uuid, image_url, detections, detection_index, render, blob, created, last_access) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (photo_uuid, image_url, json.dumps(detections), detection_index,
+                 json.dumps(render) if render is not None else None, blob_hash, now, now)
+            )
+            over_budget = blob_hash is not None and self._total_bytes(conn) > self.max_bytes
+        if over_budget:
+            self.sweep()
+        return photo_uuid
+
+    def get(self, photo_uuid, touch=True):
+        """
+        Запись фото или None. filepath - путь к полноразмерному рендеру
+        (None, если он еще не отрисован или файл пропал)
+        """
+        conn = self._conn()
+        if touch:
+            conn.execute("UPDATE photos SET last_access = ? WHERE uuid = ?", (time.time(), photo_uuid))
+        row = conn.execute(
+            "SELECT photos.image_url, photos.detections, photos.detection_index, photos.render, blobs.filename "
+            "FROM photos LEFT JOIN blobs ON blobs.hash = photos.blob WHERE photos.uuid = ?",
+            (photo_uuid,)
+        ).fetchone()
+        if row is None:
+            return None
+        image_url, detections, detection_index, render, filename = row
+        filepath = self._blob_path(filename) if filename else None
+        if filepath is not None and not os.path.exists(filepath):
+            filepath = None
+        return {
+            'filepath': filepath,
+            'image_url': image_url,
+            'detections': json.loads(detections),
+            'detection_index': detection_index,
+            'render': json.loads(render) if render else None
+        }
+
+    def set_render(self, photo_uuid, content, ext="jpg"):
+        """Сохраняет отложенно отрисованное фото; возвращает путь к файлу"""
+        with self._write() as conn:
+            blob_hash = self._put_blob(conn, content, ext)
+            conn.execute("UPDATE photos SET blob = ? WHERE uuid = ?", (blob_hash, photo_uuid))
+        return self._blob_path(f"{blob_hash}.{ext}")
+
+    def variant_path(self, photo_uuid, suffix):
+        """Путь к файлу варианта фото или None, если вариант еще не кодировался"""
+        row = self._conn().execute(
+            "SELECT blobs.filename FROM variants JOIN blobs ON blobs.hash = variants.blob "
+            "WHERE variants.uuid = ? AND variants.suffix = ?",
+            (photo_uuid, suffix)
+        ).fetchone()
+        if row is None:
+            return None
+        path = self._blob_path(row[0])
+        return path if os.path.exists(path) else None
+
+    def set_variant(self, photo_uuid, suffix, content, ext):
+        """Сохраняет закодированный вариант фото; возвращает путь к файлу"""
+        with self._write() as conn:
+            blob_hash = self._put_blob(conn, content, ext)
+            conn.execute(
+                "INSERT OR REPLACE INTO variants (uuid, suffix, blob) VALUES (?, ?, ?)",
+                (photo_uuid, suffix, blob_hash)
+            )
+        return self._blob_path(f"{blob_hash}.{ext}")
+
+    def sweep(self):
+        """Удаляет просроченные фото, затем вытесняет давние, пока объем больше лимита"""
+        expired = evicted = 0
+        with self._write() as conn:
+            if self.ttl_sec > 0:
+                for (photo_uuid,) in conn.execute(
+                    "SELECT uuid FROM photos WHERE last_access < ?", (time.time() - self.ttl_sec,)
+                ).fetchall():
+                    self._drop_photo(conn, photo_uuid)
+                    expired += 1
+            # Файлы, оставшиеся без ссылок (например, фото удалили во время отрисовки)
+            self._drop_unreferenced(conn)
+            total = self._total_bytes(conn)
+            if total > self.max_bytes:
+                for (photo_uuid,) in conn.execute(
+                    "SELECT uuid FROM photos WHERE blob IS NOT NULL ORDER BY last_access"
+                ).fetchall():
+                    total -= self._drop_photo(conn, photo_uuid)
+                    evicted += 1
+                    if total <= self.max_bytes:
+                        break
+        self.expired += expired
+        self.evictions += evicted
+        if expired or evicted:
+            logger.info(f"Render store sweep: expired {expired}, evicted {evicted}, {total / 2**20:.1f} MB kept")
+        return {"expired": expired, "evicted": evicted, "bytes": total}
+
+    def purge(self):
+        """Удаляет все фото и файлы хранилища; возвращает число удаленных файлов"""
+        deleted_count = 0
+        with self._write() as conn:
+            filenames = [row[0] for row in conn.execute("SELECT filename FROM blobs")]
+            conn.execute("DELETE FROM variants")
+            conn.execute("DELETE FROM photos")
+            conn.execute("DELETE FROM blobs")
+            for filename in filenames:
+                try:
+                    os.remove(self._blob_path(filename))
+                    deleted_count += 1
+                except FileNotFoundError:
+                    pass
+        return deleted_count
+
+    def start_sweeper(self):
+        """Фоновая очистка: сразу после старта и затем раз в sweep_sec секунд"""
+        if self._sweeper is not None or self.sweep_sec <= 0:
+            return
+
+        def loop():
+            while True:
+                try:
+                    self.sweep()
+                except Exception as e:
+                    logger.error(f"Render store sweep failed: {e}")
+                time.sleep(self.sweep_sec)
+
+        self._sweeper = threading.Thread(target=loop, name="render-store-sweeper", daemon=True)
+        self._sweeper.start()
+
+    def stats(self):
+        conn = self._conn()
+        photos, pending = conn.execute(
+            "SELECT COUNT(*), COALESCE(SUM(blob IS NULL), 0) FROM photos"
+        ).fetchone()
+        blobs, total = conn.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM blobs").fetchone()
+        return {
+            "photos": photos,
+            "pending_renders": pending,
+            "files": blobs,
+            "bytes_mb": round(total / 2**20, 1),
+            "budget_mb": round(self.max_bytes / 2**20, 1),
+            "ttl_sec": self.ttl_sec,
+            "expired": self.expired,
+            "evictions": self.evictions
+        }
+
+RENDER_STORE = RenderStore(
+    RENDER_STORE_DIR, RENDER_STORE_MAX_MB * 1024 * 1024, RENDER_STORE_TTL_SEC, RENDER_STORE_SWEEP_SEC
+)
+
+def save_photo(img_buffer, image_url, detections=None, detection_index=None):
+    """Сохраняет фото в хранилище и возвращает UUID"""
+    return RENDER_STORE.create(image_url, detections, detection_index, content=img_buffer.getvalue())
+
+# Замки отложенной отрисовки: одно превью рисуется одним потоком.
+# Ключ -> [замок, число потоков, которые держат или ждут его]
+_LAZY_RENDER_LOCKS = {}
+_LAZY_RENDER_LOCKS_GUARD = threading.Lock()
+
+@contextlib.contextmanager
+def _lazy_render_lock(key):
+    """Замок отрисовки по ключу; удаляется, только когда его больше никто не ждет"""
+    with _LAZY_RENDER_LOCKS_GUARD:
+        entry = _LAZY_RENDER_LOCKS.get(key)
+        if entry is None:
+            entry = _LAZY_RENDER_LOCKS[key] = [threading.Lock(), 0]
+        entry[1] += 1
+    try:
+        with entry[0]:
+            yield
+    finally:
+        with _LAZY_RENDER_LOCKS_GUARD:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del _LAZY_RENDER_LOCKS[key]
+
+def register_lazy_photo(image_url, detections, detection_index):
+    """
+    Регистрирует превью одного обнаружения без отрисовки и возвращает UUID.
+    Изображение рисуется при первом запросе /photo и дальше отдается из файла.
+    """
+    return RENDER_STORE.create(
+        image_url, detections, detection_index, render={'single_detection_index': 0}
+    )
+
+def _ensure_photo_rendered(photo_uuid, photo_info):
+    """Отрисовывает отложенное превью, если файла еще нет; возвращает путь к файлу"""
+    filepath = photo_info['filepath']
+    render = photo_info['render']
+    if filepath is not None or render is None:
+        return filepath
+    
+    with _lazy_render_lock(photo_uuid):
+        current = RENDER_STORE.get(photo_uuid, touch=False)
+        filepath = current['filepath'] if current is not None else None
+        if filepath is None:
+            # Ошибку загрузки исходника пробрасываем, чтобы не запомнить картинку-заглушку
+            base_image = download_image(photo_info['image_url'])
+            detection = photo_info['detections'][render['single_detection_index']]
+            img_buffer = encode_variant(render_single_detection(base_image, detection))
+            filepath = RENDER_STORE.set_render(photo_uuid, img_buffer.getvalue())
+    return filepath
+
+def _ensure_photo_variant(photo_uuid, photo_info, variant):
+    """
+    Путь к файлу варианта фото; вариант кодируется из полноразмерного файла
+    один раз и дальше отдается с диска
+    """
+    if variant == DEFAULT_OUTPUT_VARIANT:
+        return _ensure_photo_rendered(photo_uuid, photo_info)
+    
+    # Готовый вариант (например, сохраненный /show) отдается без отрисовки полноразмерного фото
+    suffix = variant_suffix(variant)
+    variant_path = RENDER_STORE.variant_path(photo_uuid, suffix)
+    if variant_path is not None:
+        return variant_path
+    
+    filepath = _ensure_photo_rendered(photo_uuid, photo_info)
+    with _lazy_render_lock(f"{photo_uuid}_{suffix}"):
+        variant_path = RENDER_STORE.variant_path(photo_uuid, suffix)
+        if variant_path is None:
+            with Image.open(filepath) as source:
+                img_buffer = encode_variant(source, variant)
+            variant_path = RENDER_STORE.set_variant(
+                photo_uuid, suffix, img_buffer.getvalue(), OUTPUT_FORMATS[variant['format']]['ext']
+            )
+    return variant_path
+
+def _mask_iou(mask_a, mask_b):
+    union = np.count_nonzero(mask_a | mask_b)
+    return round(np.count_nonzero(mask_a & mask_b) / union, 4) if union else 1.0
+
+def _bbox_iou(box_a, box_b):
+    """IoU двух bbox [x_min, y_min, x_max, y_max] с включительными границами"""
+    width = min(box_a[2], box_b[2]) - max(box_a[0], box_b[0]) + 1
+    height = min(box_a[3], box_b[3]) - max(box_a[1], box_b[1]) + 1
+    if width <= 0 or height <= 0:
+        return 0.0
+    area = lambda box: (box[2] - box[0] + 1) * (box[3] - box[1] + 1)
+    intersection = width * height
+    return intersection / (area(box_a) + area(box_b) - intersection)
+
+def backend_parity(method, images, backend):
+    """
+    Сравнивает бэкенд инференса с эталонным torch на тех же изображениях:
+    совпадение карт классов, IoU масок категорий и расхождения в найденных зданиях
+    """
+    model_config = _get_model_config(method)
+    reference = AdvancedUrbanSegmentator(model_config["model_name"], MODEL_CACHE_DIR, backend="torch")
+    candidate = AdvancedUrbanSegmentator(model_config["model_name"], MODEL_CACHE_DIR, backend=backend)
+    if candidate.backend != backend:
+        raise RuntimeError(f"Backend {backend} is not available for method {model_config['method']}")
+    
+    reports = []
+    for image in images:
+        outputs = {}
+        for name, segmentator in (("torch", reference), (backend, candidate)):
+            started = time.time()
+            semantic_map = segmentator.predict_semantic_maps([image])[0]
+            elapsed = time.time() - started
+            outputs[name] = (semantic_map, segmentator.postprocess_semantic_map(semantic_map), elapsed)
+        
+        (ref_map, ref, ref_sec), (cand_map, cand, cand_sec) = outputs["torch"], outputs[backend]
+        report = _semantic_map_parity(reference, ref_map, ref, candidate, cand_map, cand, ("torch", backend))
+        report["latency_sec"] = {"torch": round(ref_sec, 3), backend: round(cand_sec, 3)}
+        reports.append(report)
+    return {"method": model_config["method"], "backend": backend, "images": reports}
+
+def postprocess_parity(method, images, argmax_max_side=None):
+    """
+    Сравнивает argmax на промежуточном разрешении с argmax по логитам полного разрешения
+    на одном и том же прямом проходе: совпадение карт, IoU масок, здания, время и объем логитов
+    """
+    model_config = _get_model_config(method)
+    segmentator = MODEL_REGISTRY.get(model_config["method"])
+    argmax_max_side = ARGMAX_MAX_SIDE if argmax_max_side is None else argmax_max_side
+    if argmax_max_side <= 0:
+        raise ValueError("argmax_max_side must be positive")
+    
+    reports = []
+    for image in images:
+        image = _to_rgb_image(image)
+        target_size = image.size[::-1]
+        pixel_inputs = segmentator.preprocess_images([image])
+        inputs = dict(pixel_inputs)
+        inputs["task_inputs"] = segmentator.task_inputs(1)
+        if segmentator.onnx_session is not None:
+            outputs = segmentator._run_onnx(inputs)
+        else:
+            with torch.no_grad():
+                outputs = segmentator.model(**inputs)
+        
+        maps = {}
+        for name, side in (("full", 0), ("reduced", argmax_max_side)):
+            started = time.time()
+            semantic_map = segmentator._semantic_maps_from_outputs(
+                outputs, pixel_inputs.get("pixel_mask"), [target_size], side
+            )[0]
+            maps[name] = (semantic_map, segmentator.postprocess_semantic_map(semantic_map), time.time() - started)
+        
+        (ref_map, ref, ref_sec), (cand_map, cand, cand_sec) = maps["full"], maps["reduced"]
+        report = _semantic_map_parity(segmentator, ref_map, ref, segmentator, cand_map, cand, ("full", "reduced"))
+        num_classes = outputs.class_queries_logits.shape[-1] - 1
+        reduced_factor = min(1.0, argmax_max_side / max(target_size))
+        report["logits_mb"] = {
+            "full": round(num_classes * target_size[0] * target_size[1] * 4 / 2**20, 1),
+            "reduced": round(num_classes * target_size[0] * target_size[1] * reduced_factor ** 2 * 4 / 2**20, 1)
+        }
+        report["latency_sec"] = {"full": round(ref_sec, 3), "reduced": round(cand_sec, 3)}
+        reports.append(report)
+    return {"method": model_config["method"], "argmax_max_side": argmax_max_side, "images": reports}
+
+def _semantic_map_parity(reference, ref_map, ref, candidate, cand_map, cand, names):
+    """Совпадение двух карт классов: доля пикселей, IoU масок категорий, сопоставление зданий"""
+    ref_flags, cand_flags = reference.category_lut[ref_map], candidate.category_lut[cand_map]
+    
+    # Здания сопоставляются жадно по IoU bbox (порог 0.5)
+    unmatched = list(cand["buildings"].values())
+    matched_ious = []
+    for building in sorted(ref["buildings"].values(), key=lambda b: -b["area"]):
+        ious = [_bbox_iou(building["bbox"], other["bbox"]) for other in unmatched]
+        if ious and max(ious) >= 0.5:
+            matched_ious.append(max(ious))
+            unmatched.pop(int(np.argmax(ious)))
+    
+    ref_name, cand_name = names
+    return {
+        "pixel_agreement": round(float(np.mean(ref_map == cand_map)), 4),
+        "mask_iou": {
+            name: _mask_iou(reference.category_mask(ref_flags, name), candidate.category_mask(cand_flags, name))
+            for name in ("building", "road", "other")
+        },
+        "buildings": {
+            ref_name: len(ref["buildings"]),
+            cand_name: len(cand["buildings"]),
+            "delta": len(cand["buildings"]) - len(ref["buildings"]),
+            "matched": len(matched_ious),
+            "mean_bbox_iou": round(float(np.mean(matched_ious)), 4) if matched_ious else None
+        }
+    }
+
+def preprocess_parity(method, images):
+    """
+    Сравнивает быстрый препроцессинг с OneFormerProcessor на тех же изображениях:
+    расхождение тензоров входа, совпадение карт классов и время препроцессинга
+    """
+    model_config = _get_model_config(method)
+    segmentator = MODEL_REGISTRY.get(model_config["method"])
+    if not segmentator._fast_preprocess_supported():
+        raise RuntimeError(f"Fast preprocessing is not supported by the processor of method {model_config['method']}")
+    
+    reports = []
+    for image in images:
+        image = _to_rgb_image(image)
+        outputs = {}
+        for name, fast in (("processor", False), ("fast", True)):
+            started = time.time()
+            pixel_inputs = segmentator.preprocess_images([image], fast=fast)
+            elapsed = time.time() - started
+            semantic_map = segmentator.forward_semantic_maps(pixel_inputs, [image.size[::-1]])[0]
+            outputs[name] = (pixel_inputs, semantic_map, elapsed)
+        
+        (ref_inputs, ref_map, ref_sec), (fast_inputs, fast_map, fast_sec) = outputs["processor"], outputs["fast"]
+        if ref_inputs["pixel_values"].shape != fast_inputs["pixel_values"].shape:
+            reports.append({
+                "shape_mismatch": [list(ref_inputs["pixel_values"].shape), list(fast_inputs["pixel_values"].shape)]
+            })
+            continue
+        difference = (ref_inputs["pixel_values"] - fast_inputs["pixel_values"]).abs()
+        reports.append({
+            "input_shape": list(fast_inputs["pixel_values"].shape),
+            "max_abs_diff": round(float(difference.max()), 4),
+            "mean_abs_diff": round(float(difference.mean()), 5),
+            "pixel_mask_equal": bool(torch.equal(ref_inputs["pixel_mask"].long(), fast_inputs["pixel_mask"])),
+            "pixel_agreement": round(float(np.mean(ref_map == fast_map)), 4),
+            "latency_sec": {"processor": round(ref_sec, 4), "fast": round(fast_sec, 4)}
+        })
+    return {"method": model_config["method"], "images": reports}
+
+class BatchPipeline:
+    """
+    Конвейер /detect_batch: загрузка -> детекция (декодирование и инференс) -> отрисовка,
+    кодирование и сохранение фото.
+
+    У каждой стадии свой пул потоков; изображение переходит на следующую стадию, как только
+    готово на предыдущей, поэтому загрузка одних изображений, инференс других и отрисовка
+    третьих идут одновременно. Между стадиями одновременно не больше depth изображений
+    пакета - это ограничивает очереди стадий и память. Результаты отдаются в исходном
+    порядке; повторы изображения с теми же координатами детектируются один раз.
+    Результат детекции (с полноразмерными масками) держится, только пока не отрисован
+    последний повтор его изображения.
+    """
+
+    def __init__(self, fetch_workers, detect_workers, render_workers, depth):
+        self.fetch_workers = max(1, fetch_workers)
+        self.detect_workers = max(1, detect_workers)
+        self.render_workers = max(1, render_workers)
+        self.depth = max(1, depth)
+
+    def run(self, images, method, seed, auto_policy=None):
+        """Генератор результатов _batch_image_result в порядке images"""
+        pools = {
+            "fetch": ThreadPoolExecutor(self.fetch_workers, thread_name_prefix="batch-fetch"),
+            "detect": ThreadPoolExecutor(self.detect_workers, thread_name_prefix="batch-detect"),
+            "render": ThreadPoolExecutor(self.render_workers, thread_name_prefix="batch-render")
+        }
+        images = list(images)
+        detections = {}
+        # Сколько еще отрисовок ждет каждый результат детекции
+        references = {}
+        for img_data in images:
+            key = (img_data['image_url'], img_data.get('lat'), img_data.get('lon'))
+            references[key] = references.get(key, 0) + 1
+        lock = threading.Lock()
+
+        def release(key, done):
+            """После последней отрисовки результат и его маски больше не удерживаются"""
+            with lock:
+                references[key] -= 1
+                if references[key]:
+                    return
+                del references[key]
+                detections.pop(key, None)
+            try:
+                results = done.result()
+            except Exception:
+                return
+            results.pop("road_mask", None)
+            results.pop("other_mask", None)
+
+        def render(key, done):
+            try:
+                return _batch_image_result(key[0], _detection_or_error(done), method, seed)
+            finally:
+                release(key, done)
+
+        def start(img_data):
+            image_url, lat, lon = key = img_data['image_url'], img_data.get('lat'), img_data.get('lon')
+            with lock:
+                detection = detections.get(key)
+                created = detection is None
+                if created:
+                    detection = detections[key] = Future()
+            if created:
+                fetched = Future()
+                _pipeline_stage(pools["fetch"], fetched, _prefetch_image, image_url)
+                # Своя копия результата: маски из нее убираются, не затрагивая других получателей
+                fetched.add_done_callback(lambda _: _pipeline_stage(
+                    pools["detect"], detection,
+                    lambda: dict(detect_objects(image_url, lat, lon, method, seed, auto_policy))
+                ))
+            result = Future()
+            detection.add_done_callback(lambda done: _pipeline_stage(pools["render"], result, render, key, done))
+            return result
+
+        pending = deque()
+        try:
+            for img_data in images:
+                pending.append(start(img_data))
+                if len(pending) >= self.depth:
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
+        finally:
+            for pool in pools.values():
+                pool.shutdown(wait=False, cancel_futures=True)
+
+BATCH_PIPELINE = BatchPipeline(BATCH_FETCH_WORKERS, BATCH_DETECT_WINDOW, BATCH_RENDER_WORKERS, BATCH_PIPELINE_DEPTH)
+
+def _pipeline_stage(pool, target, fn, *args):
+    """Запускает fn в пуле стадии; результат или исключение переходит в Future target"""
+    def run():
+        try:
+            target.set_result(fn(*args))
+        except Exception as e:
+            target.set_exception(e)
+    try:
+        pool.submit(run)
+    except RuntimeError as e:
+        # Пакет прерван, пулы стадий уже остановлены
+        target.set_exception(e)
+
+def _with_image_urls(images):
+    """
+    Элементы пакета с каноническим image_url (из image_url, photo_uuid или path);
+    элементы без источника отбрасываются, недопустимый path или photo_uuid - ValueError
+    """
+    resolved = []
+    for img_data in images:
+        image_url = UPLOADS.image_url(img_data)
+        if image_url:
+            resolved.append(dict(img_data, image_url=image_url))
+    return resolved
+
+def _body_images():
+    """
+    Изображения из тела запроса: [(байты, имя файла)] - все файлы multipart по порядку
+    или одно изображение телом запроса (image/* или application/octet-stream);
+    None - изображений в теле нет
+    """
+    if request.mimetype == "multipart/form-data":
+        return [(storage.stream.getvalue(), storage.filename) for _, storage in request.files.items(multi=True)]
+    if request.mimetype.startswith("image/") or request.mimetype == "application/octet-stream":
+        return [(request.get_data(cache=False), None)]
+    return None
+
+def _prefetch_image(image_url):
+    """Стадия загрузки: байты попадают в кэш загрузок; ошибку обработает стадия детекции"""
+    try:
+        IMAGE_CACHE.get_bytes(image_url)
+    except Exception as e:
+        logger.warning(f"Не удалось загрузить {image_url}: {e}")
+
+def _detection_or_error(future):
+    """Результат детекции; отказ по бюджету памяти и сбои - ошибка только этого изображения"""
+    try:
+        return future.result()
+    except MemoryBudgetExceeded as e:
+        return {"error": str(e)}
+    except Exception as e:
+        logger.error(f"Ошибка детекции в пакете: {e}")
+        return {"error": str(e)}
 
-def _calculate_object_coordinates(center_lat, center_lon, centroid, image_size, area):
-    """Рассчитывает координаты объекта на основе его положения в изображении"""
-    centroid_x, centroid_y = centroid
-    img_width, img_height = image_size
-    
-    if center_lat is None or center_lon is None:
-        return None, None
-    
-    # Нормализуем позицию относительно центра изображения
-    norm_x = (centroid_x - img_width/2) / img_width
-    norm_y = (centroid_y - img_height/2) / img_height
-    
-    # Масштабируем смещение в зависимости от площади объекта
-    area_factor = min(area / 10000, 1.0)
-    
-    # Рассчитываем смещение в градусах
-    offset_deg = 0.001 * area_factor
-    
-    obj_lat = float(center_lat) + norm_y * offset_deg
-    obj_lon = float(center_lon) + norm_x * offset_deg
-    
-    return round(obj_lat, 6), round(obj_lon, 6)
+def _batch_error_result(image_url, error):
+    return {
+        'original_image_url': image_url,
+        'error': error,
+        'detection_count': 0,
+        'detections': []
+    }
 
-def apply_masks(image, road_mask, other_mask):
-    """Накладывает маски на изображение"""
-    if image.mode != 'RGBA':
-        image = image.convert('RGBA')
-    
-    # Создаем изображение для масок
-    mask_overlay = Image.new('RGBA', image.size, (0, 0, 0, 0))
-    
-    if road_mask is not None and np.sum(road_mask) > 0:
-        # Синяя маска для дорог (альфа = 90)
-        road_mask_img = Image.fromarray((road_mask * 255).astype(np.uint8), mode='L')
-        red_overlay = Image.new('RGBA', image.size, (0, 0, 255, 90))
-        mask_overlay = Image.composite(red_overlay, mask_overlay, road_mask_img)
-    
-    if other_mask is not None and np.sum(other_mask) > 0:
-        # Осветляющая маска для остальных объектов (альфа = 250)
-        other_mask_img = Image.fromarray((other_mask * 255).astype(np.uint8), mode='L')
-        gray_overlay = Image.new('RGBA', image.size, (255, 255, 255, 192))
-        mask_overlay = Image.composite(gray_overlay, mask_overlay, other_mask_img)
-    
-    # Накладываем маски на исходное изображение
-    result = Image.alpha_composite(image, mask_overlay)
-    return result
-    
-def draw_detections(image_url, detections, method, seed, single_detection_index=None, road_mask=None, other_mask=None):
+def _batch_image_result(image_url, detection_results, method, seed):
     """
-    Отрисовывает обнаружения на изображении
-    
-    Args:
-        image_url: URL изображения
-        detections: список обнаружений [id, method, bbox, confidence, lat, lon]
-        method: метод детекции
-        seed: seed
-        single_detection_index: индекс одиночного bbox (None - все bbox)
-        road_mask: маска дорог
-        other_mask: маска других объектов
-    
-    Returns:
-        tuple: (img_buffer, photo_urls)
+    Результат одного изображения пакета: основное фото со всеми bbox и масками
+    и ссылки на превью отдельных обнаружений
     """
+    if detection_results.get("error"):
+        return _batch_error_result(image_url, detection_results["error"])
     try:
-        # Палитра цветов для bbox (циклическое использование)
-        COLOR_PALETTE = [
-            (255, 105, 180),  # розовый
-            (119, 11, 32),    # бордовый
-            (0, 0, 142),      # темно-синий
-            (0, 0, 230),      # синий
-            (106, 0, 228),    # фиолетовый
-            (0, 60, 100),     # темно-бирюзовый
-            (0, 80, 100),     # бирюзовый
-            (0, 0, 70),       # очень темно-синий
-            (0, 0, 192),      # ярко-синий
-            (250, 170, 30)    # оранжевый
-        ]
-        
-        # Загружаем изображение
-        image = download_image(image_url)
-        width, height = image.size
+        detections = detection_results.get("detections", [])
         
-        # Накладываем маски если они предоставлены
-        if road_mask is not None or other_mask is not None:
-            image = apply_masks(image, road_mask, other_mask)
-        
-        # Создаем контекст для рисования
-        draw = ImageDraw.Draw(image)
+        # Отрисовываем основное изображение со всеми bbox и масками
+        img_buffer_all, _ = draw_detections(
+            image_url, 
+            detections, 
+            method, 
+            seed,
+            road_mask=detection_results.get("road_mask"),
+            other_mask=detection_results.get("other_mask")
+        )
+        main_uuid = save_photo(img_buffer_all, image_url, detections)
         
-        # Шрифт
-        font = None
-        try:
-            font = ImageFont.truetype("arial.ttf", 11)
-        except:
-            try:
-                font = ImageFont.load_default()
-            except:
-                pass
+        # Отдельные фото для каждого bbox (без масок) рисуются лениво при первом запросе /photo;
+        # изображение из тела запроса после ответа недоступно, поэтому его превью рисуются сразу
+        base_image = download_image(image_url) if image_url.startswith(ImageFetchCache.INLINE_SCHEME) else None
+        single_photos = []
+        for j, detection in enumerate(detections):
+            if base_image is not None:
+                single_uuid = save_photo(
+                    encode_variant(render_single_detection(base_image, detection)), image_url, [detection], j
+                )
+            else:
+                single_uuid = register_lazy_photo(image_url, [detection], j)
+            
+            id_val, method_val, bbox, confidence, obj_lat, obj_lon = detection
+            single_photos.append({
+                'photo_url': f"{BASE_URL}/photo?uuid={single_uuid}",
+                'bbox': bbox,
+                'lat': obj_lat,        # Плоская структура
+                'lon': obj_lon,        # Плоская структура
+                'confidence': confidence
+            })
         
-        photo_urls = []
+        # Формируем результат (плоская структура)
+        result_detections = []
+        for j, detection in enumerate(detections):
+            id_val, method_val, bbox, confidence, obj_lat, obj_lon = detection
+            result_detections.append({
+                'id': id_val,
+                'method': method_val,
+                'bbox': bbox,
+                'confidence': confidence,
+                'lat': obj_lat,        # Прямо здесь
+                'lon': obj_lon,        # Прямо здесь
+                'single_photo_url': single_photos[j]['photo_url']
+            })
         
-        # Определяем режим отрисовки
-        draw_single = single_detection_index is not None
+        result = {
+            'original_image_url': image_url,
+            'processed_image_url': f"{BASE_URL}/photo?uuid={main_uuid}",
+            'detection_count': len(detections),
+            'method': method,
+            'detections': result_detections
+        }
+        if detection_results.get("category_stats"):
+            result['category_stats'] = detection_results["category_stats"]
+        if detection_results.get("auto_select"):
+            result['auto_select'] = detection_results["auto_select"]
+        if detection_results.get("label_map_id"):
+            result['label_map_id'] = detection_results["label_map_id"]
+        if detection_results.get("memory"):
+            result['memory'] = detection_results["memory"]
+        return result
         
-        if not draw_single:
-            # Режим "все bbox"
-            for i, detection in enumerate(detections):
-                id_val, method_val, bbox, confidence, obj_lat, obj_lon = detection
-                
-                # Получаем цвет по id (циклически из палитры)
-                color = COLOR_PALETTE[i % len(COLOR_PALETTE)]
-                
-                # Конвертируем x,y,w,h в x1,y1,x2,y2 для отрисовки
-                x1 = bbox['x']
-                y1 = bbox['y']
-                x2 = bbox['x'] + bbox['w']
-                y2 = bbox['y'] + bbox['h']
-                
-                # Рисуем bbox (УВЕЛИЧИЛ толщину рамки с 1 до 3)
-                draw.rectangle([x1, y1, x2, y2], 
-                             outline=color, width=3)  # Было width=1
-                
-                # Подписываем bbox с confidence (формат: "id1 .87")
-                label = f"{id_val} .{int(confidence * 100):02d}"
-                label_bg_width = 45
-                label_bg_height = 14
-                
-                # Фон для подписи (полупрозрачный)
-                label_bg = Image.new('RGBA', (label_bg_width, label_bg_height), color + (180,))
-                image.paste(label_bg, (x1 + 1, y1 + 1), label_bg)
-                
-                # Текст подписи
-                draw.text((x1 + 3, y1 + 1), 
-                         label, fill=(255, 255, 255), font=font)
-                
-                # Координаты объекта
-                if obj_lat and obj_lon:
-                    coord_text1 = f"{obj_lat:.5f}"
-                    coord_text2 = f"{obj_lon:.5f}"
-                    
-                    coord_bg_x = x1 + 1
-                    coord_bg_y = y1 + label_bg_height + 1
-                    # ШИРЕ фон для координат - учитываем полную длину чисел
-                    coord_bg_width = max(len(coord_text1), len(coord_text2)) * 6 + 8
-                    coord_bg_height = 24
-                    
-                    if (coord_bg_y + coord_bg_height < y2 and 
-                        coord_bg_x + coord_bg_width < x2):
-                        # Полупрозрачный белый фон для координат
-                        coord_bg = Image.new('RGBA', (coord_bg_width, coord_bg_height), (255, 255, 255, 180))
-                        image.paste(coord_bg, (coord_bg_x, coord_bg_y), coord_bg)
-                        
-                        # Текст координат
-                        draw.text((coord_bg_x + 4, coord_bg_y + 2), coord_text1, 
-                                 fill=(0, 0, 0), font=font)
-                        draw.text((coord_bg_x + 4, coord_bg_y + 12), coord_text2, 
-                                 fill=(0, 0, 0), font=font)
-            
-            # Информационная строка с seed (полупрозрачный фон) - ТОЛЬКО ДЛЯ РЕЖИМА ВСЕХ BBOX
-            info_bg_height = 20
-            info_bg = Image.new('RGBA', (width, info_bg_height), (0, 0, 0, 180))
-            image.paste(info_bg, (0, height - info_bg_height), info_bg)
-            
-            info_text = f"Detections: {len(detections)} | Method: {method} | Seed: {seed}"
-            draw.text((10, height - info_bg_height + 3), info_text, fill=(255, 255, 255), font=font)
-            
-        else:
-            # Режим "один bbox" - БЕЗ СТАТУСНОЙ СТРОКИ
-            if single_detection_index < len(detections):
-                detection = detections[single_detection_index]
-                id_val, method_val, bbox, confidence, obj_lat, obj_lon = detection
-                
-                # Для одиночного bbox всегда используем розовый цвет
-                pink_color = (255, 105, 180)
-                
-                # Конвертируем x,y,w,h в x1,y1,x2,y2 для отрисовки
-                x1 = bbox['x']
-                y1 = bbox['y']
-                x2 = bbox['x'] + bbox['w']
-                y2 = bbox['y'] + bbox['h']
-                
-                # Рисуем bbox (УВЕЛИЧИЛ толщину рамки с 2 до 4)
-                draw.rectangle([x1, y1, x2, y2], 
-                             outline=pink_color, width=4)  # Было width=2
-                
-                # Подписываем bbox с confidence (формат: "id1 .87")
-                label = f"{id_val} .{int(confidence * 100):02d}"
-                label_bg_width = 45
-                label_bg_height = 14
+    except Exception as e:
+        logger.error(f"Error processing image {image_url}: {e}")
+        return _batch_error_result(image_url, str(e))
+
+class DetectionJob:
+    """
+    Асинхронная задача детекции по списку изображений.
+
+    Результаты складываются в events в порядке готовности (у каждого есть index -
+    позиция изображения в запросе и seq - номер события), подписчики ждут новые
+    события на условной переменной.
+    """
+
+    FINISHED = ("done", "cancelled", "failed")
+
+    def __init__(self, images, method, seed, auto_policy, image_timeout):
+        self.id = str(uuid.uuid4())
+        self.images = images
+        self.method = method
+        self.seed = seed
+        self.auto_policy = auto_policy
+        self.image_timeout = image_timeout
+        self.status = "queued"
+        self.error = None
+        self.events = []
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self.cancel_event = threading.Event()
+        self._cond = threading.Condition()
+
+    @property
+    def finished(self):
+        return self.status in self.FINISHED
+
+    def emit(self, index, result):
+        with self._cond:
+            self.events.append({"event": "result", "seq": len(self.events), "index": index, "result": result})
+            self._cond.notify_all()
+
+    def finish(self, status, error=None):
+        with self._cond:
+            self.status = status
+            self.error = error
+            self.finished_at = time.time()
+            self._cond.notify_all()
+
+    def wait_events(self, offset, timeout):
+        """События начиная с offset (ждет до timeout секунд) и признак завершения задачи"""
+        with self._cond:
+            self._cond.wait_for(lambda: len(self.events) > offset or self.finished, timeout)
+            return self.events[offset:], self.finished
+
+    def summary(self):
+        with self._cond:
+            failed = sum(1 for event in self.events if "error" in event["result"])
+            return {
+                "job_id": self.id,
+                "status": self.status,
+                "error": self.error,
+                "method": self.method,
+                "seed": self.seed,
+                "total": len(self.images),
+                "completed": len(self.events),
+                "failed": failed,
+                "created_at": self.created_at,
+                "started_at": self.started_at,
+                "finished_at": self.finished_at
+            }
+
+class JobManager:
+    """
+    Очередь асинхронных задач детекции: не больше max_concurrent задач одновременно,
+    внутри задачи изображения идут окном BATCH_DETECT_WINDOW с таймаутом на каждое.
+    Завершенные задачи хранятся retention_sec секунд.
+    """
+
+    def __init__(self, max_concurrent, retention_sec):
+        self.retention_sec = retention_sec
+        self._jobs = {}
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=max(1, max_concurrent), thread_name_prefix="detect-job")
+
+    def _purge_locked(self):
+        expire_before = time.time() - self.retention_sec
+        for job_id, job in list(self._jobs.items()):
+            if job.finished and job.finished_at < expire_before:
+                del self._jobs[job_id]
+
+    def submit(self, images, method, seed, auto_policy, image_timeout):
+        job = DetectionJob(images, method, seed, auto_policy, image_timeout)
+        with self._lock:
+            self._purge_locked()
+            self._jobs[job.id] = job
+        self._executor.submit(self._run, job)
+        return job
+
+    def get(self, job_id):
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def cancel(self, job_id):
+        job = self.get(job_id)
+        if job is not None and not job.finished:
+            job.cancel_event.set()
+            if job.status == "queued":
+                job.finish("cancelled")
+        return job
+
+    def _run(self, job):
+        if job.cancel_event.is_set():
+            if not job.finished:
+                job.finish("cancelled")
+            return
+        job.status = "running"
+        job.started_at = time.time()
+        try:
+            self._process(job)
+        except Exception as e:
+            logger.error(f"Job {job.id} failed: {e}")
+            job.finish("failed", str(e))
+            return
+        job.finish("cancelled" if job.cancel_event.is_set() else "done")
+
+    def _process(self, job):
+        images = job.images
+        window = max(1, BATCH_DETECT_WINDOW)
+        # Отрисовка - в своих потоках (как стадия отрисовки BATCH_PIPELINE), не в цикле задачи
+        render_pool = ThreadPoolExecutor(BATCH_PIPELINE.render_workers, thread_name_prefix=f"job-{job.id[:8]}-render")
+        # Детекция -> (индекс, дедлайн); дедлайн ставится при запуске - поток стартует сразу
+        pending = {}
+        rendered = []
+        next_index = 0
+        try:
+            while next_index < len(images) or pending:
+                if job.cancel_event.is_set():
+                    break
+                while next_index < len(images) and len(pending) < window:
+                    pending[self._start_detection(job, images[next_index])] = (
+                        next_index, time.monotonic() + job.image_timeout
+                    )
+                    next_index += 1
                 
-                # Полупрозрачный розовый фон для подписи
-                label_bg = Image.new('RGBA', (label_bg_width, label_bg_height), pink_color + (180,))
-                image.paste(label_bg, (x1 + 1, y1 + 1), label_bg)
+                # Ждем до ближайшего дедлайна, но не дольше секунды - чтобы заметить отмену
+                now = time.monotonic()
+                timeout = min([1.0] + [max(0.0, deadline - now) for _, deadline in pending.values()])
+                done, _ = wait(pending, timeout=timeout, return_when=FIRST_COMPLETED)
                 
-                draw.text((x1 + 3, y1 + 1), 
-                         label, fill=(255, 255, 255), font=font)
+                for future in done:
+                    index, _ = pending.pop(future)
+                    rendered.append(self._render(job, render_pool, index, future))
                 
-                # Координаты объекта
-                if obj_lat and obj_lon:
-                    coord_text1 = f"{obj_lat:.5f}"
-                    coord_text2 = f"{obj_lon:.5f}"
-                    
-                    coord_bg_x = x1 + 1
-                    coord_bg_y = y1 + label_bg_height + 1
-                    # ШИРЕ фон для координат - учитываем полную длину чисел
-                    coord_bg_width = max(len(coord_text1), len(coord_text2)) * 7 + 10  # Было *5+6
-                    coord_bg_height = 22
-                    
-                    if (coord_bg_y + coord_bg_height < y2 and 
-                        coord_bg_x + coord_bg_width < x2):
-                        # Полупрозрачный белый фон для координат
-                        coord_bg = Image.new('RGBA', (coord_bg_width, coord_bg_height), (255, 255, 255, 180))
-                        image.paste(coord_bg, (coord_bg_x, coord_bg_y), coord_bg)
-                        
-                        # Текст координат
-                        draw.text((coord_bg_x + 4, coord_bg_y + 2), coord_text1, 
-                                 fill=(0, 0, 0), font=font)
-                        draw.text((coord_bg_x + 4, coord_bg_y + 12), coord_text2, 
-                                 fill=(0, 0, 0), font=font)
-        
-        # Конвертируем обратно в RGB для сохранения как JPEG
-        if image.mode == 'RGBA':
-            image = image.convert('RGB')
-            
-        img_buffer = io.BytesIO()
-        image.save(img_buffer, 'JPEG', quality=90)
-        img_buffer.seek(0)
+                now = time.monotonic()
+                for future, (index, deadline) in list(pending.items()):
+                    if now > deadline:
+                        # Поток детекции не прерывается, но слот окна освобождается: зависшая
+                        # детекция не уменьшает окно для остальных изображений задачи
+                        del pending[future]
+                        logger.warning(f"Job {job.id}: image {index} timed out after {job.image_timeout} s")
+                        job.emit(index, _batch_error_result(
+                            images[index]['image_url'], f"Timed out after {job.image_timeout} s"
+                        ))
+            # Уже готовые детекции дорисовываются и попадают в результаты даже при отмене
+            wait(rendered)
+        finally:
+            render_pool.shutdown(wait=False)
+
+    @staticmethod
+    def _start_detection(job, img_data):
+        """Детекция одного изображения в отдельном потоке; возвращает Future"""
+        future = Future()
+
+        def run():
+            try:
+                future.set_result(detect_objects(
+                    img_data['image_url'], img_data.get('lat'), img_data.get('lon'),
+                    job.method, job.seed, job.auto_policy
+                ))
+            except Exception as e:
+                future.set_exception(e)
+
+        threading.Thread(target=run, name=f"job-{job.id[:8]}-detect", daemon=True).start()
+        return future
+
+    @staticmethod
+    def _render(job, render_pool, index, detection):
+        """Отрисовка готовой детекции в пуле отрисовки; результат уходит в задачу по готовности"""
+        image_url = job.images[index]['image_url']
+
+        def render():
+            try:
+                result = _batch_image_result(image_url, _detection_or_error(detection), job.method, job.seed)
+            except Exception as e:
+                result = _batch_error_result(image_url, str(e))
+            job.emit(index, result)
+
+        return render_pool.submit(render)
+
+JOB_MANAGER = JobManager(JOBS_MAX_CONCURRENT, JOB_RETENTION_SEC)
+
+def _job_stream(job, offset, sse):
+    """Поток событий задачи: NDJSON (по строке на событие) или Server-Sent Events"""
+    def render(event):
+        if sse:
+            event_id = f"id: {event['seq']}\n" if "seq" in event else ""
+            return f"{event_id}event: {event['event']}\ndata: {json.dumps(event, ensure_ascii=False)}\n\n"
+        return json.dumps(event, ensure_ascii=False) + "\n"
+
+    while True:
+        events, finished = job.wait_events(offset, JOB_STREAM_HEARTBEAT_SEC)
+        for event in events:
+            yield render(event)
+        offset += len(events)
+        if finished and not events:
+            yield render({"event": "done", **job.summary()})
+            return
+        if not events and not finished:
+            yield ": keepalive\n\n" if sse else render({"event": "heartbeat"})
+
+# Счетчик одновременных запросов детекции (не больше MAX_INFLIGHT_REQUESTS)
+_REQUESTS_LOCK = threading.Lock()
+_requests_in_flight = 0
+
+def _busy_response(retry_after):
+    """Ответ 429: сервис перегружен, повторить через retry_after секунд"""
+    response = jsonify({"success": False, "error": "Service is busy, retry later", "retry_after": retry_after})
+    response.status_code = 429
+    response.headers['Retry-After'] = str(retry_after)
+    return response
+
+def _limit_inflight(view):
+    """Отклоняет запрос с 429, если заняты все слоты одновременных запросов"""
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        global _requests_in_flight
+        with _REQUESTS_LOCK:
+            admitted = MAX_INFLIGHT_REQUESTS <= 0 or _requests_in_flight < MAX_INFLIGHT_REQUESTS
+            if admitted:
+                _requests_in_flight += 1
+        if not admitted:
+            return _busy_response(INFERENCE_POOL.retry_after() if INFERENCE_POOL is not None else RETRY_AFTER_SEC)
+        try:
+            return view(*args, **kwargs)
+        finally:
+            with _REQUESTS_LOCK:
+                _requests_in_flight -= 1
+    return wrapper
+
+def _without_inference_pool(view):
+    """
+    Диагностика, загружающая модели в этом процессе: при включенном пуле инференса - 409,
+    чтобы процесс API не держал полные копии моделей рядом с воркерами
+    """
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        if INFERENCE_POOL is not None:
+            return jsonify({
+                "success": False,
+                "error": "Parity checks load models in the API process; run them with INFERENCE_WORKERS=0"
+            }), 409
+        return view(*args, **kwargs)
+    return wrapper
+
+@app.route('/health', methods=['GET'])
+def health():
+    return jsonify({"status": "healthy", "service": "calc-service"})
+
+@app.route('/models', methods=['GET'])
+def models_status():
+    """Список загруженных в память моделей и занимаемый ими объем (по воркерам, если есть пул)"""
+    if INFERENCE_POOL is not None:
+        return jsonify({"success": True, "workers": INFERENCE_POOL.control("stats")})
+    return jsonify({"success": True, **MODEL_REGISTRY.stats()})
+
+@app.route('/stats', methods=['GET'])
+def service_stats():
+    """
+    Сводная статистика сервиса: модели в памяти, планировщик батчей, кэш загрузок,
+    чтения с тома загрузок, хранилище фото, пул инференса и занятые слоты запросов
+    """
+    return jsonify({
+        "success": True,
+        "models": MODEL_REGISTRY.stats(),
+        "scheduler": INFERENCE_SCHEDULER.stats(),
+        "image_cache": IMAGE_CACHE.stats(),
+        "uploads": UPLOADS.stats(),
+        "render_store": RENDER_STORE.stats(),
+        "result_cache": RESULT_CACHE.stats() if RESULT_CACHE is not None else None,
+        "label_maps": LABEL_MAPS.stats() if LABEL_MAPS is not None else None,
+        "single_flight": DETECTION_FLIGHTS.stats(),
+        "memory": MEMORY_GUARD.stats(),
+        "inference_pool": INFERENCE_POOL.stats() if INFERENCE_POOL is not None else None,
+        "requests": {
+            "max_in_flight": MAX_INFLIGHT_REQUESTS,
+            "in_flight": _requests_in_flight
+        }
+    })
+
+@app.route('/models/unload', methods=['POST'])
+def models_unload():
+    """Выгружает модель (method в JSON) или все модели из памяти"""
+    data = request.get_json(silent=True) or {}
+    method = data.get('method')
+    method = int(method) if method is not None else None
+    if INFERENCE_POOL is not None:
+        return jsonify({"success": True, "workers": INFERENCE_POOL.control("unload", method)})
+    unloaded = MODEL_REGISTRY.unload(method)
+    return jsonify({"success": True, "unloaded": unloaded, **MODEL_REGISTRY.stats()})
+
+@app.route('/models/parity', methods=['POST'])
+@_without_inference_pool
+def models_parity():
+    """
+    Проверка бэкенда инференса против torch: JSON {method, backend, image_urls}.
+    Обе модели загружаются в этом процессе на время проверки.
+    """
+    try:
+        data = request.get_json(silent=True) or {}
+        method = int(data.get('method', 1))
+        backend = data.get('backend') or _get_model_config(method)["backend"]
+        image_urls = data.get('image_urls') or ([data['image_url']] if data.get('image_url') else [])
         
-        return img_buffer, photo_urls
+        if backend not in INFERENCE_BACKEND_CHOICES or backend == "torch":
+            return jsonify({"success": False, "error": "backend must be one of ['onnx', 'onnx-int8']"}), 400
+        if not image_urls:
+            return jsonify({"success": False, "error": "image_urls is required"}), 400
         
-    except Exception as e:
-        logger.error(f"Error in draw_detections: {e}")
-        width, height = 800, 600
-        image = Image.new('RGB', (width, height), color=(240, 240, 240))
-        draw = ImageDraw.Draw(image)
-        draw.text((50, 50), f"Error: {str(e)}", fill=(255, 0, 0))
+        images = [download_image(image_url) for image_url in image_urls]
+        return jsonify({"success": True, **backend_parity(method, images, backend)})
         
-        img_buffer = io.BytesIO()
-        image.save(img_buffer, 'JPEG', quality=85)
-        img_buffer.seek(0)
+    except Exception as e:
+        logger.error(f"Error in models_parity: {e}")
+        return jsonify({"success": False, "error": str(e)}), 500
+
+@app.route('/models/postprocess_parity', methods=['POST'])
+@_without_inference_pool
+def models_postprocess_parity():
+    """
+    Диагностика: argmax на промежуточном разрешении против логитов полного разрешения
+    на реальной модели, JSON {method, image_urls, argmax_max_side}. Обрезка паддинга и
+    масштабирование карты проверяются тестами tests/test_postprocess.py
+    """
+    try:
+        data = request.get_json(silent=True) or {}
+        method = int(data.get('method', 1))
+        argmax_max_side = data.get('argmax_max_side')
+        image_urls = data.get('image_urls') or ([data['image_url']] if data.get('image_url') else [])
+        if not image_urls:
+            return jsonify({"success": False, "error": "image_urls is required"}), 400
         
-        return img_buffer, []
+        images = [download_image(image_url) for image_url in image_urls]
+        try:
+            report = postprocess_parity(method, images, int(argmax_max_side) if argmax_max_side is not None else None)
+        except ValueError as e:
+            return jsonify({"success": False, "error": str(e)}), 400
+        return jsonify({"success": True, **report})
         
-def save_photo(img_buffer, image_url, detections=None, detection_index=None):
-    """Сохраняет фото в хранилище и возвращает UUID"""
-    photo_uuid = str(uuid.uuid4())
-    filename = f"{photo_uuid}.jpg"
-    filepath = os.path.join(UPLOAD_DIR, filename)
-    
-    with open(filepath, 'wb') as f:
-        f.write(img_buffer.getvalue())
-    
-    PHOTO_STORAGE[photo_uuid] = {
-        'filepath': filepath,
-        'image_url': image_url,
-        'detections': detections,
-        'detection_index': detection_index
-    }
-    
-    return photo_uuid
+    except Exception as e:
+        logger.error(f"Error in models_postprocess_parity: {e}")
+        return jsonify({"success": False, "error": str(e)}), 500
 
-@app.route('/health', methods=['GET'])
-def health():
-    return jsonify({"status": "healthy", "service": "calc-service"})
+@app.route('/models/preprocess_parity', methods=['POST'])
+@_without_inference_pool
+def models_preprocess_parity():
+    """
+    Диагностика: быстрый препроцессинг против OneFormerProcessor на реальной модели,
+    JSON {method, image_urls}. Формулы проверяются тестами tests/test_preprocess.py
+    """
+    try:
+        data = request.get_json(silent=True) or {}
+        method = int(data.get('method', 1))
+        image_urls = data.get('image_urls') or ([data['image_url']] if data.get('image_url') else [])
+        if not image_urls:
+            return jsonify({"success": False, "error": "image_urls is required"}), 400
+        
+        images = [download_image(image_url) for image_url in image_urls]
+        return jsonify({"success": True, **preprocess_parity(method, images)})
+        
+    except Exception as e:
+        logger.error(f"Error in models_preprocess_parity: {e}")
+        return jsonify({"success": False, "error": str(e)}), 500
 
-@app.route('/detect', methods=['GET'])
+@app.route('/detect', methods=['GET', 'POST'])
+@_limit_inflight
 def detect_objects_endpoint():
+    """
+    Детекция на одном изображении: image_url / photo_uuid / path в строке запроса (GET)
+    или само изображение в POST - телом запроса либо первым файлом multipart
+    """
+    inline_key = None
     try:
-        image_url = request.args.get('image_url')
-        lat = request.args.get('lat')
-        lon = request.args.get('lon')
-        method = request.args.get('method', '1')
-        seed = request.args.get('seed')
+        body_images = _body_images() if request.method == 'POST' else None
+        params = request.values
+        lat = params.get('lat')
+        lon = params.get('lon')
+        method = params.get('method', '1')
+        seed = params.get('seed')
+        auto_policy = params.get('auto_policy')
         
+        if body_images:
+            image_url = inline_key = IMAGE_CACHE.hold_inline(body_images[0][0])
+        else:
+            try:
+                image_url = UPLOADS.image_url(params)
+            except ValueError as e:
+                return jsonify({"success": False, "error": str(e)}), 400
         if not image_url:
-            return jsonify({"success": False, "error": "image_url is required"}), 400
+            return jsonify({"success": False, "error": "image_url, photo_uuid, path or image body is required"}), 400
+        try:
+            variant = parse_output_variant(params)
+        except ValueError as e:
+            return jsonify({"success": False, "error": str(e)}), 400
+        if auto_policy and auto_policy not in AUTO_POLICIES:
+            return jsonify({"success": False, "error": f"auto_policy must be one of {sorted(AUTO_POLICIES)}"}), 400
         
         # Детектируем объекты
-        results = detect_objects(image_url, lat, lon, int(method), seed)
+        results = detect_objects(image_url, lat, lon, int(method), seed, auto_policy, wait_for_slot=False)
         detections = results.get("detections", [])
         
-        # Отрисовываем изображение со всеми bbox и масками
+        # Отрисовываем изображение со всеми bbox и масками; маски полного разрешения
+        # забираются из копии результата и освобождаются сразу после отрисовки
+        results = dict(results)
         img_buffer, _ = draw_detections(
             image_url, 
             detections, 
             method, 
             seed,
-            road_mask=results.get("road_mask"),
-            other_mask=results.get("other_mask")
+            road_mask=results.pop("road_mask", None),
+            other_mask=results.pop("other_mask", None),
+            variant=variant
         )
         
-        # Возвращаем ТОЛЬКО изображение
-        return send_file(
+        # Возвращаем ТОЛЬКО изображение; сведения об автоподборе - в заголовках
+        response = send_file(
             img_buffer,
-            mimetype='image/jpeg',
+            mimetype=variant_mimetype(variant),
             as_attachment=False,
-            download_name='detection_result.jpg'
+            download_name=f"detection_result.{OUTPUT_FORMATS[variant['format']]['ext']}"
         )
+        auto_select = results.get("auto_select")
+        if auto_select:
+            response.headers['X-Auto-Policy'] = auto_select["policy"]
+            response.headers['X-Models-Run'] = ",".join(str(m) for m in auto_select["models_run"])
+            response.headers['X-Selected-Method'] = str(auto_select["selected_method"] or "")
+        if results.get("label_map_id"):
+            response.headers['X-Label-Map-Id'] = results["label_map_id"]
+        memory = results.get("memory")
+        if memory:
+            response.headers['X-Memory-Estimate-MB'] = str(memory["estimated_mb"])
+            response.headers['X-Memory-Downscale'] = str(memory["downscale"])
+            if "peak_rss_mb" in memory:
+                response.headers['X-Peak-RSS-MB'] = str(memory["peak_rss_mb"])
+        return response
         
+    except InferenceQueueFull as e:
+        return _busy_response(e.retry_after)
+    except (MemoryBudgetExceeded, RequestEntityTooLarge) as e:
+        return jsonify({"success": False, "error": str(e)}), 413
     except Exception as e:
         logger.error(f"Error in detect_objects: {e}")
         return jsonify({"success": False, "error": str(e)}), 500
+    finally:
+        if inline_key is not None:
+            IMAGE_CACHE.release_inline(inline_key)
 
 @app.route('/detect_batch', methods=['POST'])
+@_limit_inflight
 def detect_batch():
+    """
+    Пакетная детекция: JSON {method, seed, auto_policy, images: [{image_url | photo_uuid | path, lat, lon}]}
+    или multipart - файлы изображений по порядку, их lat/lon - JSON-список в поле images,
+    method / seed / auto_policy - поля формы; одно изображение можно передать телом запроса
+    """
+    inline_keys = []
     try:
-        data = request.get_json()
+        body_images = _body_images()
+        if body_images is not None:
+            params = request.values
+            try:
+                metadata = json.loads(params.get('images') or "[]")
+                data = {'method': int(params.get('method', 1)), 'seed': params.get('seed'),
+                        'auto_policy': params.get('auto_policy'), 'images': []}
+            except ValueError as e:
+                return jsonify({"success": False, "error": f"Invalid form fields: {e}"}), 400
+            if not isinstance(metadata, list):
+                return jsonify({"success": False, "error": "images must be a JSON list of {lat, lon}"}), 400
+            for index, (content, filename) in enumerate(body_images):
+                img_data = dict(metadata[index]) if index < len(metadata) else {}
+                img_data.setdefault('lat', params.get('lat'))
+                img_data.setdefault('lon', params.get('lon'))
+                inline_keys.append(IMAGE_CACHE.hold_inline(content))
+                img_data['image_url'] = inline_keys[-1]
+                if filename:
+                    img_data['filename'] = filename
+                data['images'].append(img_data)
+        else:
+            data = request.get_json()
         
         if not data:
             return jsonify({"success": False, "error": "No JSON data provided"}), 400
@@ -685,83 +4095,27 @@ def detect_batch():
         method = data.get('method', 1)
         seed = data.get('seed')
         images = data.get('images', [])
+        auto_policy = data.get('auto_policy')
         
         if not images:
             return jsonify({"success": False, "error": "No images provided"}), 400
+        if auto_policy and auto_policy not in AUTO_POLICIES:
+            return jsonify({"success": False, "error": f"auto_policy must be one of {sorted(AUTO_POLICIES)}"}), 400
         
-        results = []
+        # Пакет принимается, только если у пула есть место; дальше изображения ждут очереди
+        if INFERENCE_POOL is not None and INFERENCE_POOL.full():
+            return _busy_response(INFERENCE_POOL.retry_after())
         
-        for img_data in images:
-            image_url = img_data.get('image_url')
-            lat = img_data.get('lat')
-            lon = img_data.get('lon')
-            
-            if not image_url:
-                continue
-            
-            try:
-                # Детектируем объекты
-                detection_results = detect_objects(image_url, lat, lon, method, seed)
-                detections = detection_results.get("detections", [])
-                
-                # Отрисовываем основное изображение со всеми bbox и масками
-                img_buffer_all, _ = draw_detections(
-                    image_url, 
-                    detections, 
-                    method, 
-                    seed,
-                    road_mask=detection_results.get("road_mask"),
-                    other_mask=detection_results.get("other_mask")
-                )
-                main_uuid = save_photo(img_buffer_all, image_url, detections)
-                
-                # Отрисовываем отдельные фото для каждого bbox (без масок)
-                single_photos = []
-                for j, detection in enumerate(detections):
-                    single_buffer, _ = draw_detections(image_url, [detection], method, seed, single_detection_index=0)
-                    single_uuid = save_photo(single_buffer, image_url, [detection], j)
-                    
-                    id_val, method_val, bbox, confidence, obj_lat, obj_lon = detection
-                    single_photos.append({
-                        'photo_url': f"{BASE_URL}/photo?uuid={single_uuid}",
-                        'bbox': bbox,
-                        'lat': obj_lat,        # Плоская структура
-                        'lon': obj_lon,        # Плоская структура
-                        'confidence': confidence
-                    })
-                
-                # Формируем результат (плоская структура)
-                result_detections = []
-                for j, detection in enumerate(detections):
-                    id_val, method_val, bbox, confidence, obj_lat, obj_lon = detection
-                    result_detections.append({
-                        'id': id_val,
-                        'method': method_val,
-                        'bbox': bbox,
-                        'confidence': confidence,
-                        'lat': obj_lat,        # Прямо здесь
-                        'lon': obj_lon,        # Прямо здесь
-                        'single_photo_url': single_photos[j]['photo_url']
-                    })
-                
-                result = {
-                    'original_image_url': image_url,
-                    'processed_image_url': f"{BASE_URL}/photo?uuid={main_uuid}",
-                    'detection_count': len(detections),
-                    'method': method,
-                    'detections': result_detections
-                }
-                
-                results.append(result)
-                
-            except Exception as e:
-                logger.error(f"Error processing image {image_url}: {e}")
-                results.append({
-                    'original_image_url': image_url,
-                    'error': str(e),
-                    'detection_count': 0,
-                    'detections': []
-                })
+        try:
+            images = _with_image_urls(images)
+        except ValueError as e:
+            return jsonify({"success": False, "error": str(e)}), 400
+        started = time.time()
+        results = list(BATCH_PIPELINE.run(images, method, seed, auto_policy))
+        logger.info(f"Пакет из {len(results)} изображений обработан за {time.time() - started:.1f} с")
+        for img_data, result in zip(images, results):
+            if img_data.get('filename'):
+                result['filename'] = img_data['filename']
         
         return jsonify({
             'success': True,
@@ -771,9 +4125,14 @@ def detect_batch():
             'results': results
         })
         
+    except RequestEntityTooLarge as e:
+        return jsonify({"success": False, "error": str(e)}), 413
     except Exception as e:
         logger.error(f"Error in detect_batch: {e}")
         return jsonify({"success": False, "error": str(e)}), 500
+    finally:
+        for key in inline_keys:
+            IMAGE_CACHE.release_inline(key)
 
 @app.route('/show', methods=['GET'])
 def show_detection():
@@ -789,6 +4148,10 @@ def show_detection():
         
         if not all([image_url, id_val, method, bbox_str, confidence, lat, lon]):
             return jsonify({"success": False, "error": "All parameters are required"}), 400
+        try:
+            variant = parse_output_variant(request.args)
+        except ValueError as e:
+            return jsonify({"success": False, "error": str(e)}), 400
         
         # Парсим bbox в формате "x,y,w,h"
         try:
@@ -819,20 +4182,30 @@ def show_detection():
             float(lon)                 # lon объекта
         ]
         
-        # Отрисовываем изображение без статусной строки
-        img_buffer, _ = draw_detections(
-            image_url, [detection], method, None, single_detection_index=0
-        )        
+        # Отрисовываем изображение без статусной строки и сразу кодируем в запрошенный вариант
+        try:
+            image = render_single_detection(download_image(image_url), detection)
+        except Exception as e:
+            logger.error(f"Error in show_detection render: {e}")
+            return send_file(render_error_image(e), mimetype='image/jpeg', as_attachment=False,
+                             download_name=f"show_{id_val}.jpg")
+        img_buffer = encode_variant(image, variant)
+        del image
         
-        # Сохраняем фото
-        photo_uuid = save_photo(img_buffer, image_url, [detection])
+        # Сохраняем только этот вариант; полноразмерный рендер - отложенно, если его запросят через /photo
+        ext = OUTPUT_FORMATS[variant['format']]['ext']
+        if variant == DEFAULT_OUTPUT_VARIANT:
+            save_photo(img_buffer, image_url, [detection])
+        else:
+            photo_uuid = register_lazy_photo(image_url, [detection], 0)
+            RENDER_STORE.set_variant(photo_uuid, variant_suffix(variant), img_buffer.getvalue(), ext)
         
         # Возвращаем изображение
         return send_file(
-            os.path.join(UPLOAD_DIR, f"{photo_uuid}.jpg"),
-            mimetype='image/jpeg',
+            img_buffer,
+            mimetype=variant_mimetype(variant),
             as_attachment=False,
-            download_name=f'show_{id_val}.jpg'
+            download_name=f"show_{id_val}.{ext}"
         )
         
     except Exception as e:
@@ -847,38 +4220,38 @@ def get_photo():
         if not photo_uuid:
             return jsonify({"success": False, "error": "uuid parameter is required"}), 400
         
-        if photo_uuid not in PHOTO_STORAGE:
+        photo_info = RENDER_STORE.get(photo_uuid)
+        if photo_info is None:
             return jsonify({"success": False, "error": "Photo not found"}), 404
+        try:
+            variant = parse_output_variant(request.args)
+        except ValueError as e:
+            return jsonify({"success": False, "error": str(e)}), 400
         
-        photo_info = PHOTO_STORAGE[photo_uuid]
-        filepath = photo_info['filepath']
-        
-        if not os.path.exists(filepath):
+        if photo_info['filepath'] is None and photo_info['render'] is None:
             return jsonify({"success": False, "error": "Photo file not found"}), 404
+        filepath = _ensure_photo_variant(photo_uuid, photo_info, variant)
         
         return send_file(
             filepath,
-            mimetype='image/jpeg',
+            mimetype=variant_mimetype(variant),
             as_attachment=False,
-            download_name=f'photo_{photo_uuid}.jpg'
+            download_name=f"photo_{photo_uuid}.{OUTPUT_FORMATS[variant['format']]['ext']}"
         )
         
     except Exception as e:
         logger.error(f"Error in get_photo: {e}")
         return jsonify({"success": False, "error": str(e)}), 500
 
-@app.route('/clear', methods=['GET'])
+@app.route('/clear', methods=['GET', 'POST'])
 def clear_storage():
+    """Административная очистка хранилища фото (все ссылки /photo перестают работать)"""
     try:
-        deleted_count = 0
-        
-        for photo_uuid, photo_info in list(PHOTO_STORAGE.items()):
-            filepath = photo_info['filepath']
-            if os.path.exists(filepath):
-                os.remove(filepath)
-                deleted_count += 1
+        if ADMIN_TOKEN and request.headers.get('X-Admin-Token') != ADMIN_TOKEN:
+            return jsonify({"success": False, "error": "Admin token required"}), 403
         
-        PHOTO_STORAGE.clear()
+        deleted_count = RENDER_STORE.purge()
+        logger.info(f"Render store purged: {deleted_count} files deleted")
         
         return jsonify({
             'success': True,
@@ -890,6 +4263,212 @@ def clear_storage():
         logger.error(f"Error in clear_storage: {e}")
         return jsonify({"success": False, "error": str(e)}), 500
 
+def _threshold_params(data):
+    min_area = int(data.get('min_area', DETECTION_MIN_AREA))
+    building_confidence = float(data.get('building_confidence', DETECTION_BUILDING_CONFIDENCE))
+    if min_area < 1 or not 0.0 <= building_confidence <= 1.0:
+        raise ValueError("min_area must be >= 1 and building_confidence must be in [0, 1]")
+    return min_area, building_confidence
+
+@app.route('/reprocess', methods=['POST'])
+def reprocess():
+    """
+    Повторная постобработка сохраненной карты классов с новыми порогами, без инференса:
+    JSON {label_map_id, min_area, building_confidence, lat, lon}
+    """
+    try:
+        data = request.get_json(silent=True) or {}
+        map_id = data.get('label_map_id')
+        if LABEL_MAPS is None:
+            return jsonify({"success": False, "error": "Label map storage is disabled"}), 400
+        if not map_id:
+            return jsonify({"success": False, "error": "label_map_id is required"}), 400
+        try:
+            min_area, building_confidence = _threshold_params(data)
+            semantic_map, header = LABEL_MAPS.get(map_id)
+        except ValueError as e:
+            return jsonify({"success": False, "error": str(e)}), 400
+        except KeyError:
+            return jsonify({"success": False, "error": "Label map not found"}), 404
+        
+        segmentator = _postprocessor(header)
+        results = segmentator.postprocess_semantic_map(semantic_map, min_area, building_confidence)
+        height, width = semantic_map.shape
+        detections = _format_detections(results["buildings"], header["method"],
+                                        data.get('lat'), data.get('lon'), (width, height))
+        
+        return jsonify({
+            "success": True,
+            "label_map_id": map_id,
+            "method": header["method"],
+            "min_area": min_area,
+            "building_confidence": building_confidence,
+            "building_ratio": round(results["building_ratio"], 4),
+            "category_stats": results["category_stats"],
+            "detection_count": len(detections),
+            "detections": [
+                {'id': id_val, 'method': method_val, 'bbox': bbox, 'confidence': confidence,
+                 'lat': obj_lat, 'lon': obj_lon}
+                for id_val, method_val, bbox, confidence, obj_lat, obj_lon in detections
+            ]
+        })
+        
+    except Exception as e:
+        logger.error(f"Error in reprocess: {e}")
+        return jsonify({"success": False, "error": str(e)}), 500
+
+@app.route('/reprocess/sweep', methods=['POST'])
+def reprocess_sweep():
+    """
+    Перебор сетки порогов по сохраненным картам за один проход на карту:
+    JSON {label_map_ids, min_areas, building_confidences}
+    """
+    try:
+        data = request.get_json(silent=True) or {}
+        map_ids = data.get('label_map_ids') or []
+        if LABEL_MAPS is None:
+            return jsonify({"success": False, "error": "Label map storage is disabled"}), 400
+        try:
+            min_areas = sorted({int(v) for v in data.get('min_areas') or [DETECTION_MIN_AREA]})
+            confidences = sorted({float(v) for v in data.get('building_confidences') or [DETECTION_BUILDING_CONFIDENCE]})
+        except (TypeError, ValueError):
+            return jsonify({"success": False, "error": "min_areas and building_confidences must be numbers"}), 400
+        if not map_ids:
+            return jsonify({"success": False, "error": "label_map_ids is required"}), 400
+        if min_areas[0] < 1 or len(min_areas) * len(confidences) > SWEEP_MAX_PAIRS:
+            return jsonify({"success": False, "error": f"min_areas must be >= 1, at most {SWEEP_MAX_PAIRS} pairs"}), 400
+        
+        counts = np.zeros((len(min_areas), len(confidences)), dtype=np.int64)
+        confidence_sums = np.zeros(counts.shape)
+        per_image = {}
+        missing = []
+        for map_id in map_ids:
+            try:
+                semantic_map, header = LABEL_MAPS.get(map_id)
+            except (KeyError, ValueError):
+                missing.append(map_id)
+                continue
+            image_counts, image_sums = _postprocessor(header).sweep_thresholds(semantic_map, min_areas, confidences)
+            counts += image_counts
+            confidence_sums += image_sums
+            per_image[map_id] = image_counts
+        
+        grid = []
+        for i, min_area in enumerate(min_areas):
+            for j, building_confidence in enumerate(confidences):
+                grid.append({
+                    "min_area": min_area,
+                    "building_confidence": building_confidence,
+                    "buildings": int(counts[i, j]),
+                    "mean_confidence": round(float(confidence_sums[i, j] / counts[i, j]), 4) if counts[i, j] else None,
+                    "per_image": {map_id: int(image_counts[i, j]) for map_id, image_counts in per_image.items()}
+                })
+        
+        return jsonify({"success": True, "images": len(per_image), "missing": missing, "grid": grid})
+        
+    except Exception as e:
+        logger.error(f"Error in reprocess_sweep: {e}")
+        return jsonify({"success": False, "error": str(e)}), 500
+
+@app.route('/jobs', methods=['POST'])
+def create_job():
+    """Создает асинхронную задачу детекции (формат тела как у /detect_batch)"""
+    try:
+        data = request.get_json()
+        
+        if not data:
+            return jsonify({"success": False, "error": "No JSON data provided"}), 400
+        
+        method = data.get('method', 1)
+        seed = data.get('seed')
+        auto_policy = data.get('auto_policy')
+        try:
+            images = _with_image_urls(data.get('images', []))
+        except ValueError as e:
+            return jsonify({"success": False, "error": str(e)}), 400
+        
+        if not images:
+            return jsonify({"success": False, "error": "No images provided"}), 400
+        if auto_policy and auto_policy not in AUTO_POLICIES:
+            return jsonify({"success": False, "error": f"auto_policy must be one of {sorted(AUTO_POLICIES)}"}), 400
+        try:
+            image_timeout = float(data.get('image_timeout_sec', JOB_IMAGE_TIMEOUT_SEC))
+        except (TypeError, ValueError):
+            image_timeout = 0
+        if image_timeout <= 0:
+            return jsonify({"success": False, "error": "image_timeout_sec must be a positive number"}), 400
+        
+        job = JOB_MANAGER.submit(images, method, seed, auto_policy, image_timeout)
+        logger.info(f"Job {job.id} queued: {len(images)} images, method {method}")
+        
+        return jsonify({
+            "success": True,
+            "job_id": job.id,
+            "status": job.status,
+            "total": len(images),
+            "status_url": f"{BASE_URL}/jobs/{job.id}",
+            "stream_url": f"{BASE_URL}/jobs/{job.id}/stream"
+        }), 202
+        
+    except Exception as e:
+        logger.error(f"Error in create_job: {e}")
+        return jsonify({"success": False, "error": str(e)}), 500
+
+@app.route('/jobs/<job_id>', methods=['GET'])
+def job_status(job_id):
+    """Статус задачи и готовые результаты начиная с события since"""
+    job = JOB_MANAGER.get(job_id)
+    if job is None:
+        return jsonify({"success": False, "error": "Job not found"}), 404
+    
+    since = request.args.get('since', 0, type=int)
+    events, _ = job.wait_events(since, 0)
+    return jsonify({
+        "success": True,
+        **job.summary(),
+        "results": [{"index": event["index"], **event["result"]} for event in events],
+        "next_since": since + len(events)
+    })
+
+@app.route('/jobs/<job_id>/stream', methods=['GET'])
+def job_stream(job_id):
+    """
+    Результаты задачи по мере готовности: NDJSON по умолчанию, SSE при
+    Accept: text/event-stream или format=sse. Возобновление - since или Last-Event-ID.
+    """
+    job = JOB_MANAGER.get(job_id)
+    if job is None:
+        return jsonify({"success": False, "error": "Job not found"}), 404
+    
+    sse = request.args.get('format') == 'sse' or 'text/event-stream' in request.headers.get('Accept', '')
+    offset = request.args.get('since', 0, type=int)
+    last_event_id = request.headers.get('Last-Event-ID')
+    if last_event_id and last_event_id.isdigit():
+        offset = int(last_event_id) + 1
+    
+    response = Response(
+        stream_with_context(_job_stream(job, offset, sse)),
+        mimetype='text/event-stream' if sse else 'application/x-ndjson'
+    )
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
+@app.route('/jobs/<job_id>/cancel', methods=['POST'])
+def cancel_job(job_id):
+    """Отменяет задачу: новые изображения не запускаются, готовые результаты сохраняются"""
+    job = JOB_MANAGER.cancel(job_id)
+    if job is None:
+        return jsonify({"success": False, "error": "Job not found"}), 404
+    return jsonify({"success": True, **job.summary()})
+
 if __name__ == '__main__':
     port = int(os.environ.get('PORT', 5000))
+    RENDER_STORE.start_sweeper()
+    if INFERENCE_WORKERS > 0:
+        INFERENCE_POOL = InferencePool(
+            INFERENCE_WORKERS, INFERENCE_WORKER_THREADS, INFERENCE_WORKER_INTEROP_THREADS,
+            INFERENCE_WORKER_AFFINITY, INFERENCE_QUEUE_MAX, INFERENCE_MAX_BATCH_SIZE
+        )
+        INFERENCE_POOL.start()
     app.run(host='0.0.0.0', port=port, debug=False)
\ No newline at end of file
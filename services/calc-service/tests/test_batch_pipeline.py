@@ -0,0 +1,50 @@
+import threading
+import weakref
+
+import numpy as np
+
+import app
+
+
+def _stub_stages(monkeypatch):
+    calls = []
+    masks = {}
+    lock = threading.Lock()
+
+    def detect_objects(image_url, lat, lon, method, seed, auto_policy=None):
+        road_mask = np.zeros((8, 8), dtype=np.uint8)
+        with lock:
+            calls.append((image_url, lat, lon))
+            masks[image_url] = weakref.ref(road_mask)
+        return {"detections": [image_url], "road_mask": road_mask, "other_mask": road_mask.copy()}
+
+    def batch_image_result(image_url, detection_results, method, seed):
+        assert detection_results["road_mask"] is not None
+        return {"original_image_url": image_url, "detections": detection_results["detections"]}
+
+    monkeypatch.setattr(app, "_prefetch_image", lambda image_url: None)
+    monkeypatch.setattr(app, "detect_objects", detect_objects)
+    monkeypatch.setattr(app, "_batch_image_result", batch_image_result)
+    return calls, masks
+
+
+def test_order_and_duplicates(monkeypatch):
+    calls, _ = _stub_stages(monkeypatch)
+    images = [{"image_url": f"u{i % 4}", "lat": 1, "lon": 2} for i in range(10)]
+    images.append({"image_url": "u0", "lat": 3, "lon": 4})
+    pipeline = app.BatchPipeline(4, 2, 2, depth=3)
+    results = list(pipeline.run(images, 1, None))
+    assert [r["original_image_url"] for r in results] == [img["image_url"] for img in images]
+    # Повторы с теми же координатами детектируются один раз, другие координаты - отдельно
+    assert sorted(calls) == sorted({(img["image_url"], img["lat"], img["lon"]) for img in images})
+
+
+def test_masks_released_after_last_render(monkeypatch):
+    _, masks = _stub_stages(monkeypatch)
+    images = [{"image_url": f"u{i}", "lat": 1, "lon": 2} for i in range(8)]
+    pipeline = app.BatchPipeline(2, 1, 1, depth=2)
+    for index, result in enumerate(pipeline.run(images, 1, None)):
+        if index >= 3:
+            # Отданные ранее изображения больше не держат свои маски
+            assert masks["u0"]() is None
+    assert all(ref() is None for ref in masks.values())
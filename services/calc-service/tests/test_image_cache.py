@@ -0,0 +1,31 @@
+import io
+
+from PIL import Image
+
+import app
+
+
+def _jpeg(color, size=(40, 30)):
+    buffer = io.BytesIO()
+    Image.new("RGB", size, color).save(buffer, format="JPEG")
+    return buffer.getvalue()
+
+
+def _total(cache):
+    return sum(entry["nbytes"] for entry in cache._entries.values())
+
+
+def test_byte_counter_follows_entries():
+    cache = app.ImageFetchCache(10 * 40 * 30 * 3, 60, True, 4, 4)
+    keys = [cache.hold_inline(_jpeg((i * 20, 0, 0))) for i in range(12)]
+    for key in keys:
+        assert cache.get_bytes(key)
+        image = cache.get_image(key)
+        assert image.size == (40, 30)
+        assert cache._bytes == _total(cache) <= cache.max_bytes
+    # Бюджет меньше суммы записей - давние записи вытеснены, счетчик совпадает с остатком
+    assert cache.evictions > 0
+    assert keys[-1] in cache._entries and keys[0] not in cache._entries
+    assert cache.stats()["bytes_mb"] == round(_total(cache) / 2**20, 1)
+    for key in keys:
+        cache.release_inline(key)
@@ -0,0 +1,80 @@
+import threading
+import time
+
+import app
+
+
+def _stub_stages(monkeypatch, delays=None, blocked=None):
+    """detect_objects спит delays[url] секунд или ждет события blocked[url]"""
+    delays = delays or {}
+    blocked = blocked or {}
+    started = []
+
+    def detect_objects(image_url, lat, lon, method, seed, auto_policy=None):
+        started.append(image_url)
+        if image_url in blocked:
+            blocked[image_url].wait(10)
+        time.sleep(delays.get(image_url, 0))
+        return {"detections": [image_url]}
+
+    def batch_image_result(image_url, detection_results, method, seed):
+        return {"original_image_url": image_url, "detections": detection_results["detections"]}
+
+    monkeypatch.setattr(app, "detect_objects", detect_objects)
+    monkeypatch.setattr(app, "_batch_image_result", batch_image_result)
+    return started
+
+
+def _wait_finished(job, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not job.finished and time.monotonic() < deadline:
+        job.wait_events(len(job.events), 0.1)
+    assert job.finished
+
+
+def test_results_emitted_as_ready(monkeypatch):
+    _stub_stages(monkeypatch, delays={"u0": 0.3})
+    monkeypatch.setattr(app, "BATCH_DETECT_WINDOW", 2)
+    manager = app.JobManager(1, 60)
+    job = manager.submit([{"image_url": "u0"}, {"image_url": "u1"}], 1, None, None, 5)
+    _wait_finished(job)
+    assert job.status == "done"
+    # Быстрое изображение приходит раньше медленного, index указывает на позицию в запросе
+    assert [event["index"] for event in job.events] == [1, 0]
+    assert [event["seq"] for event in job.events] == [0, 1]
+    assert job.events[0]["result"]["original_image_url"] == "u1"
+
+
+def test_timeout_frees_window_slot(monkeypatch):
+    hung = threading.Event()
+    try:
+        _stub_stages(monkeypatch, blocked={"u0": hung})
+        monkeypatch.setattr(app, "BATCH_DETECT_WINDOW", 1)
+        manager = app.JobManager(1, 60)
+        job = manager.submit([{"image_url": "u0"}, {"image_url": "u1"}], 1, None, None, 0.2)
+        _wait_finished(job)
+        assert job.status == "done"
+        results = {event["index"]: event["result"] for event in job.events}
+        assert "Timed out" in results[0]["error"]
+        # Зависшая детекция не занимает окно: следующее изображение обработано
+        assert results[1]["detections"] == ["u1"]
+    finally:
+        hung.set()
+
+
+def test_cancel_keeps_finished_results(monkeypatch):
+    hung = threading.Event()
+    try:
+        started = _stub_stages(monkeypatch, blocked={"u1": hung})
+        monkeypatch.setattr(app, "BATCH_DETECT_WINDOW", 1)
+        manager = app.JobManager(1, 60)
+        job = manager.submit([{"image_url": f"u{i}"} for i in range(4)], 1, None, None, 10)
+        job.wait_events(0, 5)
+        manager.cancel(job.id)
+        _wait_finished(job)
+        assert job.status == "cancelled"
+        assert [event["index"] for event in job.events] == [0]
+        # После отмены новые изображения не запускаются
+        assert started == ["u0", "u1"]
+    finally:
+        hung.set()
@@ -0,0 +1,50 @@
+import threading
+import time
+
+from PIL import Image
+
+import app
+
+
+def test_lazy_render_once_and_locks_released(monkeypatch, tmp_path):
+    store = app.RenderStore(str(tmp_path), 2**30, 0, 0)
+    monkeypatch.setattr(app, "RENDER_STORE", store)
+    downloads = []
+
+    def download_image(image_url):
+        downloads.append(image_url)
+        time.sleep(0.05)
+        return Image.new("RGB", (400, 300), (90, 120, 60))
+
+    monkeypatch.setattr(app, "download_image", download_image)
+    detection = ["id1", 1, {"x": 10, "y": 10, "w": 100, "h": 80}, 0.9, 55.8, 37.7]
+    photo_uuid = app.register_lazy_photo("http://example/img.jpg", [detection], 0)
+    variant = {"size": "thumb", "format": "webp", "quality": 80}
+    paths = []
+
+    def request(v):
+        paths.append(app._ensure_photo_variant(photo_uuid, store.get(photo_uuid), v))
+
+    threads = [threading.Thread(target=request, args=(variant if i % 2 else app.DEFAULT_OUTPUT_VARIANT,))
+               for i in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    # Превью и вариант кодируются по одному разу, замки после всех запросов удалены
+    assert len(downloads) == 1
+    assert len(set(paths)) == 2
+    assert store.stats()["files"] == 2
+    assert app._LAZY_RENDER_LOCKS == {}
+
+
+def test_stored_variant_served_without_full_render(monkeypatch, tmp_path):
+    store = app.RenderStore(str(tmp_path), 2**30, 0, 0)
+    monkeypatch.setattr(app, "RENDER_STORE", store)
+    monkeypatch.setattr(app, "download_image", lambda image_url: (_ for _ in ()).throw(AssertionError(image_url)))
+    detection = ["id1", 1, {"x": 10, "y": 10, "w": 100, "h": 80}, 0.9, 55.8, 37.7]
+    photo_uuid = app.register_lazy_photo("http://example/img.jpg", [detection], 0)
+    variant = {"size": "thumb", "format": "webp", "quality": 80}
+    path = store.set_variant(photo_uuid, app.variant_suffix(variant), b"webp", "webp")
+    assert app._ensure_photo_variant(photo_uuid, store.get(photo_uuid), variant) == path
+    assert store.stats()["pending_renders"] == 1
@@ -0,0 +1,20 @@
+import types
+
+import app
+
+
+def test_auto_estimate_uses_requested_policy(monkeypatch):
+    policies = {
+        "light": {"stages": [[1]], "accept": None},
+        "heavy": {"stages": [[1], [2]], "accept": None}
+    }
+    models = {1: types.SimpleNamespace(class_names=["c"] * 20), 2: types.SimpleNamespace(class_names=["c"] * 1000)}
+    monkeypatch.setattr(app, "AUTO_POLICIES", policies)
+    monkeypatch.setattr(app, "AUTO_POLICY", "heavy")
+    monkeypatch.setattr(app.MODEL_REGISTRY, "peek", lambda method: models[method])
+    guard = app.MemoryGuard(0, "downscale", 1)
+    size = (2000, 1500)
+    # Модели других политик не раздувают оценку
+    assert guard.estimate(size, size, 0, "light") == guard.estimate(size, size, 1)
+    assert guard.estimate(size, size, 0, "heavy") == guard.estimate(size, size, 2)
+    assert guard.estimate(size, size, 0) == guard.estimate(size, size, 0, "heavy")
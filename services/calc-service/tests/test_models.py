@@ -0,0 +1,12 @@
+import pytest
+
+import app
+
+
+@pytest.mark.parametrize("endpoint", ["/models/parity", "/models/postprocess_parity", "/models/preprocess_parity"])
+def test_parity_endpoints_refuse_with_inference_pool(monkeypatch, endpoint):
+    monkeypatch.setattr(app, "MODEL_REGISTRY", None)
+    monkeypatch.setattr(app, "INFERENCE_POOL", object())
+    response = app.app.test_client().post(endpoint, json={"method": 1, "image_urls": ["http://example.invalid/a.jpg"]})
+    assert response.status_code == 409
+    assert response.get_json()["success"] is False
@@ -0,0 +1,113 @@
+import types
+
+import numpy as np
+import pytest
+import torch
+
+import app
+
+
+@pytest.fixture
+def segmentator():
+    """Постобработка выходов модели не требует ни весов, ни процессора"""
+    return app.AdvancedUrbanSegmentator.for_class_names("test", {0: "wall", 1: "building", 2: "road", 3: "tree"})
+
+
+def _outputs_with_padding():
+    """
+    Выходы модели для входа 64x128 с паддингом справа (валидно 64x96): маски в 1/4 разрешения,
+    запрос q - класс q; слева класс 1, справа класс 2, в паддинге - класс 3
+    """
+    classes = 4
+    class_logits = torch.full((1, classes, classes + 1), -10.0)
+    for query in range(classes):
+        class_logits[0, query, query] = 10.0
+    mask_logits = torch.full((1, classes, 16, 32), -10.0)
+    mask_logits[0, 1, :, :12] = 10.0
+    mask_logits[0, 2, :, 12:24] = 10.0
+    mask_logits[0, 3, :, 24:] = 10.0
+    pixel_mask = torch.zeros((1, 64, 128), dtype=torch.int64)
+    pixel_mask[0, :, :96] = 1
+    return types.SimpleNamespace(class_queries_logits=class_logits, masks_queries_logits=mask_logits), pixel_mask
+
+
+@pytest.mark.parametrize("argmax_max_side", [0, 30])
+def test_semantic_maps_crop_and_upsample(segmentator, argmax_max_side):
+    outputs, pixel_mask = _outputs_with_padding()
+    semantic_map, = segmentator._semantic_maps_from_outputs(outputs, pixel_mask, [(48, 72)], argmax_max_side)
+    assert semantic_map.shape == (48, 72) and semantic_map.dtype == np.uint8
+    # Паддинг отрезан: класса 3 нет, граница классов 1/2 - посередине изображения
+    assert set(np.unique(semantic_map)) == {1, 2}
+    assert (semantic_map[:, :33] == 1).all() and (semantic_map[:, 39:] == 2).all()
+
+
+def test_bounded_argmax_agrees_with_full(segmentator):
+    outputs, pixel_mask = _outputs_with_padding()
+    outputs.masks_queries_logits += torch.randn(outputs.masks_queries_logits.shape, generator=torch.Generator().manual_seed(0))
+    full, = segmentator._semantic_maps_from_outputs(outputs, pixel_mask, [(300, 450)], 0)
+    bounded, = segmentator._semantic_maps_from_outputs(outputs, pixel_mask, [(300, 450)], 100)
+    assert bounded.shape == full.shape
+    assert (bounded == full).mean() > 0.97
+
+
+def _reference_components(mask, min_area, semantic_map, min_confidence):
+    """Прежняя реализация: полная маска и np.unique на каждую компоненту"""
+    import cv2
+
+    num_labels, labels, stats, _ = cv2.connectedComponentsWithStats(mask, connectivity=8)
+    objects = {}
+    for i in range(1, num_labels):
+        if stats[i, cv2.CC_STAT_AREA] < min_area:
+            continue
+        component_mask = (labels == i).astype(np.uint8)
+        unique_classes, counts = np.unique(semantic_map[component_mask > 0], return_counts=True)
+        confidence = counts.max() / counts.sum()
+        if confidence < min_confidence:
+            continue
+        y_indices, x_indices = np.where(component_mask > 0)
+        objects[i] = {
+            "mask": component_mask,
+            "class_id": int(unique_classes[np.argmax(counts)]),
+            "confidence": float(confidence),
+            "bbox": [x_indices.min(), y_indices.min(), x_indices.max(), y_indices.max()],
+            "area": len(y_indices),
+            "centroid": [np.mean(x_indices), np.mean(y_indices)]
+        }
+    return objects
+
+
+def _synthetic_scene(seed):
+    """Карта классов со зданиями разного размера и состава классов и маска зданий по ней"""
+    rng = np.random.default_rng(seed)
+    semantic_map = rng.integers(0, 4, size=(240, 320), dtype=np.uint8)
+    mask = np.zeros(semantic_map.shape, dtype=np.uint8)
+    for _ in range(25):
+        x, y = rng.integers(0, 300), rng.integers(0, 220)
+        w, h = rng.integers(1, 60), rng.integers(1, 60)
+        mask[y:y + h, x:x + w] = 1
+        # Внутри здания преобладает один класс, но с примесью остальных
+        patch = semantic_map[y:y + h, x:x + w]
+        patch[rng.random(patch.shape) < rng.uniform(0.3, 0.95)] = rng.integers(0, 4)
+    return mask, semantic_map
+
+
+@pytest.mark.parametrize("seed", range(5))
+@pytest.mark.parametrize("min_area,min_confidence", [(1, 0.0), (50, 0.3), (500, 0.6)])
+def test_component_table_matches_per_component_loop(segmentator, seed, min_area, min_confidence):
+    mask, semantic_map = _synthetic_scene(seed)
+    expected = _reference_components(mask, min_area, semantic_map, min_confidence)
+    actual = segmentator._extract_components_soft(mask, min_area, "building", semantic_map, min_confidence)
+    assert expected and sorted(actual) == sorted(expected)
+    for i, building in actual.items():
+        reference = expected[i]
+        assert building["bbox"] == [int(v) for v in reference["bbox"]]
+        assert building["area"] == building["pixel_count"] == reference["area"]
+        assert building["class_id"] == reference["class_id"]
+        assert building["confidence"] == pytest.approx(reference["confidence"])
+        assert building["centroid"] == pytest.approx(reference["centroid"])
+        # Маска в пределах bbox совпадает с полной маской прежней реализации
+        x_min, y_min, x_max, y_max = building["bbox"]
+        assert building["mask_origin"] == [x_min, y_min]
+        full = np.zeros_like(reference["mask"])
+        full[y_min:y_max + 1, x_min:x_max + 1] = building["mask"]
+        assert (full == reference["mask"]).all()
@@ -0,0 +1,72 @@
+import threading
+import types
+
+import numpy as np
+import pytest
+import torch
+from PIL import Image
+from transformers.image_transforms import get_resize_output_image_size
+
+import app
+
+
+IMAGE_MEAN = [0.485, 0.456, 0.406]
+IMAGE_STD = [0.229, 0.224, 0.225]
+
+
+@pytest.fixture
+def segmentator():
+    """Сегментатор без весов модели: процессор задан только параметрами препроцессинга"""
+    segmentator = app.AdvancedUrbanSegmentator.for_class_names("test", {0: "wall", 1: "building", 2: "road", 3: "tree"})
+    segmentator.processor = types.SimpleNamespace(image_processor=types.SimpleNamespace(
+        size={"shortest_edge": 64, "longest_edge": 256}, do_resize=True, resample=Image.BILINEAR,
+        do_rescale=True, rescale_factor=1 / 255, do_normalize=True, image_mean=IMAGE_MEAN, image_std=IMAGE_STD
+    ))
+    segmentator._input_lock = threading.Lock()
+    segmentator._input_storage = None
+    return segmentator
+
+
+def _normalize(array):
+    return ((array.astype(np.float64) / 255 - IMAGE_MEAN) / IMAGE_STD).transpose(2, 0, 1)
+
+
+@pytest.mark.parametrize("size", [(64, 96), (96, 64), (640, 480), (333, 1000), (4000, 100), (1, 1), (1920, 1080)])
+def test_resized_shape_matches_processor(segmentator, size):
+    width, height = size
+    expected = get_resize_output_image_size(
+        np.zeros((height, width, 3), dtype=np.uint8), size=64, default_to_square=False, max_size=256,
+        input_data_format="channels_last"
+    )
+    assert segmentator.resized_shape(size) == tuple(expected)
+
+
+def test_fast_preprocess_normalization(segmentator):
+    # Размер уже совпадает с целевым - ресайз тождественный, проверяется rescale + normalize
+    array = np.random.default_rng(0).integers(0, 256, (96, 64, 3), dtype=np.uint8)
+    assert segmentator.resized_shape((64, 96)) == (96, 64)
+    inputs = segmentator.preprocess_images([Image.fromarray(array)], fast=True)
+    assert inputs["pixel_values"].dtype == torch.float32
+    np.testing.assert_allclose(inputs["pixel_values"][0].numpy(), _normalize(array), atol=1e-5)
+    assert inputs["pixel_mask"].dtype == torch.int64 and bool(inputs["pixel_mask"].all())
+
+
+def test_fast_preprocess_resize_close_to_pil(segmentator):
+    yy, xx = np.mgrid[0:300, 0:200]
+    array = np.stack([xx * 255 // 199, yy * 255 // 299, (xx + yy) * 255 // 498], axis=-1).astype(np.uint8)
+    image = Image.fromarray(array)
+    height, width = segmentator.resized_shape(image.size)
+    reference = _normalize(np.asarray(image.resize((width, height), Image.BILINEAR)))
+    inputs = segmentator.preprocess_images([image], fast=True)
+    assert inputs["pixel_values"].shape == (1, 3, height, width)
+    assert np.abs(inputs["pixel_values"][0].numpy() - reference).mean() < 0.02
+
+
+def test_fast_preprocess_padding(segmentator):
+    images = [Image.new("RGB", (64, 96), (255, 0, 0)), Image.new("RGB", (128, 64), (0, 255, 0))]
+    inputs = segmentator.preprocess_images(images, fast=True, reuse_buffer=True)
+    pixel_values, pixel_mask = inputs["pixel_values"], inputs["pixel_mask"]
+    assert pixel_values.shape == (2, 3, 96, 128)
+    assert pixel_mask[0, :96, :64].all() and not pixel_mask[0, :, 64:].any()
+    assert pixel_mask[1, :64, :128].all() and not pixel_mask[1, 64:, :].any()
+    assert not pixel_values[0, :, :, 64:].any() and not pixel_values[1, :, 64:, :].any()
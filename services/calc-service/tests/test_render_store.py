@@ -0,0 +1,78 @@
+import os
+import time
+
+import app
+
+
+DETECTIONS = [["id1", 1, {"x": 1, "y": 2, "w": 3, "h": 4}, 0.9, 55.8, 37.7]]
+
+
+def _store(tmp_path, max_bytes=2**30, ttl_sec=0):
+    return app.RenderStore(str(tmp_path), max_bytes, ttl_sec, 0)
+
+
+def test_create_and_get(tmp_path):
+    store = _store(tmp_path)
+    photo_uuid = store.create("http://example/img.jpg", DETECTIONS, 0, content=b"jpeg")
+    info = store.get(photo_uuid)
+    assert info["image_url"] == "http://example/img.jpg"
+    assert info["detections"] == DETECTIONS and info["detection_index"] == 0
+    assert info["render"] is None
+    with open(info["filepath"], "rb") as f:
+        assert f.read() == b"jpeg"
+    assert store.get("missing") is None
+
+
+def test_set_render_fills_lazy_photo(tmp_path):
+    store = _store(tmp_path)
+    photo_uuid = store.create("http://example/img.jpg", DETECTIONS, render={"single_detection_index": 0})
+    info = store.get(photo_uuid)
+    assert info["filepath"] is None and info["render"] == {"single_detection_index": 0}
+    assert store.stats()["pending_renders"] == 1
+    path = store.set_render(photo_uuid, b"rendered")
+    assert store.get(photo_uuid)["filepath"] == path
+    assert store.stats()["pending_renders"] == 0
+
+
+def test_identical_renders_share_one_file(tmp_path):
+    store = _store(tmp_path)
+    first = store.create("http://example/a.jpg", DETECTIONS, content=b"same")
+    second = store.create("http://example/b.jpg", DETECTIONS, content=b"same")
+    assert store.get(first)["filepath"] == store.get(second)["filepath"]
+    stats = store.stats()
+    assert stats["photos"] == 2 and stats["files"] == 1
+    # Файл удаляется только вместе с последним ссылающимся на него фото
+    store.ttl_sec = 0.05
+    time.sleep(0.1)
+    store.get(second)
+    store.sweep()
+    assert os.path.exists(store.get(second)["filepath"])
+
+
+def test_sweep_expires_by_ttl(tmp_path):
+    store = _store(tmp_path, ttl_sec=0.2)
+    old = store.create("http://example/old.jpg", DETECTIONS, content=b"old")
+    fresh = store.create("http://example/fresh.jpg", DETECTIONS, content=b"fresh")
+    old_path = store.get(old, touch=False)["filepath"]
+    time.sleep(0.3)
+    store.get(fresh)
+    result = store.sweep()
+    assert result["expired"] == 1
+    assert store.get(old) is None and not os.path.exists(old_path)
+    assert store.get(fresh)["filepath"] is not None
+
+
+def test_sweep_evicts_least_recently_used_over_budget(tmp_path):
+    store = _store(tmp_path, max_bytes=250)
+    photos = []
+    for i in range(2):
+        photos.append(store.create(f"http://example/{i}.jpg", DETECTIONS, content=bytes([i]) * 100))
+        time.sleep(0.01)
+    # Первое фото запрошено недавно - вытесняется второе
+    store.get(photos[0])
+    time.sleep(0.01)
+    photos.append(store.create("http://example/2.jpg", DETECTIONS, content=bytes([2]) * 100))
+    assert store.get(photos[1]) is None
+    assert store.get(photos[0]) is not None and store.get(photos[2]) is not None
+    stats = store.stats()
+    assert stats["evictions"] == 1 and stats["files"] == 2
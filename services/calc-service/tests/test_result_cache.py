@@ -0,0 +1,35 @@
+import numpy as np
+
+import app
+
+
+def _results():
+    return {
+        "buildings": {1: {"bbox": [0, 0, 9, 9], "area": 100}},
+        "detections": [["b1", 1, {"x": 0, "y": 0, "w": 10, "h": 10}, 0.9, 55.7, 37.6]],
+        "road_mask": np.zeros((40, 40), dtype=bool),
+        "other_mask": None,
+        "semantic_map": np.random.default_rng(0).integers(0, 150, (40, 40)).astype(np.int64),
+        "label_map_id": "ab" * 32,
+        "memory": {"estimated_mb": 1.0, "downscale": 1.0},
+        "image_size": (40, 40),
+        "method": 1
+    }
+
+
+def test_semantic_map_is_not_cached(tmp_path):
+    cache = app.ResultCache(str(tmp_path), 2**30)
+    cache.put("k", _results())
+    cached = cache.get("k")
+    assert "semantic_map" not in cached
+    assert "detections" not in cached and "memory" not in cached
+    assert cached["label_map_id"] == "ab" * 32
+
+
+def test_overwrite_keeps_byte_count(tmp_path):
+    cache = app.ResultCache(str(tmp_path), 2**30)
+    cache.put("k", _results())
+    size = cache._bytes
+    cache.put("k", _results())
+    cache.put("k", _results())
+    assert cache._bytes == size == (tmp_path / "k.pkl.z").stat().st_size
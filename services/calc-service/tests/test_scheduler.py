@@ -0,0 +1,72 @@
+import threading
+import time
+
+import numpy as np
+from PIL import Image
+
+import app
+
+
+class _Segmentator:
+    def __init__(self):
+        self.batches = []
+        self.release = threading.Event()
+
+    def resized_shape(self, image_size):
+        width, height = image_size
+        return height, width
+
+    def predict_semantic_maps(self, images):
+        self.release.wait(5)
+        self.batches.append([image.size for image in images])
+        return [np.full(image.size[::-1], len(self.batches), dtype=np.uint8) for image in images]
+
+    def forward_semantic_maps(self, pixel_inputs, target_sizes):
+        self.batches.append(["inputs"])
+        return [np.full(size, pixel_inputs["value"], dtype=np.uint8) for size in target_sizes]
+
+
+class _Registry:
+    def __init__(self):
+        self.segmentator = _Segmentator()
+
+    def get(self, method):
+        return self.segmentator
+
+
+def test_batches_group_by_bucket_in_arrival_order():
+    registry = _Registry()
+    scheduler = app.InferenceScheduler(registry, max_batch_size=3, max_wait_ms=50, bucket_px=64)
+    # Первое изображение занимает воркер, остальные копятся в очереди
+    first = scheduler.submit(1, Image.new("RGB", (64, 64)))
+    while not first.running():
+        time.sleep(0.001)
+    sizes = [(64, 64), (256, 128), (64, 64), (64, 64), (256, 128), (64, 64)]
+    futures = [scheduler.submit(1, Image.new("RGB", size)) for size in sizes]
+    assert scheduler.stats()["pending"] == {1: len(sizes)}
+    registry.segmentator.release.set()
+    for future, size in zip(futures, sizes):
+        assert future.result(5).shape == size[::-1]
+    batches = registry.segmentator.batches
+    assert batches[0] == [(64, 64)]
+    # Корзина самого старого запроса уходит первой, в порядке поступления и не больше max_batch_size
+    assert batches[1:] == [[(64, 64)] * 3, [(256, 128)] * 2, [(64, 64)]]
+    assert scheduler.stats()["pending"] == {1: 0}
+
+
+def test_shared_inputs_run_alone_without_preprocessing():
+    registry = _Registry()
+    scheduler = app.InferenceScheduler(registry, max_batch_size=4, max_wait_ms=50, bucket_px=64)
+    first = scheduler.submit(1, Image.new("RGB", (64, 64)))
+    while not first.running():
+        time.sleep(0.001)
+    plain = scheduler.submit(1, Image.new("RGB", (64, 64)))
+    shared = scheduler.submit(1, Image.new("RGB", (64, 64)), {"value": 7})
+    other = scheduler.submit(1, Image.new("RGB", (64, 64)))
+    registry.segmentator.release.set()
+    # Готовые тензоры идут через forward_semantic_maps отдельным проходом
+    assert (shared.result(5) == 7).all() and shared.result().shape == (64, 64)
+    other.result(5)
+    batches = registry.segmentator.batches
+    assert sorted(map(str, batches[1:])) == sorted(map(str, [[(64, 64)] * 2, ["inputs"]]))
+    assert plain.result(5).shape == (64, 64)
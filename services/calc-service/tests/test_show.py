@@ -0,0 +1,35 @@
+import io
+
+from PIL import Image
+
+import app
+
+
+SHOW_ARGS = {"image_url": "http://example/img.jpg", "id": "id1", "method": 1, "bbox": "10,10,100,80",
+             "confidence": 0.9, "lat": 55.8, "lon": 37.7}
+
+
+def _setup(monkeypatch, tmp_path):
+    store = app.RenderStore(str(tmp_path), 2**30, 0, 0)
+    monkeypatch.setattr(app, "RENDER_STORE", store)
+    monkeypatch.setattr(app, "download_image", lambda image_url: Image.new("RGB", (1600, 1200), (90, 120, 60)))
+    return store, app.app.test_client()
+
+
+def test_show_stores_only_requested_variant(monkeypatch, tmp_path):
+    store, client = _setup(monkeypatch, tmp_path)
+    r = client.get("/show", query_string=dict(SHOW_ARGS, size="thumb", format="webp"))
+    assert r.status_code == 200 and r.mimetype == "image/webp"
+    assert max(Image.open(io.BytesIO(r.data)).size) == app.OUTPUT_SIZES["thumb"]
+    stats = store.stats()
+    # Полноразмерный рендер не сохраняется, пока его не запросят
+    assert stats["files"] == 1 and stats["pending_renders"] == 1
+
+
+def test_show_default_variant(monkeypatch, tmp_path):
+    store, client = _setup(monkeypatch, tmp_path)
+    r = client.get("/show", query_string=SHOW_ARGS)
+    assert r.status_code == 200 and r.mimetype == "image/jpeg"
+    assert Image.open(io.BytesIO(r.data)).size == (1600, 1200)
+    stats = store.stats()
+    assert stats["files"] == 1 and stats["pending_renders"] == 0
@@ -0,0 +1,55 @@
+import os
+import subprocess
+import sys
+
+import pytest
+
+import app
+
+
+@pytest.mark.parametrize("length,tile,overlap", [(2000, 1024, 128), (1024, 1024, 128), (5000, 512, 0), (3001, 1000, 999)])
+def test_tile_spans_cover_axis(length, tile, overlap):
+    spans = app._tile_spans(length, tile, overlap)
+    assert spans[0][1] == 0 and spans[-1][2] == length
+    for (start, cut_from, cut_to), (_, next_from, _) in zip(spans, spans[1:] + [(None, length, None)]):
+        assert cut_to == next_from
+        assert start <= cut_from < cut_to <= start + tile
+
+
+@pytest.mark.parametrize("overlap", [-1, 1024, 2000])
+def test_tile_spans_reject_bad_overlap(overlap):
+    with pytest.raises(ValueError):
+        app._tile_spans(2000, 1024, overlap)
+
+
+def test_bad_tile_overlap_fails_at_startup():
+    env = dict(os.environ, TILE_SIZE="1024", TILE_OVERLAP="1024")
+    service_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    result = subprocess.run([sys.executable, "-c", "import app"], cwd=service_dir, env=env,
+                            capture_output=True, text=True, timeout=300)
+    assert result.returncode != 0
+    assert "TILE_OVERLAP" in result.stderr
+
+
+def test_memory_estimate_counts_full_map_for_tiled_images(monkeypatch):
+    monkeypatch.setattr(app, "TILED_INFERENCE_MIN_MP", 12)
+    guard = app.MemoryGuard(0, "downscale", 1)
+    size = (8000, 5000)
+    px = size[0] * size[1]
+    estimate = guard.estimate(size, size, 1)
+    # Карта классов и маски - на весь кадр, логиты - только у тайлов в работе
+    assert estimate > (guard.RENDER_BYTES_PER_PX + guard.ANALYSIS_BYTES_PER_PX) * px
+    logits = estimate - (guard.RENDER_BYTES_PER_PX + guard.ANALYSIS_BYTES_PER_PX) * px
+    assert logits <= guard.DEFAULT_NUM_CLASSES * 4 * app._tiles_in_flight() * app.TILE_SIZE ** 2
+
+
+def test_memory_guard_downscales_oversized_tiled_image(monkeypatch, tmp_path):
+    from PIL import Image
+
+    monkeypatch.setattr(app, "TILED_INFERENCE_MIN_MP", 12)
+    path = tmp_path / "pano.png"
+    Image.new("RGB", (8000, 5000)).save(path)
+    guard = app.MemoryGuard(1500 * 2**20, "downscale", 1)
+    admission = guard.admit(path.read_bytes(), 1)
+    assert admission["working_size"][0] < 8000
+    assert guard.estimate(admission["source_size"], admission["working_size"], 1) <= guard.budget_bytes
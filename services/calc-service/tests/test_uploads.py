@@ -0,0 +1,63 @@
+import uuid
+
+import pytest
+
+import app
+
+
+PHOTO_UUID = str(uuid.uuid4())
+
+
+def test_path_is_a_hint_without_upload_dir():
+    resolver = app.UploadResolver("", "http://photo-service:5000")
+    image_url = f"http://photo-service:5000/photos/{PHOTO_UUID}"
+    data = {"image_url": image_url, "photo_uuid": PHOTO_UUID, "path": "photo.jpg"}
+    assert resolver.image_url(data) == image_url
+    assert resolver.image_url({"photo_uuid": PHOTO_UUID, "path": "photo.jpg"}) == image_url
+    assert resolver.local_path(image_url) is None
+
+
+def test_path_alone_requires_upload_dir():
+    resolver = app.UploadResolver("", "http://photo-service:5000")
+    with pytest.raises(ValueError):
+        resolver.image_url({"path": "photo.jpg"})
+
+
+def test_path_outside_upload_dir(tmp_path):
+    resolver = app.UploadResolver(str(tmp_path), "http://photo-service:5000")
+    with pytest.raises(ValueError):
+        resolver.image_url({"path": "../etc/passwd"})
+    # Как подсказка недопустимый путь игнорируется
+    assert resolver.image_url({"photo_uuid": PHOTO_UUID, "path": "../etc/passwd"}).endswith(PHOTO_UUID)
+    assert resolver.stats()["known_paths"] == 0
+
+
+def test_local_file_by_hint_and_by_uuid(tmp_path):
+    (tmp_path / "named.jpg").write_bytes(b"named")
+    (tmp_path / f"{PHOTO_UUID}.jpg").write_bytes(b"by-uuid")
+    resolver = app.UploadResolver(str(tmp_path), "http://photo-service:5000")
+    other = str(uuid.uuid4())
+    image_url = resolver.image_url({"photo_uuid": other, "path": "named.jpg"})
+    assert resolver.read(resolver.local_path(image_url)) == b"named"
+    image_url = resolver.image_url({"photo_uuid": PHOTO_UUID})
+    assert resolver.read(resolver.local_path(image_url)) == b"by-uuid"
+
+
+def test_detect_batch_without_upload_dir(monkeypatch):
+    """Гейтвей передает image_url, photo_uuid и path; без тома загрузок это обычный HTTP-путь"""
+    monkeypatch.setattr(app, "UPLOADS", app.UploadResolver("", "http://photo-service:5000"))
+    seen = []
+
+    def run(images, method, seed, auto_policy):
+        seen.extend(images)
+        return [{"original_image_url": img_data["image_url"]} for img_data in images]
+
+    monkeypatch.setattr(app.BATCH_PIPELINE, "run", run)
+    image_url = f"http://photo-service:5000/photos/{PHOTO_UUID}"
+    response = app.app.test_client().post("/detect_batch", json={
+        "method": 1,
+        "images": [{"image_url": image_url, "photo_uuid": PHOTO_UUID, "path": "photo.jpg", "lat": 55.7, "lon": 37.6}]
+    })
+    assert response.status_code == 200
+    assert response.get_json()["results"] == [{"original_image_url": image_url}]
+    assert seen[0]["image_url"] == image_url